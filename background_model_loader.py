@@ -0,0 +1,71 @@
+######
+# Project       : lollms
+# File          : background_model_loader.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Background model loading shared by the bindings that can swap models while serving requests
+# (python_llama_cpp, hugging_face, bs_exllamav2). The bindings load it from the bindings zoo folder.
+######
+from ascii_colors import ASCIIColors, trace_exception
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import wraps
+from typing import Callable
+
+
+class BackgroundModelLoader:
+    """
+    Loads models on a worker thread so that the current model keeps serving requests while
+    the next one is loading. model_ready is a future that resolves once the last requested
+    model has been installed.
+    """
+    def __init__(self, thread_name_prefix:str="model_loader"):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=thread_name_prefix)
+        self.model_ready = Future()
+        self.model_ready.set_result(None)
+
+    def submit(self, load:Callable, install:Callable):
+        future = Future()
+        self.model_ready = future
+        def run():
+            try:
+                future.set_result(install(load()))
+            except Exception as ex:
+                trace_exception(ex)
+                future.set_exception(ex)
+        self.executor.submit(run)
+        return future
+
+    def set_ready(self, result):
+        if self.model_ready.done():
+            self.model_ready = Future()
+        self.model_ready.set_result(result)
+
+    def set_failed(self, ex:Exception):
+        if self.model_ready.done():
+            self.model_ready = Future()
+        self.model_ready.set_exception(ex)
+
+    def wait(self, timeout:float=None):
+        """Waits for the model being loaded, load errors are reported by the loading thread"""
+        if not self.model_ready.done():
+            ASCIIColors.info("Waiting for the model to be loaded")
+            try:
+                self.model_ready.result(timeout)
+            except Exception as ex:
+                trace_exception(ex)
+
+
+def with_model_lock(method):
+    """
+    Waits for the model to be ready and prevents it from being swapped while the method runs.
+    Bindings that don't need the lock for every request can define request_lock to return the
+    context to use instead of model_lock.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.wait_for_model()
+        lock = self.request_lock() if hasattr(self, "request_lock") else self.model_lock
+        with lock:
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -22,9 +22,13 @@ import subprocess
 import yaml
 from tqdm import tqdm
 import sys
+import importlib.util
 import urllib
 import json
 import shutil
+import time
+import threading
+from functools import partial
 
 if not PackageManager.check_package_installed("PIL"):
     PackageManager.install_package("Pillow")
@@ -52,6 +56,13 @@ __license__ = "Apache 2.0"
 
 binding_name = "ExLLamav2"
 binding_folder_name = "bs_exllamav2"
+
+# The background model loader is shared by the bindings of the zoo that can swap models while serving requests
+if "background_model_loader" not in sys.modules:
+    loader_spec = importlib.util.spec_from_file_location("background_model_loader", Path(__file__).parent.parent / "background_model_loader.py")
+    sys.modules[loader_spec.name] = importlib.util.module_from_spec(loader_spec)
+    loader_spec.loader.exec_module(sys.modules[loader_spec.name])
+from background_model_loader import BackgroundModelLoader, with_model_lock
 import os
 import subprocess
 import gc
@@ -60,7 +71,6 @@ from datetime import datetime
 from lollms.com import NotificationDisplayType, NotificationType
 
 
-
 class ExLLamav2(LLMBinding):
     
     def __init__(self, 
@@ -99,6 +109,8 @@ class ExLLamav2(LLMBinding):
             {"name":"ctx_size","type":"int","value":4090, "min":512, "help":"The current context size (it depends on the model you are using). Make sure the context size if correct or you may encounter bad outputs."},
             {"name":"max_n_predict","type":"int","value":4090, "min":512, "help":"The maximum amount of tokens to generate"},
             {"name":"seed","type":"int","value":-1,"help":"Random numbers generation seed allows you to fix the generation making it dterministic. This is useful for repeatability. To make the generation random, please set seed to -1."},
+            {"name":"background_loading","type":"bool","value":False, "help":"Load new models in the background. The current model keeps answering until the new one is ready"},
+            {"name":"warmup","type":"bool","value":False, "help":"Run the generator warmup after loading a model"},
 
         ])
         binding_config_vals = BaseConfig.from_template(binding_config_template)
@@ -138,6 +150,8 @@ class ExLLamav2(LLMBinding):
 
         self.model = None
         self.tokenizer = None
+        self.model_lock = threading.RLock()
+        self.model_loader = BackgroundModelLoader("exllamav2_loader")
         
     def settings_updated(self):
         self.config.ctx_size = self.binding_config.config.ctx_size        
@@ -171,7 +185,6 @@ class ExLLamav2(LLMBinding):
         self.config.ctx_size=self.binding_config.config.ctx_size
         self.config.max_n_predict=self.binding_config.max_n_predict
         import torch
-        from transformers import GenerationConfig
         import torch
         self.torch = torch
         try:
@@ -179,7 +192,7 @@ class ExLLamav2(LLMBinding):
             if self.config.model_name:
 
                 path = self.config.model_name
-                self.ShowBlockingMessage(f"Building model\n{path}")
+                self.report_load_progress(f"Building model\n{path}")
                 model_path = self.get_model_path()
 
                 if not model_path:
@@ -192,80 +205,144 @@ class ExLLamav2(LLMBinding):
 
                 model_name = str(model_path).replace("\\","/")
 
+                if self.binding_config.background_loading:
+                    # The current model keeps serving the requests until the new one is ready
+                    future = self.model_loader.submit(partial(self.load_model, model_path, model_name, models_dir), lambda entry: self.swap_model(entry) or self)
+                    future.add_done_callback(lambda f: f.exception() is not None and self.error(str(f.exception())))
+                    return self
+
                 self.destroy_model()
+                try:
+                    entry = self.load_model(model_path, model_name, models_dir)
+                except Exception as ex:
+                    self.model_loader.set_failed(ex)
+                    raise ex
+                self.swap_model(entry)
+                self.model_loader.set_ready(self)
+                return self
+            else:
+                self.InfoMessage(f"No model is selected\nPlease select a model from the Models zoo to start using ExllamaV2 binding")
+        except Exception as ex:
+            trace_exception(ex)
+            self.error(str(ex))
+            self.HideBlockingMessage()
 
-                gen_cfg = model_path/"generation_config.json"
-                if not gen_cfg.exists():
-                    with open(gen_cfg,"w") as f:
-                        json.dump({
-                            "_from_model_config": True,
-                            "bos_token_id": 1,
-                            "eos_token_id": 32000,
-                            "transformers_version": "4.35.0.dev0"
-                    }
-                    ,f)
-                import os
-                os.environ['HF_HOME'] = str(models_dir)
-                self.generation_config = GenerationConfig.from_pretrained(str(model_path))
-                self.ShowBlockingMessage(f"Creating model {model_path}\nUsing device map: {self.binding_config.device_map}")
+    def load_model(self, model_path, model_name, models_dir):
+        """
+        Loads the model, its cache, tokenizer and generator without touching the model currently in use.
 
-                
-                from exllamav2 import ExLlamaV2, ExLlamaV2Config,  ExLlamaV2Cache, ExLlamaV2Tokenizer
-                from exllamav2.generator import ExLlamaV2StreamingGenerator, ExLlamaV2Sampler
+        Returns:
+            dict: The loaded model entry, ready to be swapped in
+        """
+        from transformers import GenerationConfig
+        load_start = time.perf_counter()
+        gen_cfg = model_path/"generation_config.json"
+        if not gen_cfg.exists():
+            with open(gen_cfg,"w") as f:
+                json.dump({
+                    "_from_model_config": True,
+                    "bos_token_id": 1,
+                    "eos_token_id": 32000,
+                    "transformers_version": "4.35.0.dev0"
+            }
+            ,f)
+        import os
+        os.environ['HF_HOME'] = str(models_dir)
+        generation_config = GenerationConfig.from_pretrained(str(model_path))
+        self.report_load_progress(f"Creating model {model_path}\nUsing device map: {self.binding_config.device_map}")
 
+        
+        from exllamav2 import ExLlamaV2, ExLlamaV2Config,  ExLlamaV2Cache, ExLlamaV2Tokenizer
+        from exllamav2.generator import ExLlamaV2StreamingGenerator, ExLlamaV2Sampler
 
-                config = ExLlamaV2Config()
-                config.model_dir = model_name
-                config.prepare()
-                # config.max_seq_len = shared.args.max_seq_len
-                # config.scale_pos_emb = shared.args.compress_pos_emb
-                # config.scale_alpha_value = shared.args.alpha_value
-                config.no_flash_attn = not self.binding_config.enable_flash_attention_2
-                try:
-                    config.num_experts_per_token = int(self.binding_config.num_experts_per_token)
-                except:
-                    self.binding_config.config["num_experts_per_token"] = 2
-                    self.binding_config.save()
 
-                self.model = ExLlamaV2(config)
-                print("Loading model: " + model_name)
+        config = ExLlamaV2Config()
+        config.model_dir = model_name
+        config.prepare()
+        # config.max_seq_len = shared.args.max_seq_len
+        # config.scale_pos_emb = shared.args.compress_pos_emb
+        # config.scale_alpha_value = shared.args.alpha_value
+        config.no_flash_attn = not self.binding_config.enable_flash_attention_2
+        try:
+            config.num_experts_per_token = int(self.binding_config.num_experts_per_token)
+        except:
+            self.binding_config.config["num_experts_per_token"] = 2
+            self.binding_config.save()
 
-                self.cache = ExLlamaV2Cache(self.model, lazy = True)
-                try:
-                    self.model.load_autosplit(self.cache)
-                except Exception as ex:
-                    ASCIIColors.red("unsufficient VRAM!")
-                self.ShowBlockingMessage(f"Creating tokenizer {model_path}")
-                self.tokenizer = ExLlamaV2Tokenizer(config)
-                self.ShowBlockingMessage(f"Recovering generation config {model_path}")
+        model = ExLlamaV2(config)
+        print("Loading model: " + model_name)
 
-                # Initialize generator
+        cache = ExLlamaV2Cache(model, lazy = True)
+        try:
+            model.load_autosplit(cache)
+        except Exception as ex:
+            ASCIIColors.red("unsufficient VRAM!")
+        self.report_load_progress(f"Creating tokenizer {model_path}")
+        tokenizer = ExLlamaV2Tokenizer(config)
+        self.report_load_progress(f"Recovering generation config {model_path}")
+
+        # Initialize generator
+
+        generator = ExLlamaV2StreamingGenerator(model, cache, tokenizer)
+        settings = ExLlamaV2Sampler.Settings()
+        ASCIIColors.info(f"Model built in {time.perf_counter()-load_start:.2f}s")
+        if self.binding_config.warmup:
+            self.report_load_progress("Warming up")
+            warmup_start = time.perf_counter()
+            generator.warmup()
+            ASCIIColors.info(f"Warmup took {time.perf_counter()-warmup_start:.2f}s")
 
-                self.generator = ExLlamaV2StreamingGenerator(self.model, self.cache, self.tokenizer)
-                    
-                self.ShowBlockingMessage(f"Model loaded successfully")
-                self.HideBlockingMessage()
-                self.settings = ExLlamaV2Sampler.Settings()
+        """
+        try:
+            if not self.binding_config.automatic_context_size:
+                self.model.seqlen = self.binding_config.ctx_size
+            self.config.ctx_size = self.model.seqlen
+        except:
+            self.model.seqlen = self.binding_config.ctx_size
+            self.config.ctx_size = self.model.seqlen
+        ASCIIColors.info(f"Context lenghth set to {self.model.seqlen}")
+        
+        """
+        return {
+            "model":model,
+            "cache":cache,
+            "tokenizer":tokenizer,
+            "generator":generator,
+            "settings":settings,
+            "generation_config":generation_config
+        }
+
+    def swap_model(self, entry:dict):
+        """
+        Installs a loaded model entry as the current model.
+        The swap waits for the running generation to finish.
+        """
+        with self.model_lock:
+            old_model = self.model
+            self.model = entry["model"]
+            self.cache = entry["cache"]
+            self.tokenizer = entry["tokenizer"]
+            self.generator = entry["generator"]
+            self.settings = entry["settings"]
+            self.generation_config = entry["generation_config"]
+        if old_model is not None and hasattr(old_model, "unload"):
+            old_model.unload()
+        del old_model
+        gc.collect()
+        self.report_load_progress(f"Model loaded successfully")
+        self.HideBlockingMessage()
 
+    def wait_for_model(self, timeout:float=None):
+        """Waits for a model being loaded in the background when there is no model to serve the request"""
+        if self.model is None:
+            self.model_loader.wait(timeout)
 
-                """
-                try:
-                    if not self.binding_config.automatic_context_size:
-                        self.model.seqlen = self.binding_config.ctx_size
-                    self.config.ctx_size = self.model.seqlen
-                except:
-                    self.model.seqlen = self.binding_config.ctx_size
-                    self.config.ctx_size = self.model.seqlen
-                ASCIIColors.info(f"Context lenghth set to {self.model.seqlen}")
-                
-                """
-                return self
-            else:
-                self.InfoMessage(f"No model is selected\nPlease select a model from the Models zoo to start using ExllamaV2 binding")
-        except Exception as ex:
-            trace_exception(ex)
-            self.error(str(ex))
-            self.HideBlockingMessage()
+    def report_load_progress(self, text:str):
+        if self.binding_config.background_loading:
+            ASCIIColors.info(text)
+            self.notify(text, NotificationType.NOTIF_INFO)
+        else:
+            self.ShowBlockingMessage(text)
 
     def install(self):
         self.ShowBlockingMessage("Freeing memory...")
@@ -303,6 +380,8 @@ class ExLLamav2(LLMBinding):
                 {"name":"device_map","type":"str","value":'auto','options':device_names, "help":"Select how the model will be spread on multiple devices"},
                 {"name":"ctx_size","type":"int","value":4090, "min":512, "help":"The current context size (it depends on the model you are using). Make sure the context size if correct or you may encounter bad outputs."},
                 {"name":"seed","type":"int","value":-1,"help":"Random numbers generation seed allows you to fix the generation making it dterministic. This is useful for repeatability. To make the generation random, please set seed to -1."},
+                {"name":"background_loading","type":"bool","value":False, "help":"Load new models in the background. The current model keeps answering until the new one is ready"},
+                {"name":"warmup","type":"bool","value":False, "help":"Run the generator warmup after loading a model"},
 
             ])
             binding_config_vals = BaseConfig.from_template(binding_config_template)
@@ -338,6 +417,7 @@ class ExLLamav2(LLMBinding):
         Returns:
             list: A list of tokens representing the tokenized prompt.
         """
+        self.wait_for_model()
         ptt= self.tokenizer.encode(prompt)[0]
         return ptt.tolist()
     
@@ -351,10 +431,12 @@ class ExLLamav2(LLMBinding):
         Returns:
             str: The detokenized text as a string.
         """
+        self.wait_for_model()
         tk = self.tokenizer.decode(self.torch.tensor(tokens_list))
         return tk
     
 
+    @with_model_lock
     def generate(self, 
                  prompt:str,                  
                  n_predict: int = 128,
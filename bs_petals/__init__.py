@@ -21,6 +21,7 @@ from lollms.utilities import check_and_install_torch
 import subprocess
 import yaml
 import sys
+import importlib.util
 import urllib
 
 
@@ -31,6 +32,14 @@ __license__ = "Apache 2.0"
 
 binding_name = "Petals"
 binding_folder_name = "bs_petals"
+
+# The detokenizer is shared by the bindings of the zoo that use transformers tokenizers
+if "incremental_detokenizer" not in sys.modules:
+    detokenizer_spec = importlib.util.spec_from_file_location("incremental_detokenizer", Path(__file__).parent.parent / "incremental_detokenizer.py")
+    sys.modules[detokenizer_spec.name] = importlib.util.module_from_spec(detokenizer_spec)
+    detokenizer_spec.loader.exec_module(sys.modules[detokenizer_spec.name])
+from incremental_detokenizer import IncrementalDetokenizer
+
 import os
 import subprocess
 import gc
@@ -84,8 +93,7 @@ class Petals(LLMBinding):
         self.decode_kwargs = {}
 
         # variables used in the streaming process
-        self.token_cache = []
-        self.print_len = 0
+        self.detokenizer = None
         self.next_tokens_are_prompt = True
         try:
             import petals
@@ -255,26 +263,12 @@ class Petals(LLMBinding):
 
         if self.skip_prompt and self.next_tokens_are_prompt:
             self.next_tokens_are_prompt = False
+            # The end of the prompt gives their leading spaces to the first generated tokens
+            self.detokenizer.set_prompt(value.tolist())
             return
 
-        # Add the new token to the cache and decodes the entire thing.
-        self.token_cache.extend(value.tolist())
-        text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
-
-        # After the symbol for a new line, we flush the cache.
-        if text.endswith("\n"):
-            printable_text = text[self.print_len :]
-            self.token_cache = []
-            self.print_len = 0
-        # If the last token is a CJK character, we print the characters.
-        elif len(text) > 0 and self._is_chinese_char(ord(text[-1])):
-            printable_text = text[self.print_len :]
-            self.print_len += len(printable_text)
-        # Otherwise, prints until the last space char (simple heuristic to avoid printing incomplete words,
-        # which may change with the subsequent token -- there are probably smarter ways to do this!)
-        else:
-            printable_text = text[self.print_len : text.rfind(" ") + 1]
-            self.print_len += len(printable_text)
+        # Only the last tokens are decoded, the cost of a token doesn't grow with the length of the line
+        printable_text = self.detokenizer.add(value.tolist())
 
         self.output += printable_text
         if  self.callback:
@@ -308,13 +302,8 @@ class Petals(LLMBinding):
     def end(self):
         """Flushes any remaining cache and prints a newline to stdout."""
         # Flush the cache, if it exists
-        if len(self.token_cache) > 0:
-            text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
-            printable_text = text[self.print_len :]
-            self.token_cache = []
-            self.print_len = 0
-        else:
-            printable_text = ""
+        printable_text = self.detokenizer.flush()
+        self.output += printable_text
 
         self.next_tokens_are_prompt = True
         if  self.callback:
@@ -358,8 +347,7 @@ class Petals(LLMBinding):
         gpt_params = {**default_params, **gpt_params}
         self.callback = callback    
         try:
-            self.token_cache = []
-            self.print_len = 0
+            self.detokenizer = IncrementalDetokenizer(self.tokenizer, self.decode_kwargs)
             self.next_tokens_are_prompt = True            
             self.n_generated = 0
             self.output = ""
@@ -22,8 +22,18 @@ import subprocess
 from datetime import datetime
 from tqdm import tqdm
 import sys
+import importlib.util
 import urllib
 import json
+import time
+import threading
+import platform
+import inspect
+import copy
+from functools import partial
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 if not PackageManager.check_package_installed("PIL"):
     PackageManager.install_package("Pillow")
 
@@ -42,6 +52,7 @@ if not PackageManager.check_package_installed("transformers"):
 
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig, AutoConfig, AutoProcessor, LlavaForConditionalGeneration    
+from transformers import StoppingCriteria, StoppingCriteriaList
 from transformers import GPTQConfig
 from transformers import AwqConfig
 
@@ -56,6 +67,21 @@ __license__ = "Apache 2.0"
 
 binding_name = "HuggingFace"
 binding_folder_name = "hugging_face"
+
+# The detokenizer is shared by the bindings of the zoo that use transformers tokenizers
+if "incremental_detokenizer" not in sys.modules:
+    detokenizer_spec = importlib.util.spec_from_file_location("incremental_detokenizer", Path(__file__).parent.parent / "incremental_detokenizer.py")
+    sys.modules[detokenizer_spec.name] = importlib.util.module_from_spec(detokenizer_spec)
+    detokenizer_spec.loader.exec_module(sys.modules[detokenizer_spec.name])
+from incremental_detokenizer import IncrementalDetokenizer
+
+# The background model loader is shared by the bindings of the zoo that can swap models while serving requests
+if "background_model_loader" not in sys.modules:
+    loader_spec = importlib.util.spec_from_file_location("background_model_loader", Path(__file__).parent.parent / "background_model_loader.py")
+    sys.modules[loader_spec.name] = importlib.util.module_from_spec(loader_spec)
+    loader_spec.loader.exec_module(sys.modules[loader_spec.name])
+from background_model_loader import BackgroundModelLoader, with_model_lock
+
 import os
 import subprocess
 import gc
@@ -67,6 +93,391 @@ import torch
 
 
 
+class MaxNewTokensStoppingCriteria(StoppingCriteria):
+    """
+    Stops after n_predict new tokens. The compiled mode sets max_length to the context size so that the
+    static cache has the same size for every request, the number of new tokens is limited here instead.
+    """
+    def __init__(self, start_length:int, n_predict:int):
+        self.start_length = start_length
+        self.n_predict = n_predict
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = input_ids.shape[-1]-self.start_length>=self.n_predict
+        return torch.full((input_ids.shape[0],), done, dtype=torch.bool, device=input_ids.device)
+
+
+def cache_layers(past_key_values):
+    """Returns the (keys, values) tensors of each layer of a KV cache, whatever its format"""
+    if isinstance(past_key_values, (tuple, list)):
+        return [(layer[0], layer[1]) for layer in past_key_values]
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+
+
+def build_cache(layers:list, like):
+    """Builds a KV cache of the same format as like out of the (keys, values) tensors of each layer"""
+    if isinstance(like, (tuple, list)):
+        return tuple((keys, values) for keys, values in layers)
+    cache = type(like)()
+    for layer_idx, (keys, values) in enumerate(layers):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+class AssistedGenerationMonitor:
+    """
+    Measures how many drafted tokens the main model accepts during an assisted generation.
+    Each forward of the main model verifies the tokens drafted since the previous one and produces the
+    accepted tokens plus one, so the drafted tokens are read from the inputs of the forwards.
+    """
+    def __init__(self, model, n_prompt:int):
+        self.n_prompt = n_prompt
+        self.n_forwards = 0
+        self.n_drafted = 0
+        self.handle = model.register_forward_pre_hook(self.hook, with_kwargs=True)
+
+    def hook(self, module, args, kwargs):
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is None:
+            return
+        if self.n_forwards==0:
+            # The first forward also evaluates the prompt
+            self.n_drafted += input_ids.shape[1]-self.n_prompt
+        else:
+            self.n_drafted += input_ids.shape[1]-1
+        self.n_forwards += 1
+
+    def close(self):
+        self.handle.remove()
+
+    def summary(self, n_generated:int):
+        n_accepted = max(n_generated-self.n_forwards, 0)
+        acceptance = n_accepted/self.n_drafted if self.n_drafted>0 else 0
+        return f"Assisted generation: {n_accepted}/{self.n_drafted} drafted tokens accepted ({acceptance*100:.1f}%), {n_generated/max(self.n_forwards, 1):.2f} tokens per forward of the model"
+
+
+class PrefixKVCache:
+    """
+    Keeps the KV cache of the last generations, indexed by a trie of their tokens, in a memory budget.
+    A new prompt that shares its beginning with a kept sequence (the system prompt and the previous
+    messages of a discussion) reuses the KV cache of the shared tokens and only evaluates the rest.
+    The least recently used sequences are removed when the budget is exceeded.
+    """
+    def __init__(self, budget_bytes:int):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.root = {"children":{}, "keys":set()}
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(self, tokens:list):
+        """
+        Returns the KV cache of the longest kept prefix of tokens (cropped to that prefix), its length and
+        the key of the kept sequence it comes from. At least the last token of the prompt is left to evaluate.
+        """
+        node = self.root
+        depth = 0
+        for token in tokens[:-1]:
+            child = node["children"].get(token)
+            if child is None:
+                break
+            node = child
+            depth += 1
+        if depth==0:
+            self.misses += 1
+            return None, 0, None
+        # All the sequences going through the node share the prefix, the most recent one is used
+        key = next(key for key in reversed(self.entries) if key in node["keys"])
+        entry = self.entries[key]
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.reused_tokens += depth
+        # The kept tensors are not modified, the generation appends to copies
+        layers = [(keys[:, :, :depth], values[:, :, :depth]) for keys, values in entry["layers"]]
+        return build_cache(layers, entry["like"]), depth, key
+
+    def add(self, tokens:list, past_key_values, prompt_length:int, started_from:tuple=None, n_reused:int=0):
+        """
+        Keeps the KV cache of a generated sequence. tokens are the tokens whose keys and values are in the cache.
+        started_from is the kept sequence the generation reused n_reused tokens of. When the whole prompt of that
+        sequence was reused, the new sequence continues the same discussion and replaces it (the previous answer
+        is tokenized differently once it is part of the prompt, so it is not an exact prefix of the new sequence).
+        """
+        layers = cache_layers(past_key_values)
+        length = layers[0][0].shape[-2]
+        tokens = tuple(tokens[:length])
+        size = sum(keys.numel()*keys.element_size()+values.numel()*values.element_size() for keys, values in layers)
+        if size>self.budget_bytes or length==0:
+            return
+        # The kept sequences that are prefixes of the new one are not useful anymore
+        prefixes = []
+        node = self.root
+        for depth, token in enumerate(tokens, 1):
+            node = node["children"].get(token)
+            if node is None:
+                break
+            prefixes += [key for key in node["keys"] if len(key)==depth]
+        if started_from in self.entries and started_from not in prefixes and self.entries[started_from]["prompt_length"]<=n_reused:
+            prefixes.append(started_from)
+        for key in prefixes:
+            self.remove(key)
+        self.entries[tokens] = {"layers":layers, "like":past_key_values, "size":size, "prompt_length":prompt_length}
+        self.total_size += size
+        node = self.root
+        for token in tokens:
+            node = node["children"].setdefault(token, {"children":{}, "keys":set()})
+            node["keys"].add(tokens)
+        while self.total_size>self.budget_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key:tuple):
+        entry = self.entries.pop(key)
+        self.total_size -= entry["size"]
+        node = self.root
+        for token in key:
+            child = node["children"][token]
+            child["keys"].discard(key)
+            if not child["keys"]:
+                del node["children"][token]
+                break
+            node = child
+
+    def clear(self):
+        self.entries.clear()
+        self.root = {"children":{}, "keys":set()}
+        self.total_size = 0
+
+    def summary(self):
+        return f"Prefix cache: {self.hits} hits, {self.misses} misses, {self.reused_tokens} prompt tokens reused, {len(self.entries)} sequences ({self.total_size/(1<<20):.1f}/{self.budget_bytes/(1<<20):.1f} MiB)"
+
+
+class BatchRequest:
+    """A generation request served by the continuous batching scheduler, with its own sampler and callback"""
+    def __init__(self, prompt_tokens:list, n_predict:int, callback, logits_processors, do_sample:bool, generator, detokenizer):
+        self.prompt_tokens = prompt_tokens
+        self.tokens = list(prompt_tokens)
+        self.n_predict = n_predict
+        self.callback = callback
+        self.logits_processors = logits_processors
+        self.do_sample = do_sample
+        self.generator = generator
+        self.detokenizer = detokenizer
+        self.output = ""
+        self.n_generated = 0
+        self.future = Future()
+
+
+class ContinuousBatchScheduler:
+    """
+    Serves the generation requests of concurrent users with a single decode loop.
+    Between two decode steps, the finished requests leave the batch and the waiting requests join it:
+    their prompts are evaluated together, then their KV cache is left padded to the length of the batch
+    cache and appended to it. Each decode step advances all the running requests at once.
+    """
+    def __init__(self, binding, max_sequences:int=8):
+        self.binding = binding
+        self.max_sequences = max_sequences
+        self.pending = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.reset_batch()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def reset_batch(self):
+        self.active = []
+        self.model = None
+        self.past_key_values = None
+        self.attention_mask = None
+        self.position_ids = None
+        self.next_tokens = None
+
+    def submit(self, prompt:str, n_predict:int, callback, gpt_params:dict):
+        """Queues a request and returns a future of its generated text"""
+        binding = self.binding
+        logits_processors, do_sample, generator = binding.build_sampler(gpt_params)
+        tokenizer = binding.tokenizer
+        prompt_tokens = tokenizer.encode(prompt, add_special_tokens=False) or [tokenizer.eos_token_id]
+        request = BatchRequest(
+                                prompt_tokens,
+                                int(n_predict),
+                                callback,
+                                logits_processors,
+                                do_sample,
+                                generator,
+                                binding.start_stream(prompt_tokens)
+                            )
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+        return request.future
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and not self.pending and not self.active:
+                    self.condition.wait()
+                if self.stopped:
+                    break
+                admitted = self.pending[:self.max_sequences-len(self.active)]
+                del self.pending[:len(admitted)]
+            try:
+                # The model can't be swapped during a step, it can be swapped between two steps
+                with self.binding.model_lock:
+                    if self.active and self.binding.model is not self.model:
+                        ASCIIColors.warning("The model changed, the running generations are stopped")
+                        self.finish_all()
+                    if admitted:
+                        self.admit(admitted)
+                    if self.active:
+                        self.step()
+            except Exception as ex:
+                trace_exception(ex)
+                for request in self.active+[request for request in admitted if request not in self.active]:
+                    if not request.future.done():
+                        request.future.set_exception(ex)
+                self.reset_batch()
+        for request in self.active+self.pending:
+            request.future.cancel()
+
+    def admit(self, requests:list):
+        """Evaluates the prompts of the new requests and appends them to the running batch"""
+        binding = self.binding
+        input_ids, attention_mask, position_ids = binding.pad_prompts([request.prompt_tokens for request in requests])
+        prompt_length = input_ids.shape[1]
+        with torch.no_grad():
+            out = binding.model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=None, use_cache=True, **binding.position_params(position_ids))
+        if self.active:
+            # Both caches are left padded to the same length before being stacked
+            batch_length = self.attention_mask.shape[1]
+            length = max(batch_length, prompt_length)
+            layers = [
+                (torch.cat([self.pad_left(keys, length), self.pad_left(new_keys, length)], dim=0),
+                 torch.cat([self.pad_left(values, length), self.pad_left(new_values, length)], dim=0))
+                for (keys, values), (new_keys, new_values) in zip(cache_layers(self.past_key_values), cache_layers(out.past_key_values))
+            ]
+            self.past_key_values = build_cache(layers, out.past_key_values)
+            self.attention_mask = torch.cat([self.pad_left(self.attention_mask, length), self.pad_left(attention_mask, length)], dim=0)
+            self.position_ids = torch.cat([self.position_ids, position_ids[:, -1:]], dim=0)
+        else:
+            self.model = binding.model
+            self.past_key_values = out.past_key_values
+            self.attention_mask = attention_mask
+            self.position_ids = position_ids[:, -1:]
+        next_tokens = self.sample(requests, out.logits[:, -1, :])
+        self.next_tokens = next_tokens if not self.active else torch.cat([self.next_tokens, next_tokens], dim=0)
+        self.active += requests
+        self.evict(self.emit(len(self.active)-len(requests)))
+
+    def step(self):
+        """Generates one token for each running request"""
+        self.attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((len(self.active), 1))], dim=-1)
+        self.position_ids = self.position_ids+1
+        with torch.no_grad():
+            out = self.binding.model(input_ids=self.next_tokens[:, None], attention_mask=self.attention_mask, past_key_values=self.past_key_values, use_cache=True, **self.binding.position_params(self.position_ids))
+        self.past_key_values = out.past_key_values
+        self.next_tokens = self.sample(self.active, out.logits[:, -1, :])
+        self.evict(self.emit(0))
+
+    @staticmethod
+    def pad_left(tensor, length:int):
+        """Left pads the sequence dimension of a cache tensor (or of an attention mask) with zeros"""
+        dim = -2 if tensor.dim()==4 else -1
+        padding = length-tensor.shape[dim]
+        if padding==0:
+            return tensor
+        shape = list(tensor.shape)
+        shape[dim] = padding
+        return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+    def sample(self, requests:list, logits):
+        """Each request is sampled with its own parameters"""
+        return torch.stack([
+            self.binding.sample_next_tokens(
+                request.logits_processors,
+                torch.tensor([request.tokens], dtype=torch.long, device=logits.device),
+                logits[i:i+1],
+                request.do_sample,
+                request.generator
+            )[0]
+            for i, request in enumerate(requests)
+        ])
+
+    def emit(self, start:int):
+        """Streams the tokens sampled for the requests from start on and returns the indices of the finished requests"""
+        eos_token_ids = self.binding.eos_token_ids()
+        finished = []
+        for i in range(start, len(self.active)):
+            request = self.active[i]
+            token = int(self.next_tokens[i])
+            text, done = self.binding.stream_token(token, request.detokenizer, request.callback, eos_token_ids)
+            request.output += text
+            if token not in eos_token_ids:
+                request.tokens.append(token)
+                request.n_generated += 1
+            if done or request.n_generated>=request.n_predict:
+                finished.append(i)
+        return finished
+
+    def finish(self, request:BatchRequest):
+        request.output += self.binding.end_stream(request.detokenizer, request.callback)
+        request.future.set_result(request.output)
+
+    def finish_all(self):
+        for request in self.active:
+            self.finish(request)
+        self.reset_batch()
+
+    def evict(self, finished:list):
+        """Removes the finished requests from the batch and from the KV cache"""
+        if not finished:
+            return
+        for i in finished:
+            self.finish(self.active[i])
+        keep = [i for i in range(len(self.active)) if i not in finished]
+        if not keep:
+            self.reset_batch()
+            return
+        index = torch.tensor(keep, device=self.next_tokens.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        self.past_key_values = self.binding.select_cache_rows(self.past_key_values, index)
+        # The columns that only held the padding or the tokens of the evicted requests are dropped
+        start = int(attention_mask.any(dim=0).nonzero()[0])
+        self.attention_mask = attention_mask[:, start:]
+        if start>0:
+            self.past_key_values = build_cache([(keys[:, :, start:], values[:, :, start:]) for keys, values in cache_layers(self.past_key_values)], self.past_key_values)
+        self.position_ids = self.position_ids.index_select(0, index)
+        self.next_tokens = self.next_tokens.index_select(0, index)
+        self.active = [self.active[i] for i in keep]
+
+
+def onnx_quantization_config():
+    """Returns the int8 dynamic quantization config of onnxruntime matching the instructions of this cpu"""
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    if platform.machine().lower() in ["arm64", "aarch64"]:
+        return AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+    flags = ""
+    try:
+        flags = Path("/proc/cpuinfo").read_text()
+    except:
+        pass
+    if "avx512_vnni" in flags:
+        return AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    if "avx512f" in flags:
+        return AutoQuantizationConfig.avx512(is_static=False, per_channel=False)
+    return AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+
+
 class HuggingFace(LLMBinding):
     
     def __init__(self, 
@@ -104,6 +515,17 @@ class HuggingFace(LLMBinding):
             {"name":"ctx_size","type":"int","value":4090, "min":512, "help":"The current context size (it depends on the model you are using). Make sure the context size if correct or you may encounter bad outputs."},
             {"name":"max_n_predict","type":"int","value":4090, "min":512, "help":"The maximum amount of tokens to generate"},
             {"name":"seed","type":"int","value":-1,"help":"Random numbers generation seed allows you to fix the generation making it dterministic. This is useful for repeatability. To make the generation random, please set seed to -1."},
+            {"name":"background_loading","type":"bool","value":False, "help":"Load new models in the background. The current model keeps answering until the new one is ready"},
+            {"name":"warmup","type":"bool","value":False, "help":"Run a short test generation after loading a model"},
+            {"name":"batch_max_sequences","type":"int","value":8, "min":1, "help":"Maximum number of prompts generated together by generate_batch, or of requests generated together when continuous_batching is on"},
+            {"name":"speculative_mode","type":"str","value":"off", "options":["off","prompt_lookup","draft_model"], "help":"Assisted generation proposes several tokens at once that the model verifies in a single pass.\nprompt_lookup drafts tokens by looking up the last generated words in the prompt (good for code edition and rewriting).\ndraft_model uses a small model of the hugging face models folder sharing the vocabulary of the main model (a model with another vocabulary is slower). Not used in compiled mode or with continuous batching, and the prefix cache is not used when it is on"},
+            {"name":"draft_model_name","type":"str","value":"", "help":"Name of the small model (from the hugging face models folder) to use as draft model when speculative_mode is draft_model"},
+            {"name":"num_draft_tokens","type":"int","value":10, "min":1, "help":"Number of tokens drafted at each assisted generation step"},
+            {"name":"prefix_cache_budget","type":"int","value":0, "min":0, "help":"Memory in bytes kept for the KV cache of the last generations, on the device of the model (gpu memory for models on gpu). A prompt that starts like a previous one (same system prompt and previous messages) only evaluates its new tokens. 0 (default) deactivates the prefix cache (it is not used in compiled mode)"},
+            {"name":"execution_mode","type":"str","value":"eager", "options":["eager","compiled"], "help":"compiled preallocates a KV cache of ctx_size tokens and compiles the forward pass of the model with torch.compile when it is loaded. This removes most of the python overhead of each generated token (useful for small models on cpu) at the cost of a longer loading"},
+            {"name":"compile_buckets","type":"str","value":"32,128,512,2048", "help":"Comma separated prompt lengths compiled when the model is loaded in compiled mode. The prompts are padded to the next bucket so that they reuse a compiled graph"},
+            {"name":"backend","type":"str","value":"pytorch", "options":["pytorch","onnxruntime","openvino"], "help":"Inference backend of the model. onnxruntime and openvino export the model with int8 weights the first time it is loaded (this takes a while and needs enough memory to load the model in float32), then reuse the export kept in the exports folder of the hugging face models folder. They run faster and use less memory than pytorch on cpu. llava, gptq and awq models always use pytorch. Compiled mode, assisted generation, continuous batching and the prefix cache are not used with these backends"},
+            {"name":"continuous_batching","type":"bool","value":False, "help":"Serve the requests of concurrent users with a single decode loop instead of one after the other. New requests join the running generations between two tokens"},
 
         ])
         binding_config_vals = BaseConfig.from_template(binding_config_template)
@@ -132,12 +554,20 @@ class HuggingFace(LLMBinding):
         self.decode_kwargs = {}
 
         # variables used in the streaming process
-        self.token_cache = []
-        self.print_len = 0
+        self.detokenizer = None
         self.next_tokens_are_prompt = True
 
         self.model = None
         self.tokenizer = None
+        self.model_lock = threading.RLock()
+        self.model_loader = BackgroundModelLoader("hugging_face_loader")
+        self.scheduler = None
+        self.compiled_forward = None
+        self.compile_buckets = []
+        self.prefix_cache = None
+        self.draft_model = None
+        self.draft_tokenizer = None
+        self.backend = "pytorch"
 
         self.binding_config = binding_config
         
@@ -180,7 +610,7 @@ class HuggingFace(LLMBinding):
         try:
             if self.config.model_name:
                 path = self.config.model_name
-                self.ShowBlockingMessage(f"Building model\n{path}")
+                self.report_load_progress(f"Building model\n{path}")
                 model_path = self.get_model_path()
 
                 if not model_path:
@@ -193,97 +623,20 @@ class HuggingFace(LLMBinding):
 
                 model_name = str(model_path).replace("\\","/")
 
-                self.destroy_model()
-
+                if self.binding_config.background_loading:
+                    # The current model keeps serving the requests until the new one is ready
+                    future = self.model_loader.submit(partial(self.load_model, model_path, model_name, models_dir), lambda entry: self.swap_model(entry) or self)
+                    future.add_done_callback(lambda f: f.exception() is not None and self.InfoMessage(f"Couldn't load the model {model_path}\nHere is the error encountered during loading:\n"+str(f.exception())+"\nPlease choose another model or post a request on the discord channel."))
+                    return self
 
-                gen_cfg = model_path/"generation_config.json"
-                if not gen_cfg.exists():
-                    with open(gen_cfg,"w") as f:
-                        json.dump({
-                            "_from_model_config": True,
-                            "bos_token_id": 1,
-                            "eos_token_id": 32000,
-                            "transformers_version": "4.35.0.dev0"
-                    }
-                    ,f)
-                        
-                import os
-                os.environ['HF_HOME'] = str(models_dir)
-                self.ShowBlockingMessage(f"Creating tokenizer {model_path}")
-                mn= Path(model_name)
-                ref_path = mn/(mn.stem+".reference")
-                if (ref_path).exists():
-                    model_name = ref_path.read_text()
-                    model_path = model_name
-                
-                self.tokenizer = AutoTokenizer.from_pretrained(
-                        str(model_name), trust_remote_code=self.binding_config.trust_remote_code
-                        )
-                
-
-                if "llava" in str(model_path).lower() or "vision" in str(model_path).lower():
-                    self.model = LlavaForConditionalGeneration.from_pretrained(str(model_path),
-                                                device_map=self.binding_config.device_map,
-                                                offload_folder="offload",
-                                                offload_state_dict = True, 
-                                                trust_remote_code=self.binding_config.trust_remote_code,
-                                                low_cpu_mem_usage=self.binding_config.low_cpu_mem_usage,
-                                                load_in_8bit = self.binding_config.load_quantized_8bit,
-                                                load_in_4bit = self.binding_config.load_quantized_4bit if not self.binding_config.load_quantized_8bit else False,
-                                                torch_dtype=torch.bfloat16  # Load in float16 for quantization
-                                                )
-                    self.image_rocessor = AutoProcessor.from_pretrained(str(model_path))
-                    self.binding_type= BindingType.TEXT_IMAGE
-                    # from transformers import pipeline
-                    # self.pipe = pipeline("image-to-text", model=str(model_path))
-                    # self.binding_type = BindingType.TEXT_IMAGE
-                    # self.model = self.pipe.model
-                elif "gptq" in str(model_path).lower():
-                    self.tokenizer = AutoTokenizer.from_pretrained(str(model_path), padding_side="left")
-                    gptq_config = GPTQConfig(bits=4, tokenizer=self.tokenizer)
-                    self.model = AutoModelForCausalLM.from_pretrained(
-                        str(model_path), quantization_config=gptq_config, 
-                        device_map=self.binding_config.device_map,
-                        trust_remote_code=self.binding_config.trust_remote_code,
-                        low_cpu_mem_usage=self.binding_config.low_cpu_mem_usage,
-                    )
-                elif "awq" in str(model_path).lower():
-                    self.tokenizer = AutoTokenizer.from_pretrained(str(model_path), padding_side="left")
-                    awq_config = AwqConfig(bits=4, tokenizer=self.tokenizer)
-                    self.model = AutoModelForCausalLM.from_pretrained(
-                        str(model_path),
-                        quantization_config=awq_config, 
-                        device_map=self.binding_config.device_map,
-                        trust_remote_code=self.binding_config.trust_remote_code,
-                        low_cpu_mem_usage=self.binding_config.low_cpu_mem_usage,
-                    )
-                else:
-                    self.model = AutoModelForCausalLM.from_pretrained(
-                        str(model_path),
-                        device_map=self.binding_config.device_map,
-                        trust_remote_code=self.binding_config.trust_remote_code,
-                        low_cpu_mem_usage=self.binding_config.low_cpu_mem_usage,
-                        load_in_8bit = self.binding_config.load_quantized_8bit,
-                        load_in_4bit = self.binding_config.load_quantized_4bit if not self.binding_config.load_quantized_8bit else False,
-                        torch_dtype=torch.bfloat16  # Load in float16 for quantization
-                    )
-                                     
-                print(f"Model {model_name} built successfully.")
-                self.model_device = self.model.parameters().__next__().device
-                self.ShowBlockingMessage(f"Model loaded successfully")
-                self.HideBlockingMessage()
-                self.generation_config = GenerationConfig.from_pretrained(str(model_path))
-                """
+                self.destroy_model()
                 try:
-                    if not self.binding_config.automatic_context_size:
-                        self.model.seqlen = self.binding_config.ctx_size
-                    self.config.ctx_size = self.model.seqlen
-                except:
-                    self.model.seqlen = self.binding_config.ctx_size
-                    self.config.ctx_size = self.model.seqlen
-                ASCIIColors.info(f"Context lenghth set to {self.model.seqlen}")
-                
-                """
+                    entry = self.load_model(model_path, model_name, models_dir)
+                except Exception as ex:
+                    self.model_loader.set_failed(ex)
+                    raise ex
+                self.swap_model(entry)
+                self.model_loader.set_ready(self)
                 return self
             else:
                 self.InfoMessage(f"No model is selected\nPlease select a model from the Models zoo to start using Hugging face binding")
@@ -292,6 +645,395 @@ class HuggingFace(LLMBinding):
             self.HideBlockingMessage()
             self.InfoMessage(f"Couldn't load the model {model_path}\nHere is the error encountered during loading:\n"+str(ex)+"\nPlease choose another model or post a request on the discord channel.")
 
+    def load_model(self, model_path, model_name, models_dir):
+        """
+        Loads the tokenizer and the model without touching the model currently in use.
+
+        Returns:
+            dict: The loaded model entry, ready to be swapped in
+        """
+        load_start = time.perf_counter()
+        gen_cfg = model_path/"generation_config.json"
+        if not gen_cfg.exists():
+            with open(gen_cfg,"w") as f:
+                json.dump({
+                    "_from_model_config": True,
+                    "bos_token_id": 1,
+                    "eos_token_id": 32000,
+                    "transformers_version": "4.35.0.dev0"
+            }
+            ,f)
+                
+        import os
+        os.environ['HF_HOME'] = str(models_dir)
+        self.report_load_progress(f"Creating tokenizer {model_path}")
+        mn= Path(model_name)
+        ref_path = mn/(mn.stem+".reference")
+        if (ref_path).exists():
+            model_name = ref_path.read_text()
+            model_path = model_name
+        
+        tokenizer = AutoTokenizer.from_pretrained(
+                str(model_name), trust_remote_code=self.binding_config.trust_remote_code
+                )
+        image_processor = None
+        binding_type = BindingType.TEXT_ONLY
+
+        self.report_load_progress(f"Loading weights of {model_path}")
+        if "llava" in str(model_path).lower() or "vision" in str(model_path).lower():
+            model = LlavaForConditionalGeneration.from_pretrained(str(model_path),
+                                        device_map=self.binding_config.device_map,
+                                        offload_folder="offload",
+                                        offload_state_dict = True, 
+                                        trust_remote_code=self.binding_config.trust_remote_code,
+                                        low_cpu_mem_usage=self.binding_config.low_cpu_mem_usage,
+                                        load_in_8bit = self.binding_config.load_quantized_8bit,
+                                        load_in_4bit = self.binding_config.load_quantized_4bit if not self.binding_config.load_quantized_8bit else False,
+                                        torch_dtype=torch.bfloat16  # Load in float16 for quantization
+                                        )
+            image_processor = AutoProcessor.from_pretrained(str(model_path))
+            binding_type= BindingType.TEXT_IMAGE
+            # from transformers import pipeline
+            # self.pipe = pipeline("image-to-text", model=str(model_path))
+            # self.binding_type = BindingType.TEXT_IMAGE
+            # self.model = self.pipe.model
+        elif "gptq" in str(model_path).lower():
+            tokenizer = AutoTokenizer.from_pretrained(str(model_path), padding_side="left")
+            gptq_config = GPTQConfig(bits=4, tokenizer=tokenizer)
+            model = AutoModelForCausalLM.from_pretrained(
+                str(model_path), quantization_config=gptq_config, 
+                device_map=self.binding_config.device_map,
+                trust_remote_code=self.binding_config.trust_remote_code,
+                low_cpu_mem_usage=self.binding_config.low_cpu_mem_usage,
+            )
+        elif "awq" in str(model_path).lower():
+            tokenizer = AutoTokenizer.from_pretrained(str(model_path), padding_side="left")
+            awq_config = AwqConfig(bits=4, tokenizer=tokenizer)
+            model = AutoModelForCausalLM.from_pretrained(
+                str(model_path),
+                quantization_config=awq_config, 
+                device_map=self.binding_config.device_map,
+                trust_remote_code=self.binding_config.trust_remote_code,
+                low_cpu_mem_usage=self.binding_config.low_cpu_mem_usage,
+            )
+        elif self.binding_config.backend!="pytorch":
+            model = self.load_exported_model(model_path, models_dir)
+        else:
+            model = AutoModelForCausalLM.from_pretrained(
+                str(model_path),
+                device_map=self.binding_config.device_map,
+                trust_remote_code=self.binding_config.trust_remote_code,
+                low_cpu_mem_usage=self.binding_config.low_cpu_mem_usage,
+                load_in_8bit = self.binding_config.load_quantized_8bit,
+                load_in_4bit = self.binding_config.load_quantized_4bit if not self.binding_config.load_quantized_8bit else False,
+                torch_dtype=torch.bfloat16  # Load in float16 for quantization
+            )
+                             
+        print(f"Model {model_name} built successfully in {time.perf_counter()-load_start:.2f}s.")
+        # The onnxruntime and openvino models are not torch modules
+        backend = "pytorch" if isinstance(model, torch.nn.Module) else self.binding_config.backend
+        model_device = model.parameters().__next__().device if backend=="pytorch" else model.device
+        generation_config = GenerationConfig.from_pretrained(str(model_path))
+        draft_model, draft_tokenizer = None, None
+        if self.binding_config.speculative_mode=="draft_model" and backend=="pytorch":
+            draft_model, draft_tokenizer = self.load_draft_model(model_path, model, tokenizer)
+        compiled_forward = None
+        compile_buckets = []
+        if self.binding_config.execution_mode=="compiled" and backend=="pytorch":
+            compiled_forward, compile_buckets = self.compile_model(model, tokenizer, generation_config)
+        if self.binding_config.warmup:
+            self.report_load_progress("Warming up")
+            warmup_start = time.perf_counter()
+            with torch.no_grad():
+                input_ids = tokenizer("question: What is 1+1\nanswer:", return_tensors='pt').input_ids.to(model_device)
+                model.generate(inputs=input_ids, max_new_tokens=2, do_sample=False, pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id)
+            ASCIIColors.info(f"Warmup generation took {time.perf_counter()-warmup_start:.2f}s")
+        """
+        try:
+            if not self.binding_config.automatic_context_size:
+                self.model.seqlen = self.binding_config.ctx_size
+            self.config.ctx_size = self.model.seqlen
+        except:
+            self.model.seqlen = self.binding_config.ctx_size
+            self.config.ctx_size = self.model.seqlen
+        ASCIIColors.info(f"Context lenghth set to {self.model.seqlen}")
+        
+        """
+        return {
+            "tokenizer":tokenizer,
+            "model":model,
+            "image_rocessor":image_processor,
+            "binding_type":binding_type,
+            "model_device":model_device,
+            "generation_config":generation_config,
+            "compiled_forward":compiled_forward,
+            "compile_buckets":compile_buckets,
+            "draft_model":draft_model,
+            "draft_tokenizer":draft_tokenizer,
+            "backend":backend
+        }
+
+    def exported_model_path(self, model_path, models_dir):
+        """Returns the folder of the int8 export of the model for the selected backend"""
+        return Path(models_dir)/"exports"/f"{Path(model_path).name}-{self.binding_config.backend}-int8"
+
+    def load_exported_model(self, model_path, models_dir):
+        """
+        Loads the int8 onnxruntime or openvino export of the model. The model is exported the first time, and
+        exported again when its files are more recent than the export.
+        """
+        export_path = self.exported_model_path(model_path, models_dir)
+        source_time = max((f.stat().st_mtime for f in Path(model_path).iterdir() if f.is_file()), default=0) if Path(model_path).is_dir() else 0
+        info_path = export_path/"export_info.json"
+        if info_path.exists() and json.loads(info_path.read_text()).get("source_time",0)>=source_time:
+            ASCIIColors.info(f"Using the {self.binding_config.backend} export {export_path}")
+        else:
+            self.export_model(model_path, export_path, source_time)
+        self.report_load_progress(f"Loading the {self.binding_config.backend} int8 model {export_path.name}")
+        if self.binding_config.backend=="openvino":
+            from optimum.intel import OVModelForCausalLM
+            return OVModelForCausalLM.from_pretrained(str(export_path), trust_remote_code=self.binding_config.trust_remote_code)
+        from optimum.onnxruntime import ORTModelForCausalLM
+        return ORTModelForCausalLM.from_pretrained(str(export_path), file_name="model_quantized.onnx", trust_remote_code=self.binding_config.trust_remote_code)
+
+    def export_model(self, model_path, export_path:Path, source_time:float):
+        """
+        Exports the model for the selected backend with int8 weights. The export is built in a temporary
+        folder so that an interrupted export is never used.
+        """
+        backend = self.binding_config.backend
+        self.report_load_progress(f"Exporting {Path(model_path).name} to {backend} with int8 weights.\nThis is only done the first time the model is used and may take a while")
+        export_start = time.perf_counter()
+        tmp_path = export_path.with_name(export_path.name+".tmp")
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+        if backend=="openvino":
+            if not pm.is_installed("optimum-intel"):
+                pm.install("optimum-intel[openvino]")
+            from optimum.intel import OVModelForCausalLM, OVWeightQuantizationConfig
+            model = OVModelForCausalLM.from_pretrained(
+                str(model_path),
+                export=True,
+                compile=False,
+                quantization_config=OVWeightQuantizationConfig(bits=8),
+                trust_remote_code=self.binding_config.trust_remote_code
+            )
+            model.save_pretrained(str(tmp_path))
+            del model
+        else:
+            if not pm.is_installed("optimum-onnx"):
+                pm.install("optimum-onnx[onnxruntime]")
+            from optimum.onnxruntime import ORTModelForCausalLM, ORTQuantizer
+            float_path = tmp_path/"float"
+            model = ORTModelForCausalLM.from_pretrained(
+                str(model_path),
+                export=True,
+                use_cache=True,
+                trust_remote_code=self.binding_config.trust_remote_code
+            )
+            model.save_pretrained(str(float_path))
+            del model
+            gc.collect()
+            self.report_load_progress(f"Quantizing the weights of {Path(model_path).name} to int8")
+            quantizer = ORTQuantizer.from_pretrained(str(float_path), file_name="model.onnx")
+            quantizer.quantize(
+                quantization_config=onnx_quantization_config(),
+                save_dir=str(tmp_path),
+                # Models larger than 2GB keep their weights outside of the onnx file
+                use_external_data_format=(float_path/"model.onnx_data").exists()
+            )
+            for file in float_path.iterdir():
+                if file.suffix==".json" and not (tmp_path/file.name).exists():
+                    shutil.copy(file, tmp_path/file.name)
+            shutil.rmtree(float_path)
+        gc.collect()
+        export_time = time.perf_counter()-export_start
+        with open(tmp_path/"export_info.json","w") as f:
+            json.dump({"source":str(model_path), "source_time":source_time, "backend":backend, "weights":"int8", "export_time":export_time}, f)
+        if export_path.exists():
+            shutil.rmtree(export_path)
+        tmp_path.rename(export_path)
+        ASCIIColors.success(f"Model exported to {export_path} in {export_time:.2f}s")
+
+    def load_draft_model(self, model_path, model, tokenizer):
+        """
+        Loads the draft model of the assisted generation from the hugging face models folder.
+
+        Returns:
+            tuple: The draft model and its tokenizer when its vocabulary differs from the one of the main model (None, None if it can't be used)
+        """
+        draft_path = self.searchModelPath(self.binding_config.draft_model_name) if self.binding_config.draft_model_name!="" else None
+        if draft_path is None:
+            self.InfoMessage(f"Draft model {self.binding_config.draft_model_name} was not found in the hugging face models folder.\nAssisted generation is deactivated")
+            return None, None
+        if Path(draft_path)==Path(model_path):
+            self.warning("The draft model is the main model. Assisted generation is deactivated")
+            return None, None
+        self.report_load_progress(f"Loading draft model {Path(draft_path).name}")
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            str(draft_path),
+            device_map=self.binding_config.device_map,
+            trust_remote_code=self.binding_config.trust_remote_code,
+            low_cpu_mem_usage=self.binding_config.low_cpu_mem_usage,
+            torch_dtype=model.dtype
+        )
+        draft_tokenizer = AutoTokenizer.from_pretrained(str(draft_path), trust_remote_code=self.binding_config.trust_remote_code)
+        if draft_tokenizer.get_vocab()==tokenizer.get_vocab():
+            return draft_model, None
+        # The drafted tokens are translated through the text, which costs some of the speedup
+        self.warning("The draft model doesn't share the vocabulary of the main model, the drafted tokens are converted")
+        return draft_model, draft_tokenizer
+
+    def assisted_generation_params(self):
+        """Returns the generate parameters of the assisted generation, and sets its generation config fields"""
+        mode = self.binding_config.speculative_mode if self.backend=="pytorch" else "off"
+        self.generation_config.prompt_lookup_num_tokens = self.binding_config.num_draft_tokens if mode=="prompt_lookup" else None
+        if mode!="draft_model" or self.draft_model is None:
+            return {}
+        self.generation_config.num_assistant_tokens = self.binding_config.num_draft_tokens
+        if self.draft_tokenizer is None:
+            return {"assistant_model":self.draft_model}
+        return {"assistant_model":self.draft_model, "tokenizer":self.tokenizer, "assistant_tokenizer":self.draft_tokenizer}
+
+    def compile_model(self, model, tokenizer, generation_config):
+        """
+        Compiles the forward pass of the model and runs it once for each prompt length bucket, so that the
+        graphs of the prompt evaluation and of the decode step are ready before the first request.
+
+        Returns:
+            tuple: The compiled forward (None if the compilation failed) and the prompt length buckets
+        """
+        buckets = sorted(set(int(b) for b in self.binding_config.compile_buckets.split(",") if b.strip()!="" and 0<int(b)<self.config.ctx_size))
+        if not buckets:
+            buckets = [min(128, self.config.ctx_size//2)]
+        model_device = model.parameters().__next__().device
+        self.report_load_progress(f"Compiling the model for prompts of {', '.join(str(b) for b in buckets)} tokens")
+        compile_start = time.perf_counter()
+        compiled_forward = torch.compile(model.forward, mode="reduce-overhead" if model_device.type=="cuda" else "default", dynamic=False)
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        warmup_config = copy.deepcopy(generation_config)
+        warmup_config.update(do_sample=False, pad_token_id=pad_token_id)
+        try:
+            for bucket in buckets:
+                bucket_start = time.perf_counter()
+                input_ids = torch.full((1, bucket), pad_token_id, dtype=torch.long, device=model_device)
+                # Two tokens compile both the prompt evaluation and the decode step
+                self.generate_static(model, compiled_forward, input_ids, bucket, 2, warmup_config)
+                ASCIIColors.info(f"Prompt bucket {bucket} compiled in {time.perf_counter()-bucket_start:.2f}s")
+        except Exception as ex:
+            trace_exception(ex)
+            self.warning(f"Couldn't compile the model, using the eager mode:\n{ex}")
+            return None, []
+        ASCIIColors.success(f"Model compiled in {time.perf_counter()-compile_start:.2f}s")
+        return compiled_forward, buckets
+
+    @contextmanager
+    def installed_forward(self, model, forward):
+        """Replaces the forward of the model while generating, the other generation paths keep the eager forward"""
+        had_forward = "forward" in model.__dict__
+        eager_forward = model.forward
+        model.forward = forward
+        try:
+            yield
+        finally:
+            if had_forward:
+                model.forward = eager_forward
+            else:
+                del model.forward
+
+    def generate_static(self, model, compiled_forward, input_ids, prompt_length:int, n_predict:int, generation_config, streamer=None):
+        """
+        Left pads the prompt to prompt_length and generates with the compiled forward and a static cache of
+        ctx_size tokens, so that all the requests share the same compiled graphs.
+        """
+        generation_config = copy.deepcopy(generation_config)
+        # The assisted generation needs a dynamic cache
+        generation_config.update(cache_implementation="static", max_length=self.config.ctx_size, max_new_tokens=None, prompt_lookup_num_tokens=None)
+        padding = prompt_length-input_ids.shape[1]
+        attention_mask = torch.ones_like(input_ids)
+        if padding>0:
+            pad_token_id = generation_config.pad_token_id if generation_config.pad_token_id is not None else generation_config.eos_token_id
+            if isinstance(pad_token_id, list):
+                pad_token_id = pad_token_id[0]
+            input_ids = torch.cat([input_ids.new_full((input_ids.shape[0], padding), pad_token_id), input_ids], dim=1)
+            attention_mask = torch.cat([attention_mask.new_zeros((attention_mask.shape[0], padding)), attention_mask], dim=1)
+        with self.installed_forward(model, compiled_forward), torch.no_grad():
+            return model.generate(
+                                    inputs=input_ids,
+                                    attention_mask=attention_mask,
+                                    generation_config=generation_config,
+                                    stopping_criteria=StoppingCriteriaList([MaxNewTokensStoppingCriteria(prompt_length, n_predict)]),
+                                    streamer=streamer
+                                )
+
+    def generate_with_prefix_cache(self, input_ids):
+        """
+        Starts the generation from the KV cache of the longest kept prefix of the prompt, then keeps the KV
+        cache of the prompt and of the generated text for the next message of the discussion.
+        """
+        prompt_tokens = input_ids[0].tolist()
+        past_key_values, n_cached, cached_key = self.prefix_cache.lookup(prompt_tokens)
+        generation_config = copy.deepcopy(self.generation_config)
+        generation_config.update(return_dict_in_generate=True)
+        output = self.model.generate(
+                                    inputs=input_ids,
+                                    attention_mask=torch.ones_like(input_ids),
+                                    past_key_values=past_key_values,
+                                    generation_config=generation_config,
+                                    streamer = self,
+                                    )
+        if n_cached>0:
+            ASCIIColors.info(f"Reused the KV cache of {n_cached}/{len(prompt_tokens)} prompt tokens")
+        self.prefix_cache.add(output.sequences[0].tolist(), output.past_key_values, len(prompt_tokens), cached_key, n_cached)
+        ASCIIColors.info(self.prefix_cache.summary())
+
+    def prompt_bucket(self, length:int):
+        """Returns the compiled prompt length to pad a prompt to"""
+        for bucket in self.compile_buckets:
+            if length<=bucket:
+                return bucket
+        # Longer prompts are padded to a multiple of the largest bucket to limit the number of new graphs
+        largest = self.compile_buckets[-1]
+        return -(-length//largest)*largest
+
+    def swap_model(self, entry:dict):
+        """
+        Installs a loaded model entry as the current model.
+        The swap waits for the running generation to finish.
+        """
+        with self.model_lock:
+            old_model = self.model
+            self.tokenizer = entry["tokenizer"]
+            self.model = entry["model"]
+            if entry["image_rocessor"] is not None:
+                self.image_rocessor = entry["image_rocessor"]
+            self.binding_type = entry["binding_type"]
+            self.model_device = entry["model_device"]
+            self.generation_config = entry["generation_config"]
+            self.compiled_forward = entry["compiled_forward"]
+            self.compile_buckets = entry["compile_buckets"]
+            self.draft_model = entry["draft_model"]
+            self.draft_tokenizer = entry["draft_tokenizer"]
+            self.backend = entry["backend"]
+            # The kept KV caches belong to the previous model
+            self.prefix_cache = PrefixKVCache(self.binding_config.prefix_cache_budget) if self.binding_config.prefix_cache_budget>0 and self.compiled_forward is None and self.backend=="pytorch" else None
+        del old_model
+        gc.collect()
+        self.report_load_progress(f"Model loaded successfully")
+        self.HideBlockingMessage()
+
+    def wait_for_model(self, timeout:float=None):
+        """Waits for a model being loaded in the background when there is no model to serve the request"""
+        if self.model is None:
+            self.model_loader.wait(timeout)
+
+    def report_load_progress(self, text:str):
+        if self.binding_config.background_loading:
+            ASCIIColors.info(text)
+            self.notify(text, NotificationType.NOTIF_INFO)
+        else:
+            self.ShowBlockingMessage(text)
+
 
     @staticmethod
     def get_device():
@@ -415,6 +1157,17 @@ class HuggingFace(LLMBinding):
                 {"name":"ctx_size","type":"int","value":4090, "min":512, "help":"The current context size (it depends on the model you are using). Make sure the context size if correct or you may encounter bad outputs."},
                 {"name":"max_n_predict","type":"int","value":4090, "min":512, "help":"The maximum amount of tokens to generate"},
                 {"name":"seed","type":"int","value":-1,"help":"Random numbers generation seed allows you to fix the generation making it dterministic. This is useful for repeatability. To make the generation random, please set seed to -1."},
+                {"name":"background_loading","type":"bool","value":False, "help":"Load new models in the background. The current model keeps answering until the new one is ready"},
+                {"name":"warmup","type":"bool","value":False, "help":"Run a short test generation after loading a model"},
+                {"name":"batch_max_sequences","type":"int","value":8, "min":1, "help":"Maximum number of prompts generated together by generate_batch, or of requests generated together when continuous_batching is on"},
+                {"name":"speculative_mode","type":"str","value":"off", "options":["off","prompt_lookup","draft_model"], "help":"Assisted generation proposes several tokens at once that the model verifies in a single pass.\nprompt_lookup drafts tokens by looking up the last generated words in the prompt (good for code edition and rewriting).\ndraft_model uses a small model of the hugging face models folder sharing the vocabulary of the main model (a model with another vocabulary is slower). Not used in compiled mode or with continuous batching, and the prefix cache is not used when it is on"},
+                {"name":"draft_model_name","type":"str","value":"", "help":"Name of the small model (from the hugging face models folder) to use as draft model when speculative_mode is draft_model"},
+                {"name":"num_draft_tokens","type":"int","value":10, "min":1, "help":"Number of tokens drafted at each assisted generation step"},
+                {"name":"prefix_cache_budget","type":"int","value":0, "min":0, "help":"Memory in bytes kept for the KV cache of the last generations, on the device of the model (gpu memory for models on gpu). A prompt that starts like a previous one (same system prompt and previous messages) only evaluates its new tokens. 0 (default) deactivates the prefix cache (it is not used in compiled mode)"},
+                {"name":"execution_mode","type":"str","value":"eager", "options":["eager","compiled"], "help":"compiled preallocates a KV cache of ctx_size tokens and compiles the forward pass of the model with torch.compile when it is loaded. This removes most of the python overhead of each generated token (useful for small models on cpu) at the cost of a longer loading"},
+                {"name":"compile_buckets","type":"str","value":"32,128,512,2048", "help":"Comma separated prompt lengths compiled when the model is loaded in compiled mode. The prompts are padded to the next bucket so that they reuse a compiled graph"},
+                {"name":"backend","type":"str","value":"pytorch", "options":["pytorch","onnxruntime","openvino"], "help":"Inference backend of the model. onnxruntime and openvino export the model with int8 weights the first time it is loaded (this takes a while and needs enough memory to load the model in float32), then reuse the export kept in the exports folder of the hugging face models folder. They run faster and use less memory than pytorch on cpu. llava, gptq and awq models always use pytorch. Compiled mode, assisted generation, continuous batching and the prefix cache are not used with these backends"},
+                {"name":"continuous_batching","type":"bool","value":False, "help":"Serve the requests of concurrent users with a single decode loop instead of one after the other. New requests join the running generations between two tokens"},
 
             ])
             binding_config_vals = BaseConfig.from_template(binding_config_template)
@@ -452,6 +1205,7 @@ class HuggingFace(LLMBinding):
         Returns:
             list: A list of tokens representing the tokenized prompt.
         """
+        self.wait_for_model()
         return self.tokenizer.encode(prompt,add_special_tokens=False)
 
     def detokenize(self, tokens_list:list):
@@ -464,6 +1218,7 @@ class HuggingFace(LLMBinding):
         Returns:
             str: The detokenized text as a string.
         """
+        self.wait_for_model()
         return  self.tokenizer.decode(tokens_list)
     
 
@@ -481,26 +1236,13 @@ class HuggingFace(LLMBinding):
 
         if self.skip_prompt and self.next_tokens_are_prompt:
             self.next_tokens_are_prompt = False
+            # The end of the prompt gives their leading spaces to the first generated tokens
+            self.detokenizer.set_prompt(value.tolist())
             return
 
-        # Add the new token to the cache and decodes the entire thing.
-        self.token_cache.extend(value.tolist())
-        text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
-
-        # After the symbol for a new line, we flush the cache.
-        if text.endswith("\n"):
-            printable_text = text[self.print_len :]
-            self.token_cache = []
-            self.print_len = 0
-        # If the last token is a CJK character, we print the characters.
-        elif len(text) > 0 and self._is_chinese_char(ord(text[-1])):
-            printable_text = text[self.print_len :]
-            self.print_len += len(printable_text)
-        # Otherwise, prints until the last space char (simple heuristic to avoid printing incomplete words,
-        # which may change with the subsequent token -- there are probably smarter ways to do this!)
-        else:
-            printable_text = text[self.print_len : text.rfind(" ") + 1]
-            self.print_len += len(printable_text)
+        # Only the last tokens are decoded, the cost of a token doesn't grow with the length of the line
+        self.n_generated += len(value)
+        printable_text = self.detokenizer.add(value.tolist())
 
         self.output += printable_text
         if  self.callback:
@@ -533,13 +1275,8 @@ class HuggingFace(LLMBinding):
     def end(self):
         """Flushes any remaining cache and prints a newline to stdout."""
         # Flush the cache, if it exists
-        if len(self.token_cache) > 0:
-            text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
-            printable_text = text[self.print_len :]
-            self.token_cache = []
-            self.print_len = 0
-        else:
-            printable_text = ""
+        printable_text = self.detokenizer.flush()
+        self.output += printable_text
 
         self.next_tokens_are_prompt = True
         if  self.callback:
@@ -589,6 +1326,7 @@ class HuggingFace(LLMBinding):
     
 
 
+    @with_model_lock
     def generate_with_images(self, 
                 prompt:str,
                 images:list=[],
@@ -626,8 +1364,7 @@ class HuggingFace(LLMBinding):
         self.generation_config.output_attentions = False
         self.callback = callback    
         try:
-            self.token_cache = []
-            self.print_len = 0
+            self.detokenizer = IncrementalDetokenizer(self.tokenizer, self.decode_kwargs)
             self.next_tokens_are_prompt = True            
             self.n_generated = 0
             self.output = ""
@@ -653,6 +1390,13 @@ class HuggingFace(LLMBinding):
             trace_exception(ex)
         return self.output
 
+    def get_scheduler(self):
+        if self.scheduler is None or self.scheduler.max_sequences!=self.binding_config.batch_max_sequences:
+            if self.scheduler is not None:
+                self.scheduler.stop()
+            self.scheduler = ContinuousBatchScheduler(self, self.binding_config.batch_max_sequences)
+        return self.scheduler
+
     def generate(self, 
                  prompt:str,                  
                  n_predict: int = 128,
@@ -667,6 +1411,25 @@ class HuggingFace(LLMBinding):
             callback (Callable[[str], None], optional): A callback function that is called everytime a new text element is generated. Defaults to None.
             verbose (bool, optional): If true, the code will spit many informations about the generation process. Defaults to False.
         """
+        if self.binding_config.continuous_batching and self.backend=="pytorch":
+            # The request joins the decode loop shared by the concurrent requests
+            self.wait_for_model()
+            try:
+                return self.get_scheduler().submit(prompt, n_predict, callback, gpt_params).result()
+            except Exception as ex:
+                ASCIIColors.error("Couldn't generate")
+                trace_exception(ex)
+                return ""
+        return self.generate_sequential(prompt, n_predict, callback, verbose, **gpt_params)
+
+    @with_model_lock
+    def generate_sequential(self, 
+                 prompt:str,                  
+                 n_predict: int = 128,
+                 callback: Callable[[str], None] = None,
+                 verbose: bool = False,
+                 **gpt_params ):
+        """Generates text out of a prompt, one request at a time"""
         default_params = {
             'temperature': self.generation_config.temperature,
             'top_k': self.generation_config.top_k,
@@ -689,8 +1452,7 @@ class HuggingFace(LLMBinding):
         self.generation_config.output_attentions = False
         self.callback = callback    
         try:
-            self.token_cache = []
-            self.print_len = 0
+            self.detokenizer = IncrementalDetokenizer(self.tokenizer, self.decode_kwargs)
             self.next_tokens_are_prompt = True            
             self.n_generated = 0
             self.output = ""
@@ -698,11 +1460,37 @@ class HuggingFace(LLMBinding):
             self.n_prompt = len(input_ids[0])
             try:
                 print(f"Generating text on device: {self.model.device}")
-                self.model.generate(
+                prompt_length = self.prompt_bucket(self.n_prompt) if self.compiled_forward is not None else 0
+                if self.compiled_forward is not None and prompt_length+int(n_predict)<=self.config.ctx_size:
+                    self.generate_static(
+                                    self.model,
+                                    self.compiled_forward,
+                                    input_ids,
+                                    prompt_length,
+                                    int(n_predict),
+                                    self.generation_config,
+                                    streamer = self,
+                                    )
+                else:
+                    assisted_params = self.assisted_generation_params()
+                    monitor = None
+                    if self.generation_config.prompt_lookup_num_tokens is not None or assisted_params:
+                        monitor = AssistedGenerationMonitor(self.model, self.n_prompt)
+                    try:
+                        # The assisted generation evaluates the whole prompt again, it can't start from a kept KV cache
+                        if self.prefix_cache is not None and monitor is None:
+                            self.generate_with_prefix_cache(input_ids)
+                        else:
+                            self.model.generate(
                                     inputs=input_ids, 
                                     generation_config=self.generation_config,
                                     streamer = self,
+                                    **assisted_params
                                     )
+                    finally:
+                        if monitor is not None:
+                            monitor.close()
+                            ASCIIColors.info(monitor.summary(self.n_generated))
             except Exception as ex:
                 if str(ex)!="canceled":
                     trace_exception(ex)
@@ -712,6 +1500,212 @@ class HuggingFace(LLMBinding):
             trace_exception(ex)
         return self.output
 
+    def eos_token_ids(self):
+        eos_token_ids = self.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = []
+        elif isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+        if self.tokenizer.eos_token_id is not None and self.tokenizer.eos_token_id not in eos_token_ids:
+            eos_token_ids = list(eos_token_ids)+[self.tokenizer.eos_token_id]
+        return set(eos_token_ids)
+
+    def build_logits_warpers(self, gpt_params:dict):
+        """Builds the logits processors applying the sampling parameters of generate to a batch"""
+        from transformers import LogitsProcessorList, RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+        logits_processors = LogitsProcessorList()
+        if float(gpt_params["repeat_penalty"])!=1.0:
+            logits_processors.append(RepetitionPenaltyLogitsProcessor(float(gpt_params["repeat_penalty"])))
+        if float(gpt_params["temperature"])>0:
+            logits_processors.append(TemperatureLogitsWarper(float(gpt_params["temperature"])))
+            if int(gpt_params["top_k"])>0:
+                logits_processors.append(TopKLogitsWarper(int(gpt_params["top_k"])))
+            if float(gpt_params["top_p"])<1.0:
+                logits_processors.append(TopPLogitsWarper(float(gpt_params["top_p"])))
+        return logits_processors
+
+    @staticmethod
+    def sample_next_tokens(logits_processors, sequences, logits, do_sample:bool, generator=None):
+        """Picks the next token of each row of the batch"""
+        scores = logits_processors(sequences, logits.float())
+        if do_sample:
+            return torch.multinomial(torch.softmax(scores, dim=-1), 1, generator=generator).squeeze(1)
+        return scores.argmax(dim=-1)
+
+    @staticmethod
+    def select_cache_rows(past_key_values, index):
+        """Keeps only the rows of the KV cache listed in index"""
+        if hasattr(past_key_values, "batch_select_indices"):
+            past_key_values.batch_select_indices(index)
+            return past_key_values
+        return tuple(tuple(tensor.index_select(0, index) for tensor in layer) for layer in past_key_values)
+
+    def build_sampler(self, gpt_params:dict):
+        """
+        Returns the logits processors, the sampling flag and the random generator applying the sampling
+        parameters of a batched generation
+        """
+        default_params = {
+            'temperature': self.generation_config.temperature,
+            'top_k': self.generation_config.top_k,
+            'top_p': self.generation_config.top_p,
+            'repeat_penalty': self.generation_config.repetition_penalty,
+            "seed":-1,
+        }
+        gpt_params = {**default_params, **gpt_params}
+        generator = None
+        if int(gpt_params["seed"])!=-1:
+            generator = torch.Generator(device=self.model_device).manual_seed(int(gpt_params["seed"]))
+        return self.build_logits_warpers(gpt_params), float(gpt_params["temperature"])>0, generator
+
+    def pad_prompts(self, prompts_tokens:list):
+        """
+        Left pads the prompts so that their last tokens are aligned. The padding repeats the first token of
+        each prompt so that the repetition penalty doesn't penalize the pad token.
+
+        Returns:
+            tuple: The input ids, the attention mask and the position ids, on the model device
+        """
+        prompt_length = max(len(tokens) for tokens in prompts_tokens)
+        input_ids = torch.zeros((len(prompts_tokens), prompt_length), dtype=torch.long)
+        attention_mask = torch.zeros((len(prompts_tokens), prompt_length), dtype=torch.long)
+        for i, tokens in enumerate(prompts_tokens):
+            padding = prompt_length-len(tokens)
+            input_ids[i, padding:] = torch.tensor(tokens, dtype=torch.long)
+            input_ids[i, :padding] = tokens[0]
+            attention_mask[i, padding:] = 1
+        input_ids = input_ids.to(self.model_device)
+        attention_mask = attention_mask.to(self.model_device)
+        position_ids = (attention_mask.cumsum(-1)-1).clamp(min=0)
+        return input_ids, attention_mask, position_ids
+
+    def position_params(self, position_ids):
+        """The padded rows need their position ids, for the models that accept them"""
+        if "position_ids" in inspect.signature(self.model.forward).parameters:
+            return {"position_ids":position_ids}
+        return {}
+
+    def start_stream(self, prompt_tokens:list):
+        """Returns the detokenizer of a sequence of the batch"""
+        detokenizer = IncrementalDetokenizer(self.tokenizer, self.decode_kwargs)
+        detokenizer.set_prompt(prompt_tokens)
+        return detokenizer
+
+    def stream_token(self, token:int, detokenizer, callback, eos_token_ids:set):
+        """
+        Detokenizes a token generated for a sequence of the batch and sends its text to the callback of the sequence.
+
+        Returns:
+            tuple: The text and True if the sequence is finished (end of sequence token or stopped by the callback)
+        """
+        if token in eos_token_ids:
+            return "", True
+        text = detokenizer.add([token])
+        return text, bool(text) and callback is not None and not callback(text, MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK)
+
+    def end_stream(self, detokenizer, callback):
+        """Sends the text held back by the detokenizer of a finished sequence to its callback and returns it"""
+        text = detokenizer.flush()
+        if text and callback is not None:
+            callback(text, MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK)
+        return text
+
+    def decode_rows(self, rows:list, prompts_tokens:list, n_predict:int, callbacks:list, outputs:list, logits_processors, do_sample:bool, generator, eos_token_ids:set):
+        """
+        Generates the prompts listed in rows together. The prompts are left padded so that their last tokens
+        are aligned, and the finished rows are removed from the batch and from the KV cache so that the other
+        rows don't keep computing them.
+
+        Returns:
+            int: The number of generated tokens
+        """
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else next(iter(eos_token_ids), 0)
+        rows_tokens = [prompts_tokens[row] or [pad_token_id] for row in rows]
+        sequences, attention_mask, position_ids = self.pad_prompts(rows_tokens)
+        detokenizers = [self.start_stream(tokens) for tokens in rows_tokens]
+        model_inputs = sequences
+        past_key_values = None
+        active = list(rows)
+        n_generated = 0
+
+        def finish(i):
+            outputs[active[i]] += self.end_stream(detokenizers[i], callbacks[active[i]])
+
+        with torch.no_grad():
+            for step in range(n_predict):
+                out = self.model(input_ids=model_inputs, attention_mask=attention_mask, past_key_values=past_key_values, use_cache=True, **self.position_params(position_ids))
+                past_key_values = out.past_key_values
+                next_tokens = self.sample_next_tokens(logits_processors, sequences, out.logits[:, -1, :], do_sample, generator)
+                sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+                keep = []
+                for i, token in enumerate(next_tokens.tolist()):
+                    text, finished = self.stream_token(token, detokenizers[i], callbacks[active[i]], eos_token_ids)
+                    outputs[active[i]] += text
+                    if token not in eos_token_ids:
+                        n_generated += 1
+                    if finished:
+                        finish(i)
+                    else:
+                        keep.append(i)
+                if len(keep)==0:
+                    return n_generated
+                if len(keep)<len(active):
+                    index = torch.tensor(keep, device=sequences.device)
+                    sequences = sequences.index_select(0, index)
+                    attention_mask = attention_mask.index_select(0, index)
+                    position_ids = position_ids.index_select(0, index)
+                    next_tokens = next_tokens.index_select(0, index)
+                    past_key_values = self.select_cache_rows(past_key_values, index)
+                    active = [active[i] for i in keep]
+                    detokenizers = [detokenizers[i] for i in keep]
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(active), 1))], dim=-1)
+                position_ids = position_ids[:, -1:]+1
+                model_inputs = next_tokens[:, None]
+        for i in range(len(active)):
+            finish(i)
+        return n_generated
+
+    @with_model_lock
+    def generate_batch(self,
+                 prompts:list,
+                 n_predict: int = 128,
+                 callbacks: list = None,
+                 verbose: bool = False,
+                 **gpt_params ):
+        """Generates text out of several independent prompts decoded together
+
+        Up to batch_max_sequences prompts share each forward pass of the model. A prompt that is finished
+        is removed from the batch right away.
+
+        Args:
+            prompts (list): The prompts to use for generation
+            n_predict (int, optional): Number of tokens to predict for each prompt. Defaults to 128.
+            callbacks (list, optional): One callback (or None) per prompt, called every time a new text element is generated for that prompt. Returning False stops that prompt only. Defaults to None.
+            verbose (bool, optional): If true, the code will spit many informations about the generation process. Defaults to False.
+
+        Returns:
+            list: The generated texts, in the order of the prompts
+        """
+        if callbacks is None:
+            callbacks = [None]*len(prompts)
+        logits_processors, do_sample, generator = self.build_sampler(gpt_params)
+        eos_token_ids = self.eos_token_ids()
+        prompts_tokens = [self.tokenizer.encode(prompt, add_special_tokens=False) for prompt in prompts]
+        outputs = [""]*len(prompts)
+        max_sequences = self.binding_config.batch_max_sequences
+        start_time = time.perf_counter()
+        n_generated = 0
+        for start in range(0, len(prompts), max_sequences):
+            rows = list(range(start, min(start+max_sequences, len(prompts))))
+            try:
+                n_generated += self.decode_rows(rows, prompts_tokens, n_predict, callbacks, outputs, logits_processors, do_sample, generator, eos_token_ids)
+            except Exception as ex:
+                ASCIIColors.error("Couldn't generate")
+                trace_exception(ex)
+        duration = time.perf_counter()-start_time
+        ASCIIColors.info(f"Batch of {len(prompts)} prompts: {n_generated} tokens generated in {duration:.2f}s ({n_generated/max(duration, 1e-6):.1f} tokens/s)")
+        return outputs
+
 
     def install_model(self, model_type:str, model_path:str, variant_name:str, client_id:int=None):
         print("Install model triggered")
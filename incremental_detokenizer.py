@@ -0,0 +1,55 @@
+######
+# Project       : lollms
+# File          : incremental_detokenizer.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   : 
+# Streaming detokenizer shared by the bindings that generate with transformers tokenizers
+# (hugging_face, TGI, bs_petals). The bindings load it from the bindings zoo folder.
+######
+
+
+class IncrementalDetokenizer:
+    """
+    Turns the generated tokens into text while decoding only the last few tokens at each step.
+    The text of a token depends on the tokens before it (leading spaces, merges, characters split over
+    several byte tokens), so the new tokens are decoded together with the tokens of the previous step
+    (the prefix) and only the text that comes after the prefix is emitted. Text that ends with an
+    incomplete utf-8 character is held back until the next tokens complete it.
+    """
+    # Tokens of the end of the prompt used as prefix for the first generated tokens
+    prompt_context = 5
+
+    def __init__(self, tokenizer, decode_kwargs:dict=None):
+        self.tokenizer = tokenizer
+        self.decode_kwargs = decode_kwargs or {}
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def set_prompt(self, prompt_tokens:list):
+        self.tokens = list(prompt_tokens[-self.prompt_context:])
+        self.prefix_offset = 0
+        self.read_offset = len(self.tokens)
+
+    def add(self, new_tokens:list):
+        """Adds the generated tokens and returns the text that became final"""
+        self.tokens.extend(new_tokens)
+        prefix_text = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset], **self.decode_kwargs)
+        new_text = self.tokenizer.decode(self.tokens[self.prefix_offset:], **self.decode_kwargs)
+        if len(new_text)<=len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        # The tokens before the prefix are never decoded again
+        del self.tokens[:self.prefix_offset]
+        self.prefix_offset = self.read_offset-self.prefix_offset
+        self.read_offset = len(self.tokens)
+        return new_text[len(prefix_text):]
+
+    def flush(self):
+        """Returns the text held back, even if it ends with an incomplete character"""
+        prefix_text = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset], **self.decode_kwargs)
+        new_text = self.tokenizer.decode(self.tokens[self.prefix_offset:], **self.decode_kwargs)
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        return new_text[len(prefix_text):]
@@ -25,9 +25,17 @@ import subprocess
 import yaml
 import os
 import sys
+import importlib.util
 import shutil
 import platform
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import nullcontext
+import threading
+import json
+import time
+import hashlib
 import gc
 
 __author__ = "parisneo"
@@ -37,15 +45,44 @@ __license__ = "Apache 2.0"
 
 binding_name = "LLAMA_Python_CPP"
 
+# The background model loader is shared by the bindings of the zoo that can swap models while serving requests
+if "background_model_loader" not in sys.modules:
+    loader_spec = importlib.util.spec_from_file_location("background_model_loader", Path(__file__).parent.parent / "background_model_loader.py")
+    sys.modules[loader_spec.name] = importlib.util.module_from_spec(loader_spec)
+    loader_spec.loader.exec_module(sys.modules[loader_spec.name])
+from background_model_loader import BackgroundModelLoader, with_model_lock
+
+
 def ban_eos_logits_processor(eos_token, input_ids, logits):
     logits[eos_token] = -float('inf')
     return logits
 
 
 def custom_token_ban_logits_processor(token_ids, input_ids, logits):
-    for token_id in token_ids:
-        logits[token_id] = -float('inf')
+    logits[token_ids] = -float('inf')
+    return logits
+
+
+def logit_bias_logits_processor(token_ids, biases, input_ids, logits):
+    logits[token_ids] += biases
+    return logits
+
 
+def min_p_logits_processor(min_p, input_ids, logits):
+    """Removes the tokens whose probability is below min_p times the probability of the most likely token"""
+    import numpy as np
+    logits[logits < logits.max() + np.log(min_p)] = -float('inf')
+    return logits
+
+
+def repetition_penalty_logits_processor(penalty, window, input_ids, logits):
+    """Penalizes the tokens present in the last window tokens (the whole context if window is -1)"""
+    import numpy as np
+    if window==0 or len(input_ids)==0:
+        return logits
+    token_ids = np.unique(input_ids[-window:] if window>0 else input_ids)
+    penalized = logits[token_ids]
+    logits[token_ids] = np.where(penalized>0, penalized/penalty, penalized*penalty)
     return logits
 
 
@@ -58,6 +95,1393 @@ def check_file_type(suffix, extensions):
         if ext.replace('.', '').lower() in suffix.lower():
             return True
     return False
+
+
+def sample_logits(logits, rng, temperature:float=0.7, top_k:int=0, top_p:float=1.0):
+    """
+    Samples a token out of a logits vector with numpy (used by the batched generation which
+    drives llama.cpp directly and can't use the llama_cpp samplers)
+    """
+    import numpy as np
+    logits = logits.astype(np.float32, copy=True)
+    if temperature<=0:
+        return int(np.argmax(logits))
+    logits /= temperature
+    if top_k>0 and top_k<logits.shape[0]:
+        candidates = np.argpartition(logits, -top_k)[-top_k:]
+    else:
+        candidates = np.arange(logits.shape[0])
+    candidates = candidates[np.argsort(logits[candidates])[::-1]]
+    probs = np.exp(logits[candidates] - logits[candidates[0]])
+    probs /= probs.sum()
+    if 0<top_p<1.0:
+        keep = int(np.searchsorted(np.cumsum(probs), top_p)) + 1
+        candidates = candidates[:keep]
+        probs = probs[:keep] / probs[:keep].sum()
+    return int(rng.choice(candidates, p=probs))
+
+
+def stop_string_holdback(text:str, stop:list):
+    """
+    Returns the number of characters at the end of text that may be the beginning of a stop string
+    and must not be streamed yet
+    """
+    holdback = 0
+    for s in stop:
+        for n in range(min(len(s)-1, len(text)), holdback, -1):
+            if text.endswith(s[:n]):
+                holdback = n
+                break
+    return holdback
+
+
+def longest_token_prefix(a, b):
+    """Returns the number of leading tokens shared by the two token sequences."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+GGUF_FILE_TYPES = {
+    0:"F32", 1:"F16", 2:"Q4_0", 3:"Q4_1", 7:"Q8_0", 8:"Q5_0", 9:"Q5_1", 10:"Q2_K", 11:"Q3_K_S", 12:"Q3_K_M",
+    13:"Q3_K_L", 14:"Q4_K_S", 15:"Q4_K_M", 16:"Q5_K_S", 17:"Q5_K_M", 18:"Q6_K", 19:"IQ2_XXS", 20:"IQ2_XS",
+    21:"Q2_K_S", 22:"IQ3_XS", 23:"IQ3_XXS", 24:"IQ1_S", 25:"IQ4_NL", 26:"IQ3_S", 27:"IQ3_M", 28:"IQ2_S",
+    29:"IQ2_M", 30:"IQ4_XS", 31:"IQ1_M", 32:"BF16", 36:"TQ1_0", 37:"TQ2_0"
+}
+
+
+def read_gguf_header(path:Path):
+    """
+    Reads the metadata of a gguf file without loading it.
+    The file is memory mapped and only the header pages are read. Arrays (like the vocabulary) are skipped:
+    only the length prefixes of their strings are read.
+
+    Returns:
+        dict: The metadata key/values and the tensors count and data size
+    """
+    import mmap
+    import struct
+    scalars = {0:"<B", 1:"<b", 2:"<H", 3:"<h", 4:"<I", 5:"<i", 6:"<f", 7:"<?", 10:"<Q", 11:"<q", 12:"<d"}
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:4]!=b"GGUF":
+                raise ValueError("Not a gguf file")
+            version, = struct.unpack_from("<I", data, 4)
+            if version==1:
+                raise ValueError("gguf version 1 is not supported anymore")
+            n_tensors, n_kv = struct.unpack_from("<QQ", data, 8)
+            offset = 24
+
+            string_length = struct.Struct("<Q")
+
+            def read_string(offset):
+                length, = string_length.unpack_from(data, offset)
+                return data[offset+8:offset+8+length].decode("utf8", errors="replace"), offset+8+length
+
+            def skip_array(item_type, length, offset):
+                if item_type in scalars:
+                    return offset + length*struct.calcsize(scalars[item_type])
+                if item_type==8:
+                    # Only the length prefixes are read, the strings are not decoded
+                    for _ in range(length):
+                        offset += 8 + string_length.unpack_from(data, offset)[0]
+                    return offset
+                if item_type==9:
+                    for _ in range(length):
+                        nested_type, nested_length = struct.unpack_from("<IQ", data, offset)
+                        offset = skip_array(nested_type, nested_length, offset+12)
+                    return offset
+                raise ValueError(f"Unknown gguf value type {item_type}")
+
+            def read_value(value_type, offset):
+                if value_type in scalars:
+                    fmt = scalars[value_type]
+                    return struct.unpack_from(fmt, data, offset)[0], offset+struct.calcsize(fmt)
+                if value_type==8:
+                    return read_string(offset)
+                if value_type==9:
+                    item_type, length = struct.unpack_from("<IQ", data, offset)
+                    return None, skip_array(item_type, length, offset+12)
+                raise ValueError(f"Unknown gguf value type {value_type}")
+
+            metadata = {}
+            for _ in range(n_kv):
+                key, offset = read_string(offset)
+                value_type, = struct.unpack_from("<I", data, offset)
+                metadata[key], offset = read_value(value_type, offset+4)
+            for _ in range(n_tensors):
+                _, offset = read_string(offset)
+                n_dims, = struct.unpack_from("<I", data, offset)
+                # dims, type and offset
+                offset += 4 + 8*n_dims + 4 + 8
+            alignment = metadata.get("general.alignment") or 32
+            data_start = (offset + alignment - 1)//alignment*alignment
+            if data_start>len(data):
+                raise ValueError("Truncated gguf file")
+            return {"version":version, "metadata":metadata, "tensor_count":n_tensors, "tensor_bytes":len(data)-data_start}
+
+
+# ggml type id and bytes per element of the KV cache types (the quantized types store blocks of 32 values)
+KV_CACHE_TYPES = {
+    "f16":(1, 2.0),
+    "q8_0":(8, 34/32),
+    "q4_0":(2, 18/32),
+}
+
+
+def kv_cache_bytes_per_token(model_info:dict, kv_type:str="f16"):
+    """
+    Size of the keys and values of one token for all layers: n_layer * n_head_kv * (head_dim_k + head_dim_v) * bytes per element.
+    Returns None when the gguf header doesn't give the attention shape.
+    """
+    n_layer = model_info.get("block_count")
+    n_head = model_info.get("head_count")
+    n_head_kv = model_info.get("head_count_kv") or n_head
+    if not n_layer or not n_head_kv:
+        return None
+    head_dim = model_info["embedding_length"]//n_head if model_info.get("embedding_length") and n_head else None
+    key_length = model_info.get("key_length") or head_dim
+    value_length = model_info.get("value_length") or head_dim
+    if not key_length or not value_length:
+        return None
+    return n_layer * n_head_kv * (key_length + value_length) * KV_CACHE_TYPES[kv_type][1]
+
+
+def plan_kv_cache(model_info:dict, budget_bytes:int, kv_type:str="auto", n_sequences:int=1, min_ctx:int=512):
+    """
+    Chooses the context size and KV cache type that fit in a memory budget.
+    The largest context (up to the training context of the model) wins, and among the types that reach it
+    the most precise one is used. With kv_type set to a type, only that type is considered.
+
+    Returns:
+        tuple: (n_ctx, kv_type, kv_bytes) or None if the model shape is unknown or nothing fits
+    """
+    candidates = list(KV_CACHE_TYPES.keys()) if kv_type=="auto" else [kv_type]
+    max_ctx = model_info.get("context_length") or 0
+    best = None
+    for candidate in candidates:
+        bytes_per_token = kv_cache_bytes_per_token(model_info, candidate)
+        if bytes_per_token is None:
+            return None
+        # llama.cpp pads the context to multiples of 256
+        n_ctx = int(budget_bytes // (bytes_per_token * n_sequences)) // 256 * 256
+        if max_ctx>0:
+            n_ctx = min(n_ctx, max_ctx)
+        if n_ctx<min_ctx:
+            continue
+        if best is None or n_ctx>best[0]:
+            best = (n_ctx, candidate, int(n_ctx * n_sequences * bytes_per_token))
+    return best
+
+
+def host_fingerprint():
+    """Identifies the machine (cpu model and the cores available to this process) the tuning profiles were measured on"""
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            cpu = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), cpu)
+    except Exception:
+        pass
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return hashlib.sha256(f"{platform.node()}|{platform.machine()}|{cpu}|{n_cpus}".encode("utf8")).hexdigest()[:16]
+
+
+class LlamaTuningProfiles:
+    """
+    Stores the best n_threads, n_threads_batch and n_batch measured for each (host, model file, gpu layers)
+    """
+    def __init__(self, profiles_file:Path):
+        self.profiles_file = Path(profiles_file)
+        self.profiles = {}
+        if self.profiles_file.exists():
+            try:
+                with open(self.profiles_file, "r") as f:
+                    self.profiles = json.load(f)
+            except Exception as ex:
+                trace_exception(ex)
+
+    @staticmethod
+    def model_key(model_path:Path, n_gpu_layers:int):
+        model_path = Path(model_path)
+        return f"{model_path.name}:{model_path.stat().st_size}:{n_gpu_layers}"
+
+    def get(self, model_path:Path, n_gpu_layers:int):
+        return self.profiles.get(host_fingerprint(), {}).get(self.model_key(model_path, n_gpu_layers))
+
+    def put(self, model_path:Path, n_gpu_layers:int, profile:dict):
+        self.profiles.setdefault(host_fingerprint(), {})[self.model_key(model_path, n_gpu_layers)] = profile
+        self.profiles_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.profiles_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.profiles, f, indent=4)
+        tmp_file.replace(self.profiles_file)
+
+
+def autotune_llama_cpp(model_path:Path, n_gpu_layers:int=0, thread_candidates:list=None, batch_candidates:list=None, prompt_tokens:int=512, decode_tokens:int=32, callback:Callable[[str], None]=None):
+    """
+    Measures the prompt evaluation and the generation speeds of a model on a synthetic prompt.
+    The prompt evaluation threads are swept first, then the generation threads and finally the batch sizes
+    with the best thread counts.
+
+    Returns:
+        dict: The best profile with its measurements
+    """
+    import llama_cpp
+    if callback is None:
+        callback = ASCIIColors.info
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    if thread_candidates is None:
+        thread_candidates = sorted(set([n for n in [4, 8, 16, 32, 64, 128] if n<n_cpus] + [max(1, n_cpus//4), max(1, n_cpus//2), max(1, 3*n_cpus//4), n_cpus]))
+    if batch_candidates is None:
+        batch_candidates = [128, 256, 512, 1024, 2048]
+    batch_candidates = [b for b in batch_candidates if b<=prompt_tokens] or [prompt_tokens]
+    default_batch = 512 if 512 in batch_candidates else batch_candidates[-1]
+
+    def build(n_batch, n_threads):
+        return llama_cpp.Llama(
+                    model_path=str(model_path),
+                    n_gpu_layers=n_gpu_layers,
+                    n_ctx=prompt_tokens+decode_tokens+256,
+                    n_batch=n_batch,
+                    n_ubatch=n_batch,
+                    n_threads=n_threads,
+                    n_threads_batch=n_threads,
+                    verbose=False
+                )
+
+    def prompt_speed(model, n_threads_batch):
+        llama_cpp.llama_set_n_threads(model.ctx, n_threads_batch, n_threads_batch)
+        model.reset()
+        start = time.perf_counter()
+        model.eval(tokens)
+        return len(tokens)/(time.perf_counter()-start)
+
+    def decode_speed(model, n_threads, n_threads_batch):
+        llama_cpp.llama_set_n_threads(model.ctx, n_threads, n_threads_batch)
+        model.reset()
+        model.eval(tokens[:16])
+        start = time.perf_counter()
+        for token in tokens[16:16+decode_tokens]:
+            model.eval([token])
+        return decode_tokens/(time.perf_counter()-start)
+
+    model = build(default_batch, n_cpus)
+    text = "The quick brown fox jumps over the lazy dog while the old clockmaker counts the seconds until dawn. "
+    tokens = model.tokenize((text*(1+prompt_tokens//8)).encode("utf8"))[:prompt_tokens]
+    # Warm up so that the weights are in memory before measuring
+    prompt_speed(model, n_cpus)
+
+    measurements = {"prompt":{}, "decode":{}, "batch":{}}
+    for n_threads in thread_candidates:
+        measurements["prompt"][n_threads] = prompt_speed(model, n_threads)
+        callback(f"Prompt evaluation with {n_threads} threads: {measurements['prompt'][n_threads]:.2f} tokens/s")
+    n_threads_batch = max(measurements["prompt"], key=measurements["prompt"].get)
+    for n_threads in thread_candidates:
+        measurements["decode"][n_threads] = decode_speed(model, n_threads, n_threads_batch)
+        callback(f"Generation with {n_threads} threads: {measurements['decode'][n_threads]:.2f} tokens/s")
+    best_threads = max(measurements["decode"], key=measurements["decode"].get)
+    measurements["batch"][default_batch] = measurements["prompt"][n_threads_batch]
+    model.close()
+    for n_batch in batch_candidates:
+        if n_batch==default_batch:
+            continue
+        model = build(n_batch, n_threads_batch)
+        prompt_speed(model, n_threads_batch)
+        measurements["batch"][n_batch] = prompt_speed(model, n_threads_batch)
+        callback(f"Prompt evaluation with a batch of {n_batch} tokens: {measurements['batch'][n_batch]:.2f} tokens/s")
+        model.close()
+    n_batch = max(measurements["batch"], key=measurements["batch"].get)
+    return {
+        "n_threads":best_threads,
+        "n_threads_batch":n_threads_batch,
+        "n_batch":n_batch,
+        "prompt_tokens_per_s":measurements["batch"][n_batch],
+        "decode_tokens_per_s":measurements["decode"][best_threads],
+        "measurements":measurements,
+        "date":time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+class GGUFCatalog:
+    """
+    Persistent index of the metadata of the installed gguf files.
+    Only the files that changed since the last refresh (by size and modification time) are read again,
+    so the model zoo and build_model can check a model in milliseconds.
+    """
+    def __init__(self, models_dirs:list, index_file:Path):
+        self.models_dirs = [Path(d) for d in models_dirs]
+        self.index_file = Path(index_file)
+        self.entries = {}
+        self.lock = threading.Lock()
+        if self.index_file.exists():
+            try:
+                with open(self.index_file, "r") as f:
+                    self.entries = json.load(f)
+            except Exception as ex:
+                trace_exception(ex)
+                self.entries = {}
+
+    @staticmethod
+    def read_entry(path:Path):
+        stat = path.stat()
+        entry = {"size":stat.st_size, "mtime":stat.st_mtime, "valid":False, "error":None}
+        try:
+            header = read_gguf_header(path)
+        except Exception as ex:
+            entry["error"] = str(ex)
+            return entry
+        metadata = header["metadata"]
+        architecture = metadata.get("general.architecture")
+        def arch_value(key):
+            return metadata.get(f"{architecture}.{key}")
+        entry.update({
+            "valid":True,
+            "name":metadata.get("general.name"),
+            "architecture":architecture,
+            "is_mmproj":architecture=="clip" or metadata.get("general.type")=="mmproj",
+            "context_length":arch_value("context_length"),
+            "block_count":arch_value("block_count"),
+            "embedding_length":arch_value("embedding_length"),
+            "head_count":arch_value("attention.head_count"),
+            "head_count_kv":arch_value("attention.head_count_kv"),
+            "key_length":arch_value("attention.key_length"),
+            "value_length":arch_value("attention.value_length"),
+            "file_type":GGUF_FILE_TYPES.get(metadata.get("general.file_type"), metadata.get("general.file_type")),
+            "tensor_count":header["tensor_count"],
+            "tensor_bytes":header["tensor_bytes"],
+            "chat_template":metadata.get("tokenizer.chat_template"),
+        })
+        return entry
+
+    def is_up_to_date(self, key:str, path:Path):
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        stat = path.stat()
+        return entry["size"]==stat.st_size and entry["mtime"]==stat.st_mtime
+
+    def refresh(self):
+        """Updates the index with the new and modified files and removes the deleted ones"""
+        with self.lock:
+            found = set()
+            changed = False
+            for models_dir in self.models_dirs:
+                if not models_dir.exists():
+                    continue
+                for path in models_dir.rglob("*.gguf"):
+                    key = str(path)
+                    found.add(key)
+                    if not self.is_up_to_date(key, path):
+                        self.entries[key] = self.read_entry(path)
+                        changed = True
+            for key in [k for k in self.entries if k not in found]:
+                del self.entries[key]
+                changed = True
+            if changed:
+                self.save()
+
+    def get(self, path:Path):
+        """Returns the entry of a file, reading its header again if it changed"""
+        path = Path(path)
+        key = str(path)
+        with self.lock:
+            if not self.is_up_to_date(key, path):
+                self.entries[key] = self.read_entry(path)
+                self.save()
+            return self.entries[key]
+
+    def find_mmproj(self, path:Path):
+        """Returns the projector file found next to a model, or None for text only models"""
+        path = Path(path)
+        for candidate in sorted(path.parent.glob("*.gguf")):
+            if candidate!=path and self.get(candidate).get("is_mmproj"):
+                return candidate
+        return None
+
+    def save(self):
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.index_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.entries, f)
+        tmp_file.replace(self.index_file)
+
+
+class PromptCacheMonitor:
+    """
+    Wraps a llama_cpp prompt cache (LlamaRAMCache, LlamaDiskCache, ...) and keeps
+    hit/miss statistics about the lookups done by llama_cpp before each completion.
+    """
+    def __init__(self, cache, backend:str):
+        self.cache = cache
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.looked_up_tokens = 0
+        self.last_lookup = None
+        # Set when the binding already restored the state so that the lookup done by llama_cpp is skipped
+        self.skip_next_lookup = False
+
+    @property
+    def cache_size(self):
+        return self.cache.cache_size
+
+    @property
+    def capacity_bytes(self):
+        return self.cache.capacity_bytes
+
+    def __getitem__(self, key):
+        if self.skip_next_lookup:
+            self.skip_next_lookup = False
+            raise KeyError(key)
+        try:
+            state = self.cache[key]
+        except KeyError:
+            self.misses += 1
+            self.looked_up_tokens += len(key)
+            self.last_lookup = {"hit":False, "reused_tokens":0, "prompt_tokens":len(key)}
+            raise
+        reused = longest_token_prefix(state.input_ids[:state.n_tokens].tolist(), key)
+        self.hits += 1
+        self.reused_tokens += reused
+        self.looked_up_tokens += len(key)
+        self.last_lookup = {"hit":True, "reused_tokens":reused, "prompt_tokens":len(key)}
+        return state
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+
+    def pop_last_lookup(self):
+        last_lookup = self.last_lookup
+        self.last_lookup = None
+        return last_lookup
+
+    def summary(self, last_lookup=None):
+        total = self.hits + self.misses
+        hit_rate = 100*self.hits/total if total>0 else 0
+        reuse_rate = 100*self.reused_tokens/self.looked_up_tokens if self.looked_up_tokens>0 else 0
+        text = f"Prompt cache ({self.backend}): "
+        if last_lookup is not None:
+            if last_lookup["hit"]:
+                text += f"hit, reused {last_lookup['reused_tokens']}/{last_lookup['prompt_tokens']} tokens. "
+            else:
+                text += f"miss, {last_lookup['prompt_tokens']} tokens to evaluate. "
+        text += f"Total: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}%), {reuse_rate:.1f}% tokens reused, {self.cache_size/(1<<20):.1f}/{self.capacity_bytes/(1<<20):.1f} MiB used"
+        return text
+
+
+class LlamaStateSnapshotStore:
+    """
+    Disk store of llama context states (the result of Llama.save_state).
+
+    Each snapshot lives in its own folder as raw numpy files that are memory mapped back
+    when the snapshot is restored. Snapshots are indexed by a rolling hash of the tokens
+    they hold, so the longest snapshot that prefixes a new prompt is found in one pass over
+    the prompt. The store implements the llama_cpp cache interface so it can be given to
+    Llama.set_cache, and it is safe to share between discussions using the same model.
+    """
+    HASH_BASE = 1000003
+    HASH_MOD = (1 << 61) - 1
+
+    def __init__(self, store_dir:Path, capacity_bytes:int):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.capacity_bytes = capacity_bytes
+        # prefix hash -> snapshot metadata, kept in least recently used first order
+        self.index = OrderedDict()
+        self.lock = threading.Lock()
+        self.load_index()
+
+    @staticmethod
+    def prefix_hashes(tokens):
+        """Yields the rolling hash of tokens[:1], tokens[:2], ... tokens[:n]"""
+        h = 0
+        base = LlamaStateSnapshotStore.HASH_BASE
+        mod = LlamaStateSnapshotStore.HASH_MOD
+        for token in tokens:
+            h = (h * base + int(token) + 1) % mod
+            yield h
+
+    @staticmethod
+    def tokens_hash(tokens):
+        h = 0
+        for h in LlamaStateSnapshotStore.prefix_hashes(tokens):
+            pass
+        return h
+
+    def load_index(self):
+        entries = []
+        for meta_file in self.store_dir.glob("*/meta.json"):
+            try:
+                with open(meta_file, "r") as f:
+                    meta = json.load(f)
+                entries.append((meta_file.stat().st_mtime, meta))
+            except Exception as ex:
+                ASCIIColors.warning(f"Removing corrupted snapshot {meta_file.parent}")
+                shutil.rmtree(meta_file.parent, ignore_errors=True)
+        for _, meta in sorted(entries, key=lambda e: e[0]):
+            self.index[meta["hash"]] = meta
+        for tmp_dir in self.store_dir.glob("*.tmp"):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @property
+    def cache_size(self):
+        return sum(meta["size"] for meta in self.index.values())
+
+    def find_longest_prefix(self, tokens):
+        best = None
+        for n, h in enumerate(self.prefix_hashes(tokens), 1):
+            meta = self.index.get(h)
+            if meta is not None and meta["n_tokens"] == n:
+                best = meta
+        return best
+
+    def load_snapshot(self, meta):
+        import numpy as np
+        from llama_cpp.llama import LlamaState
+        snapshot_dir = self.store_dir / meta["hash_hex"]
+        input_ids = np.load(snapshot_dir / "input_ids.npy", mmap_mode="r")
+        llama_state = np.load(snapshot_dir / "llama_state.npy", mmap_mode="r")
+        scores = np.load(snapshot_dir / "scores.npy")
+        os.utime(snapshot_dir / "meta.json")
+        return LlamaState(
+            input_ids=input_ids,
+            scores=scores,
+            n_tokens=meta["n_tokens"],
+            llama_state=llama_state,
+            llama_state_size=meta["llama_state_size"],
+            seed=meta["seed"]
+        )
+
+    def remove_snapshot(self, h):
+        meta = self.index.pop(h, None)
+        if meta is not None:
+            shutil.rmtree(self.store_dir / meta["hash_hex"], ignore_errors=True)
+
+    def __getitem__(self, key):
+        with self.lock:
+            meta = self.find_longest_prefix(key)
+            if meta is None:
+                raise KeyError("No snapshot found")
+            try:
+                state = self.load_snapshot(meta)
+            except Exception as ex:
+                trace_exception(ex)
+                self.remove_snapshot(meta["hash"])
+                raise KeyError("Snapshot couldn't be loaded")
+            # Protect against hash collisions
+            if list(state.input_ids[:meta["n_tokens"]]) != list(key[:meta["n_tokens"]]):
+                raise KeyError("Snapshot hash collision")
+            self.index.move_to_end(meta["hash"])
+            return state
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.find_longest_prefix(key) is not None
+
+    def __setitem__(self, key, state):
+        import numpy as np
+        n_tokens = int(state.n_tokens)
+        if n_tokens == 0:
+            return
+        input_ids = np.asarray(state.input_ids)
+        h = self.tokens_hash(input_ids[:n_tokens].tolist())
+        with self.lock:
+            if h in self.index:
+                self.index.move_to_end(h)
+                os.utime(self.store_dir / self.index[h]["hash_hex"] / "meta.json")
+                return
+            hash_hex = f"{h:016x}"
+            tmp_dir = self.store_dir / (hash_hex + ".tmp")
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+            np.save(tmp_dir / "input_ids.npy", input_ids)
+            # Only the logits of the last evaluated token are needed to continue the generation
+            np.save(tmp_dir / "scores.npy", np.asarray(state.scores[-1:]))
+            np.save(tmp_dir / "llama_state.npy", np.frombuffer(state.llama_state, dtype=np.uint8))
+            meta = {
+                "hash": h,
+                "hash_hex": hash_hex,
+                "n_tokens": n_tokens,
+                "llama_state_size": int(state.llama_state_size),
+                "seed": int(state.seed),
+                "size": sum(f.stat().st_size for f in tmp_dir.iterdir())
+            }
+            with open(tmp_dir / "meta.json", "w") as f:
+                json.dump(meta, f)
+            snapshot_dir = self.store_dir / hash_hex
+            if snapshot_dir.exists():
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+            tmp_dir.rename(snapshot_dir)
+            self.index[h] = meta
+            while self.cache_size > self.capacity_bytes and len(self.index) > 1:
+                self.remove_snapshot(next(iter(self.index)))
+
+
+class LlamaLoraRegistry:
+    """
+    Loads LoRA adapters on a resident base model and attaches them to its context at request time.
+    Once loaded, the adapters stay in memory (llama.cpp frees them with the model), so switching the
+    adapters between two requests costs no reload.
+    """
+    def __init__(self, model):
+        import llama_cpp
+        self.model = model
+        self.adapters = {}
+        self.active = {}
+        # Adapters attached when the model was loaded, the prompt cache states were computed with them
+        self.default = {}
+        # The adapter functions were renamed in recent llama.cpp versions
+        self.adapter_init = getattr(llama_cpp, "llama_lora_adapter_init", None) or getattr(llama_cpp, "llama_adapter_lora_init", None)
+        self.adapter_set = getattr(llama_cpp, "llama_lora_adapter_set", None) or getattr(llama_cpp, "llama_set_adapter_lora", None)
+        self.adapter_remove = getattr(llama_cpp, "llama_lora_adapter_remove", None) or getattr(llama_cpp, "llama_rm_adapter_lora", None)
+        self.supported = None not in (self.adapter_init, self.adapter_set, self.adapter_remove)
+        if not self.supported:
+            ASCIIColors.warning("This llama_cpp version doesn't expose the LoRA adapter functions. LoRA adapters are deactivated")
+
+    def get_adapter(self, lora_path:str):
+        adapter = self.adapters.get(lora_path)
+        if adapter is None:
+            start = time.perf_counter()
+            adapter = self.adapter_init(self.model.model, lora_path.encode("utf8"))
+            if not adapter:
+                raise RuntimeError(f"Couldn't load the LoRA adapter {lora_path}")
+            self.adapters[lora_path] = adapter
+            ASCIIColors.info(f"Loaded LoRA adapter {Path(lora_path).name} in {time.perf_counter()-start:.2f}s")
+        return adapter
+
+    def apply(self, selection:dict):
+        """
+        Attaches the selected adapters (path -> scale) and detaches the others.
+
+        Returns:
+            bool: True if the adapters changed, the evaluated tokens are not valid anymore
+        """
+        if selection==self.active:
+            return False
+        if not self.supported:
+            ASCIIColors.warning("LoRA adapters are not supported by this llama_cpp version, using the base model")
+            return False
+        for lora_path in list(self.active.keys()):
+            if lora_path not in selection:
+                self.adapter_remove(self.model.ctx, self.adapters[lora_path])
+                del self.active[lora_path]
+        for lora_path, scale in selection.items():
+            if self.active.get(lora_path)!=scale:
+                if self.adapter_set(self.model.ctx, self.get_adapter(lora_path), scale)!=0:
+                    raise RuntimeError(f"Couldn't attach the LoRA adapter {lora_path}")
+                self.active[lora_path] = scale
+        return True
+
+    def attach(self, ctx):
+        """Attaches the active adapters to another context of the model"""
+        for lora_path, scale in self.active.items():
+            if self.adapter_set(ctx, self.adapters[lora_path], scale)!=0:
+                raise RuntimeError(f"Couldn't attach the LoRA adapter {lora_path}")
+
+
+class LlamaGrammarCache:
+    """
+    LRU of the LlamaGrammar objects keyed by the hash of their text, so that the personalities sending the same
+    JSON schema with each request don't pay its conversion to GBNF again. llama-cpp-python only keeps the GBNF
+    text in the LlamaGrammar and the grammar is parsed by the sampler of each request, so plain GBNF grammars
+    gain little from the cache.
+    """
+    def __init__(self, capacity:int=32):
+        self.capacity = capacity
+        self.grammars = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, grammar:str=None, json_schema=None):
+        import llama_cpp
+        if json_schema is not None and not isinstance(json_schema, str):
+            json_schema = json.dumps(json_schema, sort_keys=True)
+        kind, text = ("json_schema", json_schema) if json_schema is not None else ("gbnf", grammar)
+        key = hashlib.sha256(f"{kind}:{text}".encode("utf8")).hexdigest()
+        with self.lock:
+            compiled = self.grammars.get(key)
+            if compiled is not None:
+                self.grammars.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        start = time.perf_counter()
+        if kind=="json_schema":
+            compiled = llama_cpp.LlamaGrammar.from_json_schema(text, verbose=False)
+        else:
+            compiled = llama_cpp.LlamaGrammar.from_string(text, verbose=False)
+        ASCIIColors.info(f"Prepared {kind} grammar in {1000*(time.perf_counter()-start):.1f}ms")
+        with self.lock:
+            self.grammars[key] = compiled
+            while len(self.grammars) > self.capacity:
+                self.grammars.popitem(last=False)
+        return compiled
+
+
+class GGUFDraftModel:
+    """
+    Draft model for llama_cpp speculative decoding built on a small gguf model that shares
+    the vocabulary of the main model. Drafts are produced greedily and the draft context
+    keeps the evaluated prefix between calls so only the new tokens are evaluated.
+    """
+    def __init__(self, model, num_pred_tokens:int=10):
+        self.model = model
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, **kwargs):
+        import numpy as np
+        import llama_cpp
+        tokens = input_ids.tolist()
+        if len(tokens)==0 or len(tokens) + self.num_pred_tokens >= self.model.n_ctx():
+            return np.array([], dtype=np.intc)
+        prefix = longest_token_prefix(self.model.input_ids[:self.model.n_tokens].tolist(), tokens)
+        # We need the logits of the last token, so it is evaluated again if it is already in the context
+        prefix = min(prefix, len(tokens)-1)
+        self.model.n_tokens = prefix
+        self.model.eval(tokens[prefix:])
+        n_vocab = self.model.n_vocab()
+        eos = self.model.token_eos()
+        draft = []
+        for i in range(self.num_pred_tokens):
+            logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.model.ctx, -1), shape=(n_vocab,))
+            token = int(np.argmax(logits))
+            if token == eos:
+                break
+            draft.append(token)
+            if i < self.num_pred_tokens-1:
+                self.model.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+
+class DraftModelMonitor:
+    """
+    Wraps a llama_cpp draft model and counts the drafted tokens.
+    llama_cpp asks for a new draft after each verification round, and each round produces
+    the accepted draft tokens plus one token sampled by the main model, which gives the
+    number of accepted tokens from the number of generated tokens.
+    """
+    def __init__(self, draft_model, mode:str):
+        self.draft_model = draft_model
+        self.mode = mode
+        self.reset()
+
+    def reset(self):
+        self.rounds = 0
+        self.proposed_tokens = 0
+
+    def __call__(self, input_ids, **kwargs):
+        draft = self.draft_model(input_ids, **kwargs)
+        self.rounds += 1
+        self.proposed_tokens += len(draft)
+        return draft
+
+    def summary(self, n_generated:int, elapsed:float):
+        accepted = max(0, min(self.proposed_tokens, n_generated - self.rounds))
+        acceptance_rate = 100*accepted/self.proposed_tokens if self.proposed_tokens>0 else 0
+        speed = n_generated/elapsed if elapsed>0 else 0
+        return f"Speculative decoding ({self.mode}): {accepted}/{self.proposed_tokens} drafted tokens accepted ({acceptance_rate:.1f}%), {n_generated} tokens in {elapsed:.2f}s ({speed:.2f} tokens/s)"
+
+
+class LlamaModelPool:
+    """
+    Keeps several loaded llama_cpp models resident so that switching between them is free.
+    The pool is bounded by a memory budget computed from the size of the model files and
+    evicts the least recently used models first. Pinned models are never evicted.
+    The pool is changed by the requests and by the background loader, every change holds its lock.
+    """
+    def __init__(self, budget_bytes:int=0):
+        self.budget_bytes = budget_bytes
+        # key -> entry, in least recently used first order
+        self.entries = OrderedDict()
+        self.pinned = set()
+        self.lock = threading.RLock()
+
+    @property
+    def total_size(self):
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def make_room(self, size:int, keep=[]):
+        """Evicts unpinned models (except those in keep) until a model of the given size fits in the budget"""
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if self.total_size + size <= self.budget_bytes:
+                    break
+                if key[0] not in self.pinned and key not in keep:
+                    self.evict(key)
+
+    def add(self, key, entry:dict, keep=[]):
+        with self.lock:
+            self.make_room(entry["size"], keep)
+            self.entries[key] = entry
+
+    def forget(self, key):
+        """Removes a model from the pool without closing it (the model in use is closed once it is replaced)"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def evict(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        if entry is not None:
+            ASCIIColors.yellow(f"Unloading model {Path(key[0]).name} from the models pool")
+            models = [entry["model"]]
+            if entry["draft_model"] is not None and isinstance(entry["draft_model"].draft_model, GGUFDraftModel):
+                models.append(entry["draft_model"].draft_model.model)
+            for model in models:
+                if hasattr(model, "close"):
+                    try:
+                        model.close()
+                    except Exception as ex:
+                        trace_exception(ex)
+            entry.clear()
+            gc.collect()
+
+    def clear(self, keep=[]):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if key not in keep:
+                    self.evict(key)
+
+    def pin(self, model_path:str):
+        with self.lock:
+            self.pinned.add(str(model_path))
+
+    def unpin(self, model_path:str):
+        with self.lock:
+            self.pinned.discard(str(model_path))
+
+
+class EmbeddingCache:
+    """
+    Content hash keyed cache of embeddings.
+    A LRU in memory sits in front of an optional numpy memmap on disk that keeps the vectors
+    between sessions, so indexing unchanged documents again doesn't compute anything.
+    The disk store is a ring buffer: when full, the oldest vectors are overwritten.
+    """
+    def __init__(self, memory_capacity:int=10000, cache_dir:Path=None, disk_capacity:int=0):
+        self.memory_capacity = memory_capacity
+        self.memory = OrderedDict()
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.disk_capacity = disk_capacity
+        self.vectors = None
+        self.rows = {}
+        self.row_keys = {}
+        self.next_row = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir is not None and self.disk_capacity>0:
+            self.load_disk_index()
+
+    @staticmethod
+    def key(text:str):
+        return hashlib.sha256(text.encode("utf8", errors="ignore")).hexdigest()
+
+    def load_disk_index(self):
+        import numpy as np
+        index_file = self.cache_dir / "index.json"
+        vectors_file = self.cache_dir / "vectors.npy"
+        if index_file.exists() and vectors_file.exists():
+            try:
+                with open(index_file, "r") as f:
+                    index = json.load(f)
+                self.vectors = np.load(vectors_file, mmap_mode="r+")
+                if self.vectors.shape[0] == self.disk_capacity:
+                    self.rows = index["rows"]
+                    self.row_keys = {row:key for key, row in self.rows.items()}
+                    self.next_row = index["next_row"]
+                else:
+                    # The capacity changed, start a new store
+                    self.vectors = None
+            except Exception as ex:
+                trace_exception(ex)
+                self.vectors = None
+                self.rows = {}
+                self.row_keys = {}
+                self.next_row = 0
+
+    def save_disk_index(self):
+        if self.vectors is None:
+            return
+        self.vectors.flush()
+        tmp_file = self.cache_dir / "index.json.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"rows":self.rows, "next_row":self.next_row}, f)
+        tmp_file.replace(self.cache_dir / "index.json")
+
+    def get(self, key:str):
+        with self.lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return vector
+            row = self.rows.get(key)
+            if row is not None and self.vectors is not None:
+                vector = self.vectors[row].tolist()
+                self._put_memory(key, vector)
+                self.hits += 1
+                return vector
+            self.misses += 1
+            return None
+
+    def _put_memory(self, key:str, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_capacity:
+            self.memory.popitem(last=False)
+
+    def put(self, key:str, vector):
+        import numpy as np
+        with self.lock:
+            self._put_memory(key, vector)
+            if self.cache_dir is None or self.disk_capacity<=0 or key in self.rows:
+                return
+            if self.vectors is None or self.vectors.shape[1] != len(vector):
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                self.vectors = np.lib.format.open_memmap(self.cache_dir / "vectors.npy", mode="w+", dtype=np.float32, shape=(self.disk_capacity, len(vector)))
+                self.rows = {}
+                self.row_keys = {}
+                self.next_row = 0
+            # Overwrite the oldest vector when the store is full
+            old_key = self.row_keys.get(self.next_row)
+            if old_key is not None:
+                del self.rows[old_key]
+            self.vectors[self.next_row] = vector
+            self.rows[key] = self.next_row
+            self.row_keys[self.next_row] = key
+            self.next_row = (self.next_row + 1) % self.disk_capacity
+
+    def flush(self):
+        with self.lock:
+            self.save_disk_index()
+
+
+def available_memory():
+    """Returns the memory that can be used by the page cache without swapping, or None when it is unknown"""
+    # The available memory includes the reclaimable page cache, the free memory doesn't
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except Exception:
+        return None
+
+
+class PageCachePrewarmer:
+    """
+    Reads model files sequentially on a background thread so that their pages are in the page cache before
+    llama.cpp touches them through its memory map. A cold memory mapped load reads the file one page fault
+    at a time in the order of the tensors, a sequential read runs at the full speed of the disk.
+    """
+    def __init__(self, chunk_size:int=64*(1<<20)):
+        self.chunk_size = chunk_size
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.bytes_read = 0
+        self.duration = 0
+
+    def prewarm_file(self, path:Path):
+        with open(path, "rb", buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                # Doubles the readahead window of the kernel for this file
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            buffer = bytearray(self.chunk_size)
+            while not self.stop_event.is_set():
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                self.bytes_read += n
+
+    def run(self, paths:list):
+        start = time.perf_counter()
+        for path in paths:
+            if self.stop_event.is_set():
+                break
+            try:
+                self.prewarm_file(path)
+            except Exception as ex:
+                trace_exception(ex)
+        self.duration = time.perf_counter()-start
+        state = "stopped" if self.stop_event.is_set() else "done"
+        ASCIIColors.info(f"Page cache prewarm {state}: {self.bytes_read/(1<<30):.2f} GiB read in {self.duration:.2f}s ({self.bytes_read/(1<<20)/max(self.duration, 1e-6):.0f} MiB/s)")
+
+    def start(self, paths:list, background:bool=True):
+        """
+        Starts reading the files. The files that don't fit in the available memory are not read, they would
+        only evict each other from the page cache.
+        """
+        self.stop()
+        paths = [Path(path) for path in paths if path is not None]
+        total_size = sum(path.stat().st_size for path in paths)
+        memory = available_memory()
+        if memory is not None and total_size>memory:
+            ASCIIColors.warning(f"Not prewarming {', '.join(path.name for path in paths)}: {total_size/(1<<30):.2f} GiB don't fit in the {memory/(1<<30):.2f} GiB of available memory")
+            return False
+        self.stop_event = threading.Event()
+        self.bytes_read = 0
+        if background:
+            self.thread = threading.Thread(target=self.run, args=(paths,), daemon=True)
+            self.thread.start()
+        else:
+            self.run(paths)
+        return True
+
+    def wait(self, timeout:float=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class LlamaServerWorkerPool:
+    """
+    Runs llama.cpp server processes over the same gguf file and dispatches the requests to the least busy one.
+    The weights are memory mapped so the workers share the same pages, each worker serves several requests
+    at once through its --parallel slots and can be pinned to its own set of cores.
+    A supervisor thread restarts the workers that die.
+    """
+    def __init__(self,
+                 executable:str,
+                 model_path:Path,
+                 n_workers:int=1,
+                 n_parallel:int=4,
+                 base_port:int=8181,
+                 n_ctx:int=4096,
+                 n_threads:int=8,
+                 n_batch:int=512,
+                 n_ubatch:int=512,
+                 n_gpu_layers:int=0,
+                 mmproj_path:Path=None,
+                 kv_cache_type:str="f16",
+                 pin_threads:bool=True,
+                 log_dir:Path=None,
+                 host:str="127.0.0.1",
+                 mlock:bool=False,
+                 numa:str="off"):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.executable = executable
+        self.model_path = model_path
+        self.n_parallel = n_parallel
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self.n_batch = n_batch
+        self.n_ubatch = n_ubatch
+        self.n_gpu_layers = n_gpu_layers
+        self.mmproj_path = mmproj_path
+        self.kv_cache_type = kv_cache_type
+        self.log_dir = log_dir
+        self.mlock = mlock
+        self.numa = numa
+        self.flash_attn_command = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.supervisor = None
+        # Keep one connection per slot alive instead of opening a connection per request
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=n_workers, pool_maxsize=n_workers*n_parallel))
+        cores = self.split_cores(n_workers) if pin_threads else [None]*n_workers
+        self.workers = [
+            {"id":i, "url":f"http://{host}:{base_port+i}", "host":host, "port":base_port+i, "cores":cores[i], "process":None, "active":0, "ready":False}
+            for i in range(n_workers)
+        ]
+
+    @staticmethod
+    def split_cores(n_workers:int):
+        """Splits the cores this process may run on into one contiguous set per worker"""
+        if not hasattr(os, "sched_getaffinity"):
+            return [None]*n_workers
+        cores = sorted(os.sched_getaffinity(0))
+        size = len(cores)//n_workers
+        if size==0:
+            return [None]*n_workers
+        return [cores[i*size:(i+1)*size] if i<n_workers-1 else cores[i*size:] for i in range(n_workers)]
+
+    def command(self, worker:dict):
+        n_threads = len(worker["cores"]) if worker["cores"] else self.n_threads
+        command = [
+            self.executable,
+            "--model", str(self.model_path),
+            "--host", worker["host"],
+            "--port", str(worker["port"]),
+            "--parallel", str(self.n_parallel),
+            # The context is shared by the slots
+            "--ctx-size", str(self.n_ctx*self.n_parallel),
+            "--threads", str(n_threads),
+            "--batch-size", str(self.n_batch),
+            "--ubatch-size", str(self.n_ubatch),
+            "--n-gpu-layers", str(self.n_gpu_layers),
+        ]
+        if self.mmproj_path is not None:
+            command += ["--mmproj", str(self.mmproj_path)]
+        if self.kv_cache_type!="f16":
+            # The quantized V cache requires flash attention
+            command += ["--cache-type-k", self.kv_cache_type, "--cache-type-v", self.kv_cache_type] + self.flash_attn_args()
+        if self.mlock:
+            command += ["--mlock"]
+        if self.numa!="off":
+            command += ["--numa", self.numa]
+        return command
+
+    def flash_attn_args(self):
+        """
+        Returns the arguments turning flash attention on. Recent llama-server builds take a value
+        (--flash-attn on|off|auto), older builds take a bare flag. The help of the executable tells which one it is.
+        """
+        if self.flash_attn_command is None:
+            try:
+                result = subprocess.run([self.executable, "--help"], capture_output=True, text=True, timeout=30)
+                help_text = result.stdout + result.stderr
+            except Exception as ex:
+                trace_exception(ex)
+                help_text = ""
+            flash_attn_help = next((line for line in help_text.splitlines() if "--flash-attn" in line), None)
+            if flash_attn_help is not None and "on|off" not in flash_attn_help and "'on'" not in flash_attn_help:
+                self.flash_attn_command = ["--flash-attn"]
+            else:
+                # The current syntax is used when the help can't be read
+                self.flash_attn_command = ["--flash-attn", "on"]
+        return self.flash_attn_command
+
+    def start_worker(self, worker:dict):
+        command = self.command(worker)
+        ASCIIColors.info(f"Starting llama.cpp server worker {worker['id']}" + (f" on cores {worker['cores']}" if worker["cores"] else "") + f": {' '.join(command)}")
+        log = subprocess.DEVNULL
+        if self.log_dir is not None:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            log = open(self.log_dir / f"worker_{worker['id']}.log", "ab")
+        cores = worker["cores"]
+        worker["ready"] = False
+        worker["process"] = subprocess.Popen(
+                                command,
+                                stdout=log,
+                                stderr=subprocess.STDOUT,
+                                preexec_fn=(lambda: os.sched_setaffinity(0, cores)) if cores else None
+                            )
+        if log is not subprocess.DEVNULL:
+            log.close()
+
+    def wait_ready(self, worker:dict, timeout:float=600):
+        start = time.perf_counter()
+        while time.perf_counter()-start < timeout:
+            if worker["process"].poll() is not None:
+                raise RuntimeError(f"llama.cpp server worker {worker['id']} exited with code {worker['process'].returncode}" + (f", see {self.log_dir / ('worker_'+str(worker['id'])+'.log')}" if self.log_dir else ""))
+            try:
+                if self.session.get(worker["url"]+"/health", timeout=5).status_code==200:
+                    worker["ready"] = True
+                    return
+            except Exception:
+                pass
+            time.sleep(0.5)
+        raise TimeoutError(f"llama.cpp server worker {worker['id']} didn't get ready in {timeout}s")
+
+    def start(self):
+        for worker in self.workers:
+            self.start_worker(worker)
+        for worker in self.workers:
+            self.wait_ready(worker)
+        self.supervisor = threading.Thread(target=self.supervise, name="llama_cpp_server_supervisor", daemon=True)
+        self.supervisor.start()
+
+    def supervise(self):
+        while not self.stopped.wait(5):
+            for worker in self.workers:
+                if self.stopped.is_set():
+                    return
+                if worker["process"].poll() is not None:
+                    ASCIIColors.warning(f"llama.cpp server worker {worker['id']} exited with code {worker['process'].returncode}, restarting it")
+                    try:
+                        self.start_worker(worker)
+                        self.wait_ready(worker)
+                    except Exception as ex:
+                        trace_exception(ex)
+
+    def stop(self):
+        self.stopped.set()
+        for worker in self.workers:
+            worker["ready"] = False
+            if worker["process"] is not None and worker["process"].poll() is None:
+                worker["process"].terminate()
+        for worker in self.workers:
+            if worker["process"] is not None:
+                try:
+                    worker["process"].wait(10)
+                except subprocess.TimeoutExpired:
+                    worker["process"].kill()
+        self.session.close()
+
+    def acquire(self):
+        with self.lock:
+            workers = [w for w in self.workers if w["ready"]] or self.workers
+            worker = min(workers, key=lambda w: w["active"])
+            worker["active"] += 1
+            return worker
+
+    def release(self, worker:dict):
+        with self.lock:
+            worker["active"] -= 1
+
+    def post(self, path:str, data:dict):
+        worker = self.acquire()
+        try:
+            response = self.session.post(worker["url"]+path, json=data, timeout=60)
+            response.raise_for_status()
+            return response.json()
+        finally:
+            self.release(worker)
+
+    def stream(self, path:str, data:dict, get_text:Callable, callback:Callable=None):
+        """
+        Posts a streamed request to the least busy worker and forwards the server sent events to the callback.
+        Closing the connection when the callback returns False stops the generation on the server side.
+        """
+        worker = self.acquire()
+        output = ""
+        try:
+            with self.session.post(worker["url"]+path, json=data, stream=True, timeout=600) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith(b"data: "):
+                        continue
+                    if line[6:].strip()==b"[DONE]":
+                        break
+                    chunk = json.loads(line[6:])
+                    word, done = get_text(chunk)
+                    if word:
+                        output += word
+                        if callback is not None:
+                            if not callback(word, MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
+                                break
+                    if done:
+                        break
+        finally:
+            self.release(worker)
+        return output
+
+    def completion(self, prompt:str, n_predict:int, params:dict, stop:list, callback:Callable=None):
+        data = {
+            "prompt":prompt,
+            "n_predict":n_predict,
+            "stream":True,
+            "stop":stop,
+            "cache_prompt":True,
+            **params
+        }
+        return self.stream("/completion", data, lambda chunk: (chunk.get("content", ""), chunk.get("stop", False)), callback)
+
+    def chat_completion(self, messages:list, n_predict:int, params:dict, stop:list, callback:Callable=None):
+        data = {
+            "messages":messages,
+            "max_tokens":n_predict,
+            "stream":True,
+            "stop":stop,
+            "cache_prompt":True,
+            **params
+        }
+        def get_text(chunk):
+            choice = chunk["choices"][0]
+            return choice.get("delta", {}).get("content") or "", choice.get("finish_reason") is not None
+        return self.stream("/v1/chat/completions", data, get_text, callback)
+
+    def tokenize(self, text:str):
+        return self.post("/tokenize", {"content":text, "add_special":True})["tokens"]
+
+    def detokenize(self, tokens:list):
+        return self.post("/detokenize", {"tokens":tokens})["content"]
+
+
+def image_to_data_uri(image_path):
+    """Reads an image file into a base64 data URI"""
+    import base64
+    import mimetypes
+    image_path = Path(image_path)
+    mime_type = mimetypes.guess_type(image_path.name)[0] or "image/png"
+    with open(image_path, "rb") as f:
+        return f"data:{mime_type};base64,{base64.b64encode(f.read()).decode('ascii')}"
+
+
+def cached_image_embed_handler(handler_class):
+    """
+    Builds a llava chat handler class that keeps the image embeddings computed by the projector in a LRU
+    keyed by the sha256 of the image bytes and bounded by memory, so that follow up questions about an image
+    of the discussion don't run the vision encoder again. The evicted embeddings are freed.
+    """
+    class CachedImageEmbedChatHandler(handler_class):
+        def __init__(self, *args, embed_cache_capacity:int=512*(1<<20), **kwargs):
+            super().__init__(*args, **kwargs)
+            self.embed_cache = OrderedDict()
+            self.embed_cache_capacity = embed_cache_capacity
+            self.embed_cache_size = 0
+            # Size of the embedding of one image position, set by the binding once the model is loaded
+            self.n_embd = 4096
+            self.hits = 0
+            self.misses = 0
+            self._exit_stack.callback(self.clear_embed_cache)
+
+        def _embed_image_bytes(self, image_bytes:bytes, n_threads_batch:int=1):
+            import ctypes
+            key = hashlib.sha256(image_bytes).hexdigest()
+            cached = self.embed_cache.get(key)
+            if cached is not None:
+                self.embed_cache.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+            start = time.perf_counter()
+            embed = self._llava_cpp.llava_image_embed_make_with_bytes(
+                self.clip_ctx,
+                n_threads_batch,
+                (ctypes.c_uint8 * len(image_bytes)).from_buffer(bytearray(image_bytes)),
+                len(image_bytes),
+            )
+            ASCIIColors.info(f"Image encoded in {time.perf_counter()-start:.2f}s")
+            size = embed.contents.n_image_pos * self.n_embd * 4
+            self.embed_cache[key] = (embed, size)
+            self.embed_cache_size += size
+            # The image being evaluated is never evicted
+            while self.embed_cache_size > self.embed_cache_capacity and len(self.embed_cache)>1:
+                _, (old_embed, old_size) = self.embed_cache.popitem(last=False)
+                self._llava_cpp.llava_image_embed_free(old_embed)
+                self.embed_cache_size -= old_size
+            return embed
+
+        def clear_embed_cache(self):
+            for embed, _ in self.embed_cache.values():
+                self._llava_cpp.llava_image_embed_free(embed)
+            self.embed_cache.clear()
+            self.embed_cache_size = 0
+
+        def summary(self):
+            return f"Image embeddings cache: {self.hits} hits, {self.misses} misses, {len(self.embed_cache)} images ({self.embed_cache_size/(1<<20):.1f}/{self.embed_cache_capacity/(1<<20):.1f} MiB)"
+
+    CachedImageEmbedChatHandler.__name__ = f"Cached{handler_class.__name__}"
+    return CachedImageEmbedChatHandler
+
+
 class LLAMA_Python_CPP(LLMBinding):
     def __init__(self, 
                 config: LOLLMSConfig, 
@@ -81,6 +1505,27 @@ class LLAMA_Python_CPP(LLMBinding):
             installation_option (InstallOption, optional): The installation option for LOLLMS. Defaults to InstallOption.INSTALL_IF_NECESSARY.
         """
         self.model = None
+        self.prompt_cache = None
+        self.draft_model = None
+        self.chat_handler = None
+        self.model_pool = LlamaModelPool()
+        self.pool_key = None
+        self.model_lock = threading.RLock()
+        self.model_loader = BackgroundModelLoader("llama_cpp_loader")
+        self.embedding_model = None
+        self.embedding_lock = threading.Lock()
+        self.embedding_cache = None
+        self.embedding_key = None
+        self.server_pool = None
+        self.catalog = None
+        self.kv_cache_type = "f16"
+        self.tuning_profiles = None
+        self.grammar_cache = LlamaGrammarCache()
+        self.lora_registry = None
+        self.context_shift_state = None
+        self.context_shift_stats = None
+        self.prewarmer = PageCachePrewarmer()
+        self.time_to_ready = {}
         
         self.config = config
         if lollms_paths is None:
@@ -89,17 +1534,45 @@ class LLAMA_Python_CPP(LLMBinding):
         # Initialization code goes here
         binding_config_template = ConfigTemplate([
             {"name":"n_threads","type":"int","value":8, "min":1},
+            {"name":"autotune","type":"str","value":"apply", "options":["off","apply","tune"], "help":"Use the n_threads, n_threads_batch and batch_size measured for the model on this machine instead of n_threads and batch_size.\napply uses the profiles measured before (with python_llama_cpp/autotune.py), tune also measures the models that have no profile yet when they are loaded (this takes a few minutes)"},
             {"name":"generation_mode","type":"str","value":"instruct", "options":["chat","instruct"], "help":"generation mode can be either chat or instruct.\nChat is good but doesn't allow cooperative mode or playground use. Instruct may be subject to halucination with bad models but allow more flexibility"},
             {"name":"n_gpu_layers","type":"int","value":-1 if config.hardware_mode=="nvidia" or  config.hardware_mode=="nvidia-tensorcores" or  config.hardware_mode=="amd" or  config.hardware_mode=="amd-noavx" else 0, "min":-1},
             {"name":"main_gpu","type":"int","value":0, "help":"If you have more than one gpu you can select the gpu to be used here"},
             {"name":"offload_kqv","type":"bool","value":False if 'cpu' in self.config.hardware_mode or 'apple' in self.config.hardware_mode else True, "help":"If you have more than one gpu you can select the gpu to be used here"},
-            {"name":"cache_capacity","type":"int","value":(2 << 30) , "help":"The size of the cache in bytes"},            
+            {"name":"cache_backend","type":"str","value":"ram", "options":["none","ram","disk","snapshots"], "help":"Where to keep the evaluated prompts states so that a discussion that shares its beginning with a previous one does not have to be evaluated again.\nram is the fastest, disk survives restarts and is stored in the personal models folder.\nsnapshots keeps one memory mapped state per discussion on disk, which allows many discussions to share the same model without being evaluated again when switching between them"},
+            {"name":"cache_capacity","type":"int","value":(2 << 30) , "help":"The size of the cache in bytes. When full, the least recently used states are removed"},
             {"name":"batch_size","type":"int","value":512, "min":1, "help":"The batch size (the bigger the less warmup time)"},
+            {"name":"load_profile","type":"str","value":"mmap", "options":["mmap","prewarm","mlock"], "help":"How the model file is brought in memory.\nmmap maps the file and reads the weights when they are first used (fast start, the first generations of a model that is not in the page cache are slow).\nprewarm also reads the whole file sequentially on a background thread while the model loads, so the weights are in the page cache before they are used.\nmlock reads the whole file and locks it in memory so that it is never paged out (the memory lock limit of the system must allow it)"},
+            {"name":"numa","type":"str","value":"off", "options":["off","distribute","isolate","numactl"], "help":"NUMA strategy of llama.cpp on multi socket machines. distribute spreads the threads and memory over all the nodes, isolate keeps them on the node lollms started on, numactl follows the numactl cpu map. This is set once per process"},
+            {"name":"prewarm_on_install","type":"bool","value":False, "help":"Read the models into the page cache right after they are downloaded so that their first use doesn't pay for cold disk reads"},
+            {"name":"speculative_mode","type":"str","value":"off", "options":["off","prompt_lookup","draft_model"], "help":"Speculative decoding proposes several tokens at once that the model verifies in a single pass.\nprompt_lookup drafts tokens by looking up the last generated words in the prompt (good for code edition and rewriting).\ndraft_model uses a small gguf model sharing the vocabulary of the main model"},
+            {"name":"draft_model_name","type":"str","value":"", "help":"Name of the small gguf model (from the gguf models folder) to use as draft model when speculative_mode is draft_model"},
+            {"name":"num_draft_tokens","type":"int","value":10, "min":1, "help":"Number of tokens drafted at each speculative decoding step"},
+            {"name":"grammar_cache_capacity","type":"int","value":32, "min":1, "help":"Number of grammars (grammar or json_schema generation parameters) kept in memory with their json schema already converted to GBNF"},
+            {"name":"batch_max_sequences","type":"int","value":8, "min":1, "help":"Maximum number of prompts decoded together by generate_batch. The prompts and their generations must also fit in the context size. generate_batch builds a context of the same size for the batch, its KV cache is freed at the end"},
             {"name":"ctx_size","type":"int","value":4090, "min":512, "help":"The current context size (it depends on the model you are using). Make sure the context size if correct or you may encounter bad outputs."},
+            {"name":"kv_cache_budget","type":"int","value":0, "min":0, "help":"Memory in bytes given to the KV cache. When set, the context size is computed from the model shape to be the largest one that fits in this budget (up to the training context of the model). 0 uses ctx_size"},
+            {"name":"kv_cache_type","type":"str","value":"f16", "options":["f16","q8_0","q4_0","auto"], "help":"Precision of the keys and values kept for the context. q8_0 halves the memory with almost no quality loss, q4_0 divides it by almost 4. auto picks the most precise type that reaches the largest context in kv_cache_budget. The quantized types use flash attention"},
             {"name":"max_n_predict","type":"int","value":4090, "min":512, "help":"The maximum amount of tokens to generate"},
+            {"name":"context_shift","type":"bool","value":True, "help":"When a prompt doesn't fit in the context anymore (keeping room for at least 256 generated tokens), drop its oldest messages from the evaluated context and move the following ones back in place instead of failing. A prompt that fits is never cut, the generation is shortened to the room left instead. The next messages of the discussion reuse the shifted context without evaluating it again"},
+            {"name":"context_shift_keep","type":"int","value":-1, "min":-1, "help":"Number of tokens at the beginning of the prompt that are never dropped by the context shift. -1 keeps the system prompt (everything before the second message header)"},
             {"name":"seed","type":"int","value":-1,"help":"Random numbers generation seed allows you to fix the generation making it dterministic. This is useful for repeatability. To make the generation random, please set seed to -1."},
-            {"name":"lora_path","type":"str","value":"","help":"Path to a lora file to apply to the model."},
+            {"name":"lora_path","type":"str","value":"","help":"Path to a lora file to apply to the model.\nPersonalities can select other adapters with the lora generation parameter (a name, a list of names or a name to scale dictionary). Adapters are searched in the personal models lora folder. They are attached to the loaded model without reloading it"},
             {"name":"lora_scale","type":"float","value":1.0,"help":"Scaling to apply to the lora."},
+            {"name":"image_embed_cache_capacity","type":"int","value":512*(1<<20), "min":0, "help":"Memory in bytes kept for the projected images of vision models, so that follow up questions about an image don't encode it again"},
+            {"name":"embedding_context","type":"bool","value":True, "help":"Compute the embeddings on a dedicated context built in embedding mode instead of the generation context (the generation context can only compute embeddings if it was built in embedding mode)"},
+            {"name":"embedding_cache_capacity","type":"int","value":10000, "min":0, "help":"Number of embeddings kept in memory, indexed by the hash of the text"},
+            {"name":"embedding_disk_cache_capacity","type":"int","value":0, "min":0, "help":"Number of embeddings kept on disk in the personal models folder so that indexing unchanged documents again is free. The file is allocated for all of them on first use (capacity x embedding size x 4 bytes). 0 deactivates the disk cache"},
+            {"name":"model_pool_budget","type":"int","value":0, "min":0, "help":"Size in bytes of the models that can stay loaded at the same time. Switching to a model that is still loaded is instantaneous. When the budget is exceeded the least recently used models are unloaded. 0 keeps only the current model loaded"},
+            {"name":"background_loading","type":"bool","value":False, "help":"Load new models in the background. The current model keeps answering until the new one is ready"},
+            {"name":"warmup","type":"bool","value":True, "help":"Run a short test completion after loading a model"},
+            {"name":"pinned_models","type":"str","value":"", "help":"Comma separated list of model names that are never unloaded from the models pool"},
+            {"name":"server_mode","type":"bool","value":False, "help":"Serve the model with llama.cpp server processes instead of loading it in lollms. Concurrent users are served in parallel instead of waiting for each other"},
+            {"name":"server_executable","type":"str","value":"llama-server", "help":"Path to the llama.cpp server executable used in server mode"},
+            {"name":"server_workers","type":"int","value":1, "min":1, "help":"Number of llama.cpp server processes. They share the memory mapped model file. Use one worker per socket on multi socket machines"},
+            {"name":"server_parallel","type":"int","value":4, "min":1, "help":"Number of requests each server process generates at the same time (each slot gets its own ctx_size context)"},
+            {"name":"server_base_port","type":"int","value":8181, "min":1, "help":"Port of the first server process, the next ones use the following ports"},
+            {"name":"server_pin_threads","type":"bool","value":True, "help":"Pin each server process to its own set of cores (linux only)"},
         ])
         binding_config_vals = BaseConfig.from_template(binding_config_template)
 
@@ -123,9 +1596,16 @@ class LLAMA_Python_CPP(LLMBinding):
     def settings_updated(self):
         self.config.ctx_size=self.binding_config.config.ctx_size
         self.config.max_n_predict=self.binding_config.max_n_predict
+        # The loaded models were built with the previous settings. The model in use keeps serving until the
+        # next build_model and is not reused from the pool
+        with self.model_lock:
+            self.model_pool.clear(keep=[self.pool_key])
+            self.model_pool.forget(self.pool_key)
         
 
     def __del__(self):
+        if self.server_pool is not None:
+            self.server_pool.stop()
         if self.model:
             del self.model
 
@@ -135,10 +1615,6 @@ class LLAMA_Python_CPP(LLMBinding):
         super().build_model(model_name)
         self.config.ctx_size=self.binding_config.config.ctx_size
         self.config.max_n_predict=self.binding_config.max_n_predict
-        if self.model:
-            ASCIIColors.yellow("A model is already loaded. Unloading it")
-            self.model = None
-            gc.collect()
 
         try:
             import llama_cpp
@@ -157,69 +1633,605 @@ class LLAMA_Python_CPP(LLMBinding):
         if not model_path:
             self.model = None
             return None
-        
+
+        model_info = self.get_catalog().get(model_path) if model_path.suffix==".gguf" else None
+        if model_info is not None:
+            if not model_info["valid"]:
+                self.InfoMessage(f"The model file {model_path.name} is not a valid gguf file:\n{model_info['error']}\nPlease download it again")
+                self.model = None
+                return None
+            if model_info["is_mmproj"]:
+                self.InfoMessage(f"{model_path.name} is a projector file, not a model.\nPlease select the model that goes with it")
+                self.model = None
+                return None
+            if model_info["context_length"] and self.config.ctx_size>model_info["context_length"]:
+                ASCIIColors.warning(f"The context size ({self.config.ctx_size}) is bigger than the training context of the model ({model_info['context_length']}). Using {model_info['context_length']}")
+                self.config.ctx_size = model_info["context_length"]
+            ASCIIColors.info(f"Model: {model_info['architecture']} {model_info['file_type']}, {model_info['tensor_bytes']/(1<<30):.2f} GiB of weights, trained with a context of {model_info['context_length']} tokens")
+        self.plan_kv_cache(model_info)
+
+        # The LoRA adapters are attached at request time, they don't need another copy of the model
+        pool_key = (str(model_path), self.config.ctx_size, self.binding_config.n_gpu_layers, self.kv_cache_type)
+        if self.server_pool is not None:
+            ASCIIColors.yellow("Stopping the llama.cpp server workers")
+            self.server_pool.stop()
+            self.server_pool = None
+            self.model = None
+        if self.binding_config.server_mode:
+            return self.build_server_pool(model_path, pool_key)
+        pinned = set()
+        for pinned_model in self.binding_config.pinned_models.split(","):
+            pinned_path = self.find_model_file(pinned_model.strip()) if pinned_model.strip()!="" else None
+            if pinned_path is not None:
+                pinned.add(str(pinned_path))
+        with self.model_pool.lock:
+            self.model_pool.budget_bytes = self.binding_config.model_pool_budget
+            self.model_pool.pinned = pinned
+        entry = self.model_pool.get(pool_key)
+        if entry is not None:
+            self.swap_model(pool_key, entry)
+            self.model_loader.set_ready(self)
+            ASCIIColors.success(f"Model {model_path.name} is already loaded")
+            return self
+
+        if self.binding_config.background_loading:
+            # The current model keeps serving the requests until the new one is ready
+            future = self.model_loader.submit(partial(self.load_model, llama_cpp, model_path, pool_key), lambda entry: self.swap_model(pool_key, entry) or self)
+            future.add_done_callback(lambda f: f.exception() is not None and self.error(f"Couldn't load the model {model_path.name}:\n{f.exception()}"))
+            return self
+
+        if self.model:
+            if self.model_pool.budget_bytes<=0:
+                ASCIIColors.yellow("A model is already loaded. Unloading it")
+            self.unload_model(close=self.model_pool.budget_bytes<=0)
+        try:
+            entry = self.load_model(llama_cpp, model_path, pool_key)
+        except Exception as ex:
+            self.model_loader.set_failed(ex)
+            raise ex
+        self.swap_model(pool_key, entry)
+        self.model_loader.set_ready(self)
+        return self
+
+    def unload_model(self, close:bool=False):
+        """
+        Stops using the current model, waiting for the running generation to finish.
+        With close, all the models of the pool are unloaded in the same critical section.
+        """
+        with self.model_lock:
+            if close:
+                self.model_pool.clear()
+            self.model = None
+            self.chat_handler = None
+            self.draft_model = None
+            self.prompt_cache = None
+            self.lora_registry = None
+            self.pool_key = None
+        gc.collect()
+
+    def plan_kv_cache(self, model_info:dict):
+        """
+        Sets the context size and the KV cache type of the next model from kv_cache_budget.
+        In server mode the budget is shared by all the slots of all the workers.
+        """
+        self.kv_cache_type = self.binding_config.kv_cache_type if self.binding_config.kv_cache_type!="auto" else "f16"
+        if self.binding_config.kv_cache_budget<=0 or model_info is None:
+            return
+        n_sequences = self.binding_config.server_workers*self.binding_config.server_parallel if self.binding_config.server_mode else 1
+        plan = plan_kv_cache(model_info, self.binding_config.kv_cache_budget, self.binding_config.kv_cache_type, n_sequences)
+        if plan is None:
+            ASCIIColors.warning(f"The KV cache budget can't be applied to this model (unknown attention shape or budget too small). Using a context of {self.config.ctx_size} tokens")
+            return
+        n_ctx, self.kv_cache_type, kv_bytes = plan
+        self.config.ctx_size = n_ctx
+        ASCIIColors.info(f"KV cache plan: {n_ctx} tokens of context with {self.kv_cache_type} keys and values ({kv_bytes/(1<<30):.2f}/{self.binding_config.kv_cache_budget/(1<<30):.2f} GiB)")
+
+    def get_tuning(self, model_path:Path):
+        """
+        Returns the threads and batch settings to load the model with: the tuning profile of the model on this host
+        when there is one (measuring it first in tune mode), the binding settings otherwise.
+        """
+        # 512 is the physical batch size llama.cpp uses by default
+        tuning = {"n_threads":self.binding_config.n_threads, "n_threads_batch":self.binding_config.n_threads, "n_batch":self.binding_config.batch_size, "n_ubatch":512}
+        if self.binding_config.autotune=="off":
+            return tuning
+        if self.tuning_profiles is None:
+            self.tuning_profiles = LlamaTuningProfiles(self.lollms_paths.personal_models_path / "llama_cpp_cache" / "autotune_profiles.json")
+        profile = self.tuning_profiles.get(model_path, self.binding_config.n_gpu_layers)
+        if profile is None and self.binding_config.autotune=="tune":
+            self.report_load_progress(f"Measuring the best threads and batch settings for {model_path.name}")
+            try:
+                profile = autotune_llama_cpp(model_path, self.binding_config.n_gpu_layers, callback=self.report_load_progress)
+                self.tuning_profiles.put(model_path, self.binding_config.n_gpu_layers, profile)
+            except Exception as ex:
+                trace_exception(ex)
+                self.warning(f"Couldn't measure the best settings for {model_path.name}:\n{ex}")
+        if profile is not None:
+            tuning = {k:profile[k] for k in ["n_threads", "n_threads_batch", "n_batch"]}
+            # The profile was measured with physical batches as large as the logical ones
+            tuning["n_ubatch"] = tuning["n_batch"]
+            ASCIIColors.info(f"Tuning profile: {tuning['n_threads']} threads, {tuning['n_threads_batch']} prompt threads, batch of {tuning['n_batch']} ({profile['prompt_tokens_per_s']:.1f} prompt tokens/s, {profile['decode_tokens_per_s']:.1f} tokens/s)")
+        return tuning
+
+    def build_server_pool(self, model_path:Path, pool_key):
+        """
+        Starts the llama.cpp server workers for the model. The model is not loaded in lollms itself.
+        """
+        self.unload_model(close=True)
         self.binding_type = BindingType.TEXT_ONLY
+        mmproj_path = self.find_mmproj(model_path)
+        if mmproj_path is not None:
+            self.binding_type = BindingType.TEXT_IMAGE
+        tuning = self.get_tuning(model_path)
+        server_pool = LlamaServerWorkerPool(
+                                self.binding_config.server_executable,
+                                model_path,
+                                n_workers=self.binding_config.server_workers,
+                                n_parallel=self.binding_config.server_parallel,
+                                base_port=self.binding_config.server_base_port,
+                                n_ctx=self.config.ctx_size,
+                                n_threads=tuning["n_threads"],
+                                n_batch=tuning["n_batch"],
+                                n_ubatch=tuning["n_ubatch"],
+                                n_gpu_layers=self.binding_config.n_gpu_layers,
+                                mmproj_path=mmproj_path,
+                                kv_cache_type=self.kv_cache_type,
+                                pin_threads=self.binding_config.server_pin_threads,
+                                log_dir=self.lollms_paths.personal_models_path / "llama_cpp_cache" / "server_logs",
+                                mlock=self.binding_config.load_profile=="mlock",
+                                numa=self.binding_config.numa
+                            )
+        load_start = time.perf_counter()
+        model_size = model_path.stat().st_size + (mmproj_path.stat().st_size if mmproj_path is not None else 0)
+        self.start_load_profile(model_size, [model_path, mmproj_path])
+        self.report_load_progress(f"Starting {self.binding_config.server_workers} llama.cpp server worker(s) for {model_path.name}")
+        try:
+            server_pool.start()
+        except Exception as ex:
+            server_pool.stop()
+            self.model_loader.set_failed(ex)
+            trace_exception(ex)
+            self.InfoMessage(f"Couldn't start the llama.cpp server:\n{ex}\nMake sure that server_executable points to a llama.cpp server executable")
+            return None
+        with self.model_lock:
+            self.server_pool = server_pool
+            # The worker pool stands for the model
+            self.model = server_pool
+            self.pool_key = pool_key
+        self.model_loader.set_ready(self)
+        ASCIIColors.success(f"llama.cpp server workers ready in {time.perf_counter()-load_start:.2f}s")
+        self.record_time_to_ready(model_path, time.perf_counter()-load_start)
+        return self
+
+    def load_model(self, llama_cpp, model_path:Path, pool_key):
+        """
+        Loads a model with its chat handler, draft model and prompt cache without touching the model currently in use.
+
+        Returns:
+            dict: The loaded model entry, ready to be swapped in
+        """
+        load_start = time.perf_counter()
+        self.report_load_progress(f"Loading {model_path.name}")
+        binding_type = BindingType.TEXT_ONLY
+        chat_handler = None
+        tuning = self.get_tuning(model_path)
+        model_params = dict(
+                                model_path=str(model_path), 
+                                n_gpu_layers=self.binding_config.n_gpu_layers, 
+                                main_gpu=self.binding_config.main_gpu, 
+                                n_ctx=self.config.ctx_size,
+                                n_threads=tuning["n_threads"],
+                                n_threads_batch=tuning["n_threads_batch"],
+                                n_batch=tuning["n_batch"],
+                                n_ubatch=tuning["n_ubatch"],
+                                offload_kqv=self.binding_config.offload_kqv,
+                                seed=self.binding_config.seed,
+                                use_mlock=self.binding_config.load_profile=="mlock",
+                                numa=self.numa_strategy(llama_cpp),
+                            )
+        if self.kv_cache_type!="f16":
+            # The quantized V cache requires flash attention
+            model_params["type_k"] = KV_CACHE_TYPES[self.kv_cache_type][0]
+            model_params["type_v"] = KV_CACHE_TYPES[self.kv_cache_type][0]
+            model_params["flash_attn"] = True
+
+        model_size = model_path.stat().st_size
+        proj_file = self.find_mmproj(model_path)
+        if proj_file is not None:
+            model_size += proj_file.stat().st_size
+            binding_type = BindingType.TEXT_IMAGE
+            self.report_load_progress(f"Loading projector {proj_file.name}")
+            chat_handler = cached_image_embed_handler(llama_cpp.llama_chat_format.Llava15ChatHandler)(clip_model_path=str(proj_file), embed_cache_capacity=self.binding_config.image_embed_cache_capacity)
+            model_params["chat_handler"] = chat_handler
+            model_params["logits_all"] = True
 
+        draft_model = self.build_draft_model(llama_cpp, model_path)
+        model_params["draft_model"] = draft_model
+        if draft_model is not None and isinstance(draft_model.draft_model, GGUFDraftModel):
+            model_size += Path(draft_model.draft_model.model.model_path).stat().st_size
+        if self.model_pool.budget_bytes>0:
+            self.model_pool.make_room(model_size, keep=[self.pool_key])
+        self.start_load_profile(model_size, [model_path, proj_file])
+        self.report_load_progress(f"Loading weights of {model_path.name}")
+        model = llama_cpp.Llama(**model_params)
+        if draft_model is not None and isinstance(draft_model.draft_model, GGUFDraftModel):
+            if draft_model.draft_model.model.n_vocab()!=model.n_vocab():
+                self.InfoMessage("The draft model doesn't share the vocabulary of the main model.\nSpeculative decoding is deactivated")
+                draft_model = None
+                model.draft_model = None
+
+        if chat_handler is not None:
+            chat_handler.n_embd = model.n_embd()
+        lora_registry = LlamaLoraRegistry(model)
+        lora_registry.default = self.lora_selection({})
+        lora_registry.apply(lora_registry.default)
+        prompt_cache = self.setup_prompt_cache(llama_cpp, model, model_path)
+        load_time = time.perf_counter()-load_start
+        if self.binding_config.warmup:
+            self.report_load_progress("Warming up")
+            warmup_start = time.perf_counter()
+            output = model.create_completion("question: What is 1+1\nanswer:", max_tokens = 2)
+            ASCIIColors.info(f"Warmup completion took {time.perf_counter()-warmup_start:.2f}s ({output['choices'][0]['text']!r})")
+        self.record_time_to_ready(model_path, time.perf_counter()-load_start)
+        entry = {
+            "model":model,
+            "chat_handler":chat_handler,
+            "binding_type":binding_type,
+            "draft_model":draft_model,
+            "prompt_cache":prompt_cache,
+            "lora_registry":lora_registry,
+            "size":model_size
+        }
+        if self.model_pool.budget_bytes>0:
+            self.model_pool.add(pool_key, entry, keep=[self.pool_key])
+            ASCIIColors.info(f"Models pool: {len(self.model_pool)} model(s) loaded, {self.model_pool.total_size/(1<<30):.2f}/{self.model_pool.budget_bytes/(1<<30):.2f} GiB")
+        ASCIIColors.success(f"Model built in {load_time:.2f}s")
+        return entry
+
+    def swap_model(self, pool_key, entry:dict):
+        """
+        Installs a loaded model entry as the current model.
+        The swap waits for the running generation to finish.
+        """
+        with self.model_lock:
+            self.model = entry["model"]
+            self.chat_handler = entry["chat_handler"]
+            self.binding_type = entry["binding_type"]
+            self.draft_model = entry["draft_model"]
+            self.prompt_cache = entry["prompt_cache"]
+            self.lora_registry = entry["lora_registry"]
+            self.pool_key = pool_key
+        if self.model_pool.budget_bytes>0:
+            # The previous model was protected while it was serving, now it can be evicted if needed
+            self.model_pool.make_room(0, keep=[pool_key])
+        else:
+            gc.collect()
+        self.report_load_progress(f"Model {Path(pool_key[0]).name} ready")
+
+    def wait_for_model(self, timeout:float=None):
+        """Waits for a model being loaded in the background when there is no model to serve the request"""
+        if self.model is None:
+            self.model_loader.wait(timeout)
+
+    def request_lock(self):
+        """The server workers handle the concurrent requests themselves, the local model needs the model lock"""
+        return nullcontext() if self.server_pool is not None else self.model_lock
+
+    def numa_strategy(self, llama_cpp):
+        return {
+            "off":llama_cpp.GGML_NUMA_STRATEGY_DISABLED,
+            "distribute":llama_cpp.GGML_NUMA_STRATEGY_DISTRIBUTE,
+            "isolate":llama_cpp.GGML_NUMA_STRATEGY_ISOLATE,
+            "numactl":llama_cpp.GGML_NUMA_STRATEGY_NUMACTL,
+        }[self.binding_config.numa]
+
+    def start_load_profile(self, model_size:int, paths:list):
+        """Prepares the memory for the load profile before the model files are opened"""
+        # A prewarm of the previous model is useless now
+        self.prewarmer.stop()
+        load_profile = self.binding_config.load_profile
+        if load_profile=="prewarm":
+            self.prewarmer.start(paths)
+        elif load_profile=="mlock":
+            try:
+                import resource
+                soft_limit, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+                if soft_limit!=resource.RLIM_INFINITY and soft_limit<model_size:
+                    ASCIIColors.warning(f"The memory lock limit ({soft_limit/(1<<20):.0f} MiB) is smaller than the model ({model_size/(1<<20):.0f} MiB), the model may not be locked in memory. Raise it with ulimit -l")
+            except ImportError:
+                pass
+
+    def record_time_to_ready(self, model_path:Path, duration:float):
+        """Keeps the time to ready of each load profile so that they can be compared"""
+        load_profile = self.binding_config.load_profile
+        self.time_to_ready.setdefault(load_profile, []).append((model_path.name, duration))
+        ASCIIColors.success(f"{model_path.name} ready to generate in {duration:.2f}s with the {load_profile} load profile")
+        for profile, measures in self.time_to_ready.items():
+            same_model = [d for name, d in measures if name==model_path.name]
+            if profile!=load_profile and same_model:
+                ASCIIColors.info(f"  {profile} load profile: {min(same_model):.2f}s")
+
+    def download_model(self, url, model_name, callback = None):
+        super().download_model(url, model_name, callback)
+        self.get_catalog(refresh=True)
+        if self.binding_config.prewarm_on_install:
+            model_full_path = (self.searchModelFolder(model_name)/model_name)/str(url).split("/")[-1]
+            if model_full_path.exists():
+                ASCIIColors.info(f"Prewarming {model_full_path.name}")
+                PageCachePrewarmer().start([model_full_path])
+
+    def report_load_progress(self, text:str):
+        ASCIIColors.info(text)
+        if self.binding_config.background_loading:
+            self.notify(text, NotificationType.NOTIF_INFO)
+
+    def get_catalog(self, refresh:bool=False):
+        """
+        Returns the index of the installed gguf files. The models folders are scanned when the catalog is
+        first used and when refresh is set (after a download), otherwise the stored index is used and only
+        the files that are looked up are checked.
+        """
+        if self.catalog is None:
+            self.catalog = GGUFCatalog(
+                                [self.lollms_paths.personal_models_path / models_dir_name for models_dir_name in self.models_dir_names],
+                                self.lollms_paths.personal_models_path / "llama_cpp_cache" / "gguf_catalog.json"
+                            )
+            refresh = True
+        if refresh:
+            self.catalog.refresh()
+        return self.catalog
+
+    def find_mmproj(self, model_path:Path):
+        """
+        Returns the projector of a vision model. The projector is found by reading the headers of the
+        gguf files next to the model (the model name is only used for the non gguf files).
+        """
+        if model_path.suffix==".gguf":
+            return self.get_catalog().find_mmproj(model_path)
         if "llava" in self.config.model_name.lower() or "vision" in self.config.model_name.lower():
             mmproj_variants = [v for v in model_path.parent.iterdir() if "mmproj" in str(v)]
             if len(mmproj_variants)==0:
                 self.InfoMessage("Projector file was not found. Please download it first.\nReverting to text only")
-
-                self.model = llama_cpp.Llama(
-                                        model_path=str(model_path), 
-                                        n_gpu_layers=self.binding_config.n_gpu_layers, 
-                                        main_gpu=self.binding_config.main_gpu, 
-                                        n_ctx=self.config.ctx_size,
-                                        n_threads=self.binding_config.n_threads,
-                                        n_batch=self.binding_config.batch_size,
-                                        offload_kqv=self.binding_config.offload_kqv,
-                                        seed=self.binding_config.seed,
-                                        lora_path=self.binding_config.lora_path if self.binding_config.lora_path!="" else None,
-                                        lora_scale=self.binding_config.lora_scale, 
-                                    )
-
             else:
-                proj_file = mmproj_variants[0]
-                self.binding_type = BindingType.TEXT_IMAGE
-                self.chat_handler = llama_cpp.llama_chat_format.Llava15ChatHandler(clip_model_path=str(proj_file))
-                self.model = llama_cpp.Llama(
-                                        model_path=str(model_path), 
-                                        n_gpu_layers=self.binding_config.n_gpu_layers, 
-                                        main_gpu=self.binding_config.main_gpu, 
-                                        n_ctx=self.config.ctx_size,
-                                        n_threads=self.binding_config.n_threads,
-                                        n_batch=self.binding_config.batch_size,
-                                        offload_kqv=self.binding_config.offload_kqv,
-                                        seed=self.binding_config.seed,
-                                        lora_path=self.binding_config.lora_path if self.binding_config.lora_path!="" else None,
-                                        lora_scale=self.binding_config.lora_scale,
+                return mmproj_variants[0]
+        return None
 
-                                        chat_handler=self.chat_handler,
-                                        logits_all=True
-                                    )
-        else:
-            self.model = llama_cpp.Llama(
-                                    model_path=str(model_path), 
-                                    n_gpu_layers= self.binding_config.n_gpu_layers, 
-                                    main_gpu=self.binding_config.main_gpu, 
+    def find_model_file(self, model_name:str):
+        """
+        Searches the gguf/ggml models folders for a model file by name.
+        The name can be a file name, a model folder or a part of the file name.
+        """
+        for models_dir_name in self.models_dir_names:
+            models_dir = self.lollms_paths.personal_models_path / models_dir_name
+            if not models_dir.exists():
+                continue
+            candidate = models_dir / model_name
+            if candidate.is_file():
+                return candidate
+            if candidate.is_dir():
+                variants = [v for v in candidate.iterdir() if check_file_type(v.suffix, self.supported_file_extensions) and "mmproj" not in v.name]
+                if len(variants)>0:
+                    return variants[0]
+            for v in models_dir.rglob("*"):
+                if v.is_file() and model_name.lower() in v.name.lower() and check_file_type(v.suffix, self.supported_file_extensions) and "mmproj" not in v.name:
+                    return v
+        return None
+
+    def build_draft_model(self, llama_cpp, model_path:Path):
+        """
+        Builds the draft model used for speculative decoding depending on the speculative_mode setting.
+        """
+        mode = self.binding_config.speculative_mode
+        if mode=="prompt_lookup":
+            from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+            return DraftModelMonitor(LlamaPromptLookupDecoding(num_pred_tokens=self.binding_config.num_draft_tokens), mode)
+        elif mode=="draft_model":
+            draft_path = self.find_model_file(self.binding_config.draft_model_name) if self.binding_config.draft_model_name!="" else None
+            if draft_path is None:
+                self.InfoMessage(f"Draft model {self.binding_config.draft_model_name} was not found in the gguf models folder.\nSpeculative decoding is deactivated")
+                return None
+            if draft_path == model_path:
+                self.warning("The draft model is the main model. Speculative decoding is deactivated")
+                return None
+            self.report_load_progress(f"Loading draft model {draft_path.name}")
+            draft = llama_cpp.Llama(
+                                    model_path=str(draft_path),
+                                    n_gpu_layers=self.binding_config.n_gpu_layers,
+                                    main_gpu=self.binding_config.main_gpu,
                                     n_ctx=self.config.ctx_size,
                                     n_threads=self.binding_config.n_threads,
                                     n_batch=self.binding_config.batch_size,
                                     offload_kqv=self.binding_config.offload_kqv,
-                                    seed=self.binding_config.seed,
-                                    lora_path=self.binding_config.lora_path if self.binding_config.lora_path!="" else None,
-                                    lora_scale=self.binding_config.lora_scale, 
+                                    verbose=False
                                 )
+            return DraftModelMonitor(GGUFDraftModel(draft, self.binding_config.num_draft_tokens), mode)
+        return None
 
-        # self.model.set_cache(LlamaCache(capacity_bytes=0))
-        print("Testing model")
-        for chunk in self.model.create_completion("question: What is 1+1\nanswer:",
-                                        max_tokens = 2,
-                                        stream=True):
-            print(chunk["choices"][0]["text"])
-        
-        ASCIIColors.success("Model built")            
-        return self
+    def setup_prompt_cache(self, llama_cpp, model, model_path:Path):
+        """
+        Attaches a prompt cache to the model depending on the cache_backend setting.
+        The states are stored per model, the disk cache lives in the personal models folder.
+        """
+        backend = self.binding_config.cache_backend
+        if backend=="none" or self.binding_config.cache_capacity<=0:
+            model.set_cache(None)
+            return None
+        try:
+            if backend=="disk":
+                if not PackageManager.check_package_installed("diskcache"):
+                    PackageManager.install_package("diskcache")
+                cache_dir = self.lollms_paths.personal_models_path / "llama_cpp_cache" / model_path.stem
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                cache = llama_cpp.LlamaDiskCache(cache_dir=str(cache_dir), capacity_bytes=self.binding_config.cache_capacity)
+            elif backend=="snapshots":
+                cache_dir = self.lollms_paths.personal_models_path / "llama_cpp_cache" / model_path.stem / "snapshots"
+                cache = LlamaStateSnapshotStore(cache_dir, self.binding_config.cache_capacity)
+            else:
+                cache = llama_cpp.LlamaRAMCache(capacity_bytes=self.binding_config.cache_capacity)
+            prompt_cache = PromptCacheMonitor(cache, backend)
+            model.set_cache(prompt_cache)
+            ASCIIColors.info(f"Prompt cache activated ({backend}, {self.binding_config.cache_capacity/(1<<30):.2f} GiB)")
+            return prompt_cache
+        except Exception as ex:
+            trace_exception(ex)
+            self.warning(f"Couldn't create the {backend} prompt cache. Running without cache")
+            model.set_cache(None)
+            return None
+
+    def find_lora_file(self, lora_name:str):
+        """Finds a LoRA adapter from its path or its name in the personal models lora folder"""
+        for candidate in [Path(lora_name), self.lollms_paths.personal_models_path / "lora" / lora_name, self.lollms_paths.personal_models_path / "lora" / f"{lora_name}.gguf"]:
+            if candidate.is_file():
+                return candidate
+        return None
+
+    def lora_selection(self, gpt_params:dict):
+        """
+        Returns the adapters (path -> scale) requested by the lora generation parameter, or the lora_path of the
+        binding settings when the request doesn't select any. An empty lora parameter runs the base model alone.
+        """
+        lora = gpt_params.get("lora")
+        if lora is None:
+            lora = {self.binding_config.lora_path:self.binding_config.lora_scale} if self.binding_config.lora_path!="" else {}
+        elif isinstance(lora, str):
+            lora = {lora:float(gpt_params.get("lora_scale", 1.0))} if lora!="" else {}
+        elif isinstance(lora, (list, tuple)):
+            lora = {name:1.0 for name in lora}
+        selection = {}
+        for name, scale in lora.items():
+            lora_path = self.find_lora_file(name)
+            if lora_path is None:
+                self.warning(f"LoRA adapter {name} was not found")
+                continue
+            selection[str(lora_path)] = float(scale)
+        return selection
+
+    def apply_lora(self, gpt_params:dict):
+        """
+        Attaches the adapters selected for this request. The prompt cache is only used with the adapters attached
+        when the model was loaded since the cached states were computed with them.
+        """
+        if self.lora_registry is None:
+            return
+        selection = self.lora_selection(gpt_params)
+        try:
+            if self.lora_registry.apply(selection):
+                # The evaluated tokens were computed with other adapters
+                self.model.n_tokens = 0
+        except Exception as ex:
+            trace_exception(ex)
+            self.error(f"Couldn't apply the LoRA adapters:\n{ex}")
+        self.model.set_cache(self.prompt_cache if selection==self.lora_registry.default else None)
+
+    def context_keep_length(self, prompt:str, tokens:list):
+        """Returns the number of tokens protected from the context shift (the system prompt by default)"""
+        if self.binding_config.context_shift_keep>=0:
+            return self.binding_config.context_shift_keep
+        header = self.config.start_header_id_template
+        first = prompt.find(header) if header else -1
+        second = prompt.find(header, first+len(header)) if first>=0 else -1
+        if second>0:
+            return longest_token_prefix(self.model.tokenize(prompt[:second].encode("utf8", errors="ignore"), add_bos=True, special=True), tokens)
+        return 1 if len(tokens)>0 and tokens[0]==self.model.token_bos() else 0
+
+    def shift_context(self, prompt:str, tokens:list, n_predict:int, min_generation:int=256):
+        """
+        Makes room for the prompt when it doesn't fit in the context with min_generation tokens left for the
+        generation, by dropping the oldest tokens after the protected prefix. A prompt that fits is kept whole
+        and llama_cpp shortens the generation to the room left, as without the context shift. The evaluated tokens that are kept are moved back in the KV cache
+        instead of being evaluated again. The dropped range is remembered so that the next prompts of the same
+        discussion are mapped to the shifted context.
+
+        Returns:
+            list: The tokens to evaluate
+        """
+        import llama_cpp
+        model = self.model
+        n_ctx = model.n_ctx()
+        self.context_shift_stats = None
+        original_tokens = tokens
+        state = self.context_shift_state
+        if state is not None and tokens[:len(state["origin"])]==state["origin"]:
+            # The discussion was already shifted by the previous requests
+            tokens = tokens[:state["n_keep"]] + tokens[state["n_keep"]+state["n_discard"]:]
+        else:
+            state = None
+            self.context_shift_state = None
+        overflow = len(tokens) + min(n_predict, min_generation, n_ctx//8) - n_ctx
+        if overflow<=0:
+            return tokens
+        n_keep = state["n_keep"] if state is not None else min(self.context_keep_length(prompt, tokens), n_ctx//4)
+        n_discard = overflow
+
+        kv_cache_seq_rm = getattr(llama_cpp, "llama_kv_cache_seq_rm", None) or getattr(llama_cpp, "llama_kv_self_seq_rm")
+        kv_cache_seq_add = getattr(llama_cpp, "llama_kv_cache_seq_add", None) or getattr(llama_cpp, "llama_kv_self_seq_add")
+        kv_cache_can_shift = getattr(llama_cpp, "llama_kv_cache_can_shift", None) or getattr(llama_cpp, "llama_kv_self_can_shift", None)
+        n_past = longest_token_prefix(model.input_ids[:model.n_tokens].tolist(), tokens)
+        shifted = 0
+        if n_past>n_keep+n_discard and (kv_cache_can_shift is None or kv_cache_can_shift(model.ctx)):
+            kv_cache_seq_rm(model.ctx, 0, n_keep, n_keep+n_discard)
+            kv_cache_seq_add(model.ctx, 0, n_keep+n_discard, n_past, -n_discard)
+            model.input_ids[n_keep:n_past-n_discard] = model.input_ids[n_keep+n_discard:n_past]
+            model.n_tokens = n_past-n_discard
+            shifted = n_past-n_keep-n_discard
+
+        n_discarded = n_discard + (state["n_discard"] if state is not None else 0)
+        self.context_shift_state = {"origin":original_tokens[:n_keep+n_discarded], "n_keep":n_keep, "n_discard":n_discarded}
+        self.context_shift_stats = {"kept":n_keep, "discarded":n_discard, "shifted":shifted, "total_discarded":n_discarded}
+        ASCIIColors.warning(f"Context full: dropped {n_discard} tokens after the first {n_keep} tokens, {shifted} evaluated tokens shifted in place")
+        return tokens[:n_keep] + tokens[n_keep+n_discard:]
+
+    def ingest_prompt(self, tokens:list, callback:Callable=None):
+        """
+        Evaluates the prompt in n_batch chunks before the completion, reporting the progress and the remaining
+        time through the callback after each chunk. The last token is left to llama_cpp that evaluates it to
+        sample the first generated token.
+
+        Returns:
+            bool: False if the callback returned False to cancel the generation
+        """
+        model = self.model
+        if len(tokens)>=model.n_ctx():
+            # llama_cpp reports the error
+            return True
+        if self.prompt_cache is not None and model.cache is not None:
+            # The cache lookup done by llama_cpp is done here so that the cached prefix is not evaluated again
+            self.prompt_cache.skip_next_lookup = False
+            try:
+                state = self.prompt_cache[tokens]
+                if longest_token_prefix(state.input_ids[:state.n_tokens].tolist(), tokens) > longest_token_prefix(model.input_ids[:model.n_tokens].tolist(), tokens):
+                    model.load_state(state)
+            except KeyError:
+                pass
+            self.prompt_cache.skip_next_lookup = True
+        prefix = longest_token_prefix(model.input_ids[:model.n_tokens].tolist(), tokens[:-1])
+        model.n_tokens = prefix
+        to_eval = tokens[prefix:-1]
+        n_batch = model.n_batch
+        if len(to_eval)<=n_batch:
+            if len(to_eval)>0:
+                model.eval(to_eval)
+            return True
+        start_time = time.perf_counter()
+        for i in range(0, len(to_eval), n_batch):
+            model.eval(to_eval[i:i+n_batch])
+            done = min(i+n_batch, len(to_eval))
+            elapsed = time.perf_counter()-start_time
+            speed = done/elapsed if elapsed>0 else 0
+            eta = (len(to_eval)-done)/speed if speed>0 else 0
+            text = f"Processing prompt: {prefix+done}/{len(tokens)} tokens ({speed:.1f} tokens/s, {eta:.0f}s left)"
+            ASCIIColors.info(text)
+            if callback is not None and done<len(to_eval):
+                if callback(text, MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_STEP) is False:
+                    if self.prompt_cache is not None:
+                        self.prompt_cache.skip_next_lookup = False
+                    ASCIIColors.warning(f"Prompt processing cancelled after {prefix+done}/{len(tokens)} tokens")
+                    return False
+        return True
+
+    def report_prompt_cache(self):
+        if self.prompt_cache is not None:
+            ASCIIColors.info(self.prompt_cache.summary(self.prompt_cache.pop_last_lookup()))
     
     def install_cpu(self):
         # Set the environment variable
@@ -305,6 +2317,7 @@ class LLAMA_Python_CPP(LLMBinding):
     def install(self):
         # free up memory
         ASCIIColors.success("freeing memory")
+        self.unload_model(close=True)
         AdvancedGarbageCollector.safeHardCollectMultiple(['model'],self)
         AdvancedGarbageCollector.safeHardCollectMultiple(['AutoModelForCausalLM'])
         AdvancedGarbageCollector.collect()
@@ -381,6 +2394,9 @@ class LLAMA_Python_CPP(LLMBinding):
         Returns:
             list: A list of tokens representing the tokenized prompt.
         """
+        self.wait_for_model()
+        if self.server_pool is not None:
+            return self.server_pool.tokenize(prompt)
         return self.model.tokenize(prompt.encode("utf8", errors="ignore"))
 
     def detokenize(self, tokens_list:list):
@@ -393,18 +2409,90 @@ class LLAMA_Python_CPP(LLMBinding):
         Returns:
             str: The detokenized text as a string.
         """
+        self.wait_for_model()
+        if self.server_pool is not None:
+            return self.server_pool.detokenize(tokens_list)
         return self.model.detokenize(tokens_list).decode("utf8", errors="ignore")
     
+    def get_embedding_model(self):
+        """
+        Returns the model used to compute embeddings and the embeddings cache of the current model.
+        The dedicated embedding context is built on the first call for each model.
+        """
+        model_path = Path(self.pool_key[0])
+        if self.embedding_key != self.pool_key:
+            import llama_cpp
+            self.embedding_model = None
+            gc.collect()
+            if self.binding_config.embedding_context or self.server_pool is not None:
+                ASCIIColors.info(f"Building embedding context for {model_path.name}")
+                self.embedding_model = llama_cpp.Llama(
+                                        model_path=str(model_path),
+                                        embedding=True,
+                                        n_gpu_layers=self.binding_config.n_gpu_layers,
+                                        main_gpu=self.binding_config.main_gpu,
+                                        n_ctx=self.config.ctx_size,
+                                        n_threads=self.binding_config.n_threads,
+                                        n_batch=self.binding_config.batch_size,
+                                        n_ubatch=self.binding_config.batch_size,
+                                        offload_kqv=self.binding_config.offload_kqv,
+                                        verbose=False
+                                    )
+            cache_dir = self.lollms_paths.personal_models_path / "llama_cpp_cache" / model_path.stem / "embeddings"
+            self.embedding_cache = EmbeddingCache(self.binding_config.embedding_cache_capacity, cache_dir, self.binding_config.embedding_disk_cache_capacity)
+            self.embedding_key = self.pool_key
+        return self.embedding_model if self.embedding_model is not None else self.model, self.embedding_cache
+
     def embed(self, text):
         """
         Computes text embedding
         Args:
-            text (str): The text to be embedded.
+            text (str|List[str]): The text or the list of texts to be embedded.
+            Lists are packed into multi sequence batches of batch_size tokens holding at most
+            the number of sequences the embedding context was built for.
         Returns:
-            List[float]
+            List[float] for a text, List[List[float]] for a list of texts
         """
-        return self.model.embed(text)
+        self.wait_for_model()
+        if self.model is None:
+            self.InfoMessage("No model is loaded. Please select a model first")
+            return None
+        texts = [text] if isinstance(text, str) else list(text)
+        with self.embedding_lock:
+            model, cache = self.get_embedding_model()
+            # Without a dedicated embedding context, the embeddings are computed on the context of the requests
+            with self.model_lock if model is self.model else nullcontext():
+                embeddings = self.compute_embeddings(model, cache, texts)
+        return embeddings[0] if isinstance(text, str) else embeddings
+
+    def compute_embeddings(self, model, cache, texts:list):
+        """Returns the embeddings of the texts, computing only the ones missing from the cache"""
+        keys = [EmbeddingCache.key(t) for t in texts]
+        embeddings = [cache.get(key) for key in keys]
+        # Each distinct missing text is computed once
+        missing = OrderedDict()
+        for t, key, embedding in zip(texts, keys, embeddings):
+            if embedding is None and key not in missing:
+                missing[key] = t
+        if len(missing)>0:
+            missing_keys = list(missing.keys())
+            computed = {}
+            # llama.cpp rejects the sequence ids beyond the n_seq_max of the context. llama-cpp-python only raises
+            # it for contexts built in embedding mode and older releases keep it to 1, so they embed one text per call
+            chunk_size = min(256, max(1, model.context_params.n_seq_max))
+            for i in range(0, len(missing_keys), chunk_size):
+                chunk_keys = missing_keys[i:i+chunk_size]
+                vectors = model.embed([missing[key] for key in chunk_keys])
+                for key, vector in zip(chunk_keys, vectors):
+                    cache.put(key, vector)
+                    computed[key] = vector
+            cache.flush()
+            embeddings = [embedding if embedding is not None else computed[key] for key, embedding in zip(keys, embeddings)]
+            if len(texts)>1:
+                ASCIIColors.info(f"Embedded {len(texts)} texts, {len(texts)-len(missing)} from cache")
+        return embeddings
     
+    @with_model_lock
     def generate(self, 
                  prompt:str,                  
                  n_predict: int = 128,
@@ -423,6 +2511,14 @@ class LLAMA_Python_CPP(LLMBinding):
                 top_k (int, optional): Controls the diversity of the generated text by limiting the number of possible next tokens to consider. Defaults to 0 (no limit) if not provided.
                 top_p (float, optional): Controls the diversity of the generated text by truncating the least likely tokens whose cumulative probability exceeds `top_p`. Defaults to 0.0 (no truncation) if not provided.
                 repeat_penalty (float, optional): Adjusts the penalty for repeating tokens in the generated text. Higher values (e.g., 2.0) make the model less likely to repeat tokens. Defaults to 1.0 if not provided.
+                last_n_tokens (int, optional): Number of last tokens the repeat penalty applies to (-1 for the whole context).
+                min_p (float, optional): Removes the tokens whose probability is below min_p times the probability of the most likely token.
+                grammar (str, optional): GBNF grammar the generated text must follow.
+                json_schema (dict or str, optional): JSON schema the generated text must follow.
+                lora (str, list or dict, optional): LoRA adapters to attach for this request (a name with lora_scale, a list of names or a name to scale dictionary). Defaults to the lora_path setting.
+                banned_tokens (list, optional): Token ids that can't be generated.
+                ban_eos (bool, optional): Prevents the model from ending the generation.
+                logit_bias (dict, optional): Maps token ids to a bias added to their logits.
 
         Returns:
             str: The generated text based on the prompt
@@ -437,9 +2533,32 @@ class LLAMA_Python_CPP(LLMBinding):
             "n_threads":self.binding_config.n_threads,
             "batch_size":self.binding_config.batch_size
         }
+        # The repeat_penalty setting is not applied to the local generation, only a penalty sent with the request
+        apply_repeat_penalty = "repeat_penalty" in gpt_params
         gpt_params = {**default_params, **gpt_params}
         if gpt_params['seed']!=-1:
             self.seed = self.binding_config.seed
+        if self.draft_model is not None:
+            self.draft_model.reset()
+        start_time = time.perf_counter()
+
+        if self.server_pool is not None:
+            return self.generate_on_server(prompt, n_predict, callback, gpt_params, apply_repeat_penalty)
+
+        import llama_cpp
+        self.apply_lora(gpt_params)
+        logits_processors = self.build_logits_processors(gpt_params, apply_repeat_penalty)
+        sampling_params = {"logits_processor":llama_cpp.LogitsProcessorList(logits_processors) if len(logits_processors)>0 else None}
+        if gpt_params.get("min_p") is not None:
+            # min_p is applied by the logits processors
+            sampling_params["min_p"] = 0.0
+        if gpt_params.get("grammar") or gpt_params.get("json_schema"):
+            self.grammar_cache.capacity = self.binding_config.grammar_cache_capacity
+            try:
+                sampling_params["grammar"] = self.grammar_cache.get(gpt_params.get("grammar"), gpt_params.get("json_schema"))
+            except Exception as ex:
+                trace_exception(ex)
+                self.error(f"Couldn't compile the grammar, generating without constraints:\n{ex}")
 
         """
         chunks = self.model(prompt, max_tokens=n_predict,temperature=float(gpt_params["temperature"]),stop=["<0x0A>","assistant\n"],stream=True)
@@ -478,7 +2597,8 @@ class LLAMA_Python_CPP(LLMBinding):
                                     max_tokens=n_predict,
                                     temperature=float(gpt_params["temperature"]),
                                     stop=["<0x0A>","assistant\n", self.config.start_header_id_template,self.config.start_user_header_id_template, self.config.start_ai_header_id_template],#
-                                    stream=True
+                                    stream=True,
+                                    **sampling_params
                                 ):
 
                     if count >= n_predict:
@@ -500,12 +2620,19 @@ class LLAMA_Python_CPP(LLMBinding):
         else:
             output = ""
             count = 0
+            prompt_tokens = self.model.tokenize(prompt.strip().encode("utf8", errors="ignore"), add_bos=True, special=True)
+            self.context_shift_stats = None
+            if self.binding_config.context_shift:
+                prompt_tokens = self.shift_context(prompt.strip(), prompt_tokens, n_predict)
+            if not self.ingest_prompt(prompt_tokens, callback):
+                return output
             for chunk in self.model.create_completion(
-                                    prompt.strip(),
+                                    prompt_tokens if len(prompt_tokens)>0 else prompt.strip(),
                                     max_tokens=n_predict,
                                     temperature=float(gpt_params["temperature"]),
                                     stop=["<0x0A>","assistant\n", self.config.start_header_id_template,self.config.start_user_header_id_template, self.config.start_ai_header_id_template],
-                                    stream=True
+                                    stream=True,
+                                    **sampling_params
                         ):
                 
                 word = chunk["choices"][0]["text"]
@@ -517,10 +2644,271 @@ class LLAMA_Python_CPP(LLMBinding):
                         if not callback(word, MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
                             break
         
-
+        self.report_prompt_cache()
+        if self.context_shift_stats is not None:
+            ASCIIColors.info(f"Context shift: {self.context_shift_stats['discarded']} tokens discarded ({self.context_shift_stats['total_discarded']} since the beginning of the discussion), {self.context_shift_stats['shifted']} tokens shifted, first {self.context_shift_stats['kept']} tokens kept")
+        if self.draft_model is not None:
+            ASCIIColors.info(self.draft_model.summary(count, time.perf_counter()-start_time))
         return output            
 
 
+    def build_logits_processors(self, gpt_params:dict, apply_repeat_penalty:bool=True):
+        """
+        Builds the logits processors requested in gpt_params. The token ids are converted to index arrays
+        once so that each processor is a single numpy operation per generated token.
+            banned_tokens (list): token ids that can't be generated
+            ban_eos (bool): prevents the generation from ending
+            logit_bias (dict): token id -> bias added to its logit
+            min_p (float): removes the tokens less likely than min_p times the most likely one
+            repeat_penalty (float) and last_n_tokens (int): penalizes the tokens of the last last_n_tokens tokens (-1 for the whole context), when apply_repeat_penalty is True
+
+        Returns:
+            list: the processors, called with (input_ids, logits)
+        """
+        import numpy as np
+        n_vocab = self.model.n_vocab()
+        processors = []
+        banned_tokens = list(gpt_params.get("banned_tokens") or [])
+        if gpt_params.get("ban_eos"):
+            banned_tokens.append(self.model.token_eos())
+        if len(banned_tokens)>0:
+            token_ids = np.unique(np.asarray(banned_tokens, dtype=np.intc))
+            processors.append(partial(custom_token_ban_logits_processor, token_ids[(token_ids>=0) & (token_ids<n_vocab)]))
+        logit_bias = {int(k):float(v) for k,v in (gpt_params.get("logit_bias") or {}).items() if 0<=int(k)<n_vocab}
+        if len(logit_bias)>0:
+            processors.append(partial(logit_bias_logits_processor, np.fromiter(logit_bias.keys(), dtype=np.intc), np.fromiter(logit_bias.values(), dtype=np.float32)))
+        if apply_repeat_penalty and float(gpt_params.get("repeat_penalty", 1.0))!=1.0:
+            processors.append(partial(repetition_penalty_logits_processor, float(gpt_params["repeat_penalty"]), int(gpt_params.get("last_n_tokens", self.config.repeat_last_n))))
+        if float(gpt_params.get("min_p") or 0)>0:
+            processors.append(partial(min_p_logits_processor, float(gpt_params["min_p"])))
+        return processors
+
+    def server_params(self, gpt_params:dict, apply_repeat_penalty:bool=True):
+        """Converts the generation parameters to the parameters of the llama.cpp server, the repetition penalty is only sent when apply_repeat_penalty is True"""
+        params = {
+            "temperature":float(gpt_params["temperature"]),
+            "top_k":int(gpt_params["top_k"]),
+            "top_p":float(gpt_params["top_p"]),
+            "seed":int(gpt_params["seed"]),
+        }
+        if apply_repeat_penalty:
+            params["repeat_penalty"] = float(gpt_params["repeat_penalty"])
+            params["repeat_last_n"] = int(gpt_params["last_n_tokens"])
+        if gpt_params.get("min_p") is not None:
+            params["min_p"] = float(gpt_params["min_p"])
+        logit_bias = [[int(k), float(v)] for k,v in (gpt_params.get("logit_bias") or {}).items()]
+        logit_bias += [[int(token_id), False] for token_id in (gpt_params.get("banned_tokens") or [])]
+        if len(logit_bias)>0:
+            params["logit_bias"] = logit_bias
+        if gpt_params.get("ban_eos"):
+            params["ignore_eos"] = True
+        if gpt_params.get("json_schema"):
+            params["json_schema"] = gpt_params["json_schema"] if not isinstance(gpt_params["json_schema"], str) else json.loads(gpt_params["json_schema"])
+        elif gpt_params.get("grammar"):
+            params["grammar"] = gpt_params["grammar"]
+        return params
+
+    def generate_on_server(self, prompt:str, n_predict:int, callback:Callable, gpt_params:dict, apply_repeat_penalty:bool=True):
+        """Generates text with the llama.cpp server workers"""
+        if gpt_params.get("lora") is not None:
+            self.warning("LoRA adapters selection is not supported in server mode, using the base model")
+        stop = [s for s in ["<0x0A>","assistant\n", self.config.start_header_id_template,self.config.start_user_header_id_template, self.config.start_ai_header_id_template] if s]
+        try:
+            if self.binding_config.generation_mode=="chat":
+                return self.server_pool.chat_completion([{"role": "user", "content": prompt.strip()}], n_predict, self.server_params(gpt_params, apply_repeat_penalty), stop, callback)
+            else:
+                return self.server_pool.completion(prompt.strip(), n_predict, self.server_params(gpt_params, apply_repeat_penalty), stop, callback)
+        except Exception as ex:
+            trace_exception(ex)
+            self.error(f"The llama.cpp server failed to generate:\n{ex}")
+            return ""
+
+    def build_batch_context(self, llama_cpp, model, n_seq_max:int):
+        """Builds a context of the model with the settings of its own context that holds n_seq_max sequences"""
+        params = type(model.context_params).from_buffer_copy(model.context_params)
+        params.n_seq_max = n_seq_max
+        if hasattr(params, "kv_unified"):
+            # The sequences share the whole context instead of n_ctx/n_seq_max tokens each
+            params.kv_unified = True
+        init_from_model = getattr(llama_cpp, "llama_init_from_model", None) or llama_cpp.llama_new_context_with_model
+        ctx = init_from_model(model.model, params)
+        if ctx is None:
+            raise RuntimeError(f"Couldn't build a context holding {n_seq_max} sequences")
+        return ctx
+
+    @with_model_lock
+    def generate_batch(self,
+                 prompts:list,
+                 n_predict: int = 128,
+                 callbacks: list = None,
+                 verbose: bool = False,
+                 **gpt_params ):
+        """Generates text out of several independent prompts decoded together
+
+        The prompts are evaluated as distinct sequences of the same llama_batch, so each decode step
+        advances all active sequences at once. A new prompt is admitted as soon as a finished sequence
+        frees enough room in the context. The sequences live in a context built for the batch (the
+        context of the model holds a single sequence), which is freed at the end.
+
+        Args:
+            prompts (list): The prompts to use for generation
+            n_predict (int, optional): Number of tokens to predict for each prompt. Defaults to 128.
+            callbacks (list, optional): One callback (or None) per prompt, called every time a new text element is generated for that prompt. Returning False stops that prompt only. Defaults to None.
+            verbose (bool, optional): If true, the code will spit many information about the generation process. Defaults to False.
+            **gpt_params: Additional parameters for GPT generation (temperature, top_k, top_p, repeat_penalty, last_n_tokens, seed and the logits processors parameters of generate).
+
+        Returns:
+            list: The generated texts, in the order of the prompts
+
+        Raises:
+            RuntimeError: If the batch context can't be built or a batch can't be decoded
+        """
+        import codecs
+        import numpy as np
+        import llama_cpp
+        default_params = {
+            'temperature': float(self.config.temperature),
+            'top_k': int(self.config.top_k),
+            'top_p': float(self.config.top_p),
+            'repeat_penalty': float(self.config.repeat_penalty),
+            'last_n_tokens' : int(self.config.repeat_last_n),
+            "seed":int(self.binding_config.seed),
+        }
+        # Same as generate, the repeat_penalty setting is only applied when the request sends one
+        apply_repeat_penalty = "repeat_penalty" in gpt_params
+        gpt_params = {**default_params, **gpt_params}
+        if callbacks is None:
+            callbacks = [None]*len(prompts)
+        if self.server_pool is not None:
+            # The server slots already batch the concurrent requests
+            with ThreadPoolExecutor(max_workers=len(self.server_pool.workers)*self.server_pool.n_parallel) as executor:
+                return list(executor.map(lambda args: self.generate_on_server(args[0], n_predict, args[1], gpt_params, apply_repeat_penalty), zip(prompts, callbacks)))
+        rng = np.random.default_rng(None if gpt_params["seed"]==-1 else gpt_params["seed"])
+        stop = ["<0x0A>","assistant\n", self.config.start_header_id_template,self.config.start_user_header_id_template, self.config.start_ai_header_id_template]
+        stop = [s for s in stop if s]
+
+        model = self.model
+        n_ctx = model.n_ctx()
+        n_batch = model.n_batch
+        n_vocab = model.n_vocab()
+        kv_cache_seq_rm = getattr(llama_cpp, "llama_kv_cache_seq_rm", None) or getattr(llama_cpp, "llama_kv_self_seq_rm")
+        max_sequences = self.binding_config.batch_max_sequences
+        if hasattr(llama_cpp, "llama_max_parallel_sequences"):
+            max_sequences = min(max_sequences, llama_cpp.llama_max_parallel_sequences())
+        logits_processors = self.build_logits_processors(gpt_params)
+        if gpt_params.get("grammar") or gpt_params.get("json_schema"):
+            self.warning("Grammars are not supported by the batched generation, the prompts are generated without constraints")
+
+        outputs = [""]*len(prompts)
+        prompts_tokens = [model.tokenize(prompt.strip().encode("utf8", errors="ignore")) for prompt in prompts]
+        pending = list(range(len(prompts)))
+        active = {}
+        free_seq_ids = list(range(max_sequences))
+        reserved = 0
+        n_generated = 0
+        start_time = time.perf_counter()
+
+        self.apply_lora(gpt_params)
+        ctx = self.build_batch_context(llama_cpp, model, max_sequences)
+        batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+        try:
+            if self.lora_registry is not None:
+                self.lora_registry.attach(ctx)
+            while pending or active:
+                # Admit new prompts while there is room in the context
+                while pending and free_seq_ids:
+                    index = pending[0]
+                    tokens = prompts_tokens[index]
+                    budget = min(n_predict, n_ctx - len(tokens))
+                    if budget<=0:
+                        pending.pop(0)
+                        self.error(f"Prompt {index} ({len(tokens)} tokens) does not fit in the context ({n_ctx} tokens)")
+                        continue
+                    if reserved + len(tokens) + budget > n_ctx and active:
+                        break
+                    pending.pop(0)
+                    reserved += len(tokens) + budget
+                    active[free_seq_ids.pop(0)] = {
+                        "index":index,
+                        "to_eval":tokens,
+                        "n_past":0,
+                        "tokens":list(tokens),
+                        "budget":budget,
+                        "n_generated":0,
+                        "decoder":codecs.getincrementaldecoder("utf-8")(errors="ignore"),
+                        "streamed":0,
+                    }
+
+                # Fill the batch with the tokens waiting to be evaluated by each sequence
+                n_tokens = 0
+                logits_rows = {}
+                for seq_id, seq in active.items():
+                    if n_tokens>=n_batch:
+                        break
+                    chunk = seq["to_eval"][:n_batch - n_tokens]
+                    for i, token in enumerate(chunk):
+                        batch.token[n_tokens] = token
+                        batch.pos[n_tokens] = seq["n_past"] + i
+                        batch.n_seq_id[n_tokens] = 1
+                        batch.seq_id[n_tokens][0] = seq_id
+                        batch.logits[n_tokens] = False
+                        n_tokens += 1
+                    seq["n_past"] += len(chunk)
+                    seq["to_eval"] = seq["to_eval"][len(chunk):]
+                    if len(seq["to_eval"])==0:
+                        batch.logits[n_tokens-1] = True
+                        logits_rows[seq_id] = n_tokens-1
+                batch.n_tokens = n_tokens
+                if llama_cpp.llama_decode(ctx, batch)!=0:
+                    raise RuntimeError("llama_decode failed while decoding the batch")
+
+                # Sample the next token of each sequence that has been fully evaluated
+                finished = []
+                for seq_id, row in logits_rows.items():
+                    seq = active[seq_id]
+                    logits = np.array(np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(ctx, row), shape=(n_vocab,)))
+                    input_ids = np.asarray(seq["tokens"], dtype=np.intc)
+                    for processor in logits_processors:
+                        logits = processor(input_ids, logits)
+                    token = sample_logits(logits, rng, gpt_params["temperature"], gpt_params["top_k"], gpt_params["top_p"])
+                    index = seq["index"]
+                    done = bool(llama_cpp.llama_token_is_eog(model.model, token))
+                    if not done:
+                        seq["tokens"].append(token)
+                        seq["to_eval"] = [token]
+                        seq["n_generated"] += 1
+                        n_generated += 1
+                        outputs[index] += seq["decoder"].decode(model.detokenize([token]))
+                        done = seq["n_generated"]>=seq["budget"]
+                    stop_pos = min([p for p in [outputs[index].find(s) for s in stop] if p>=0], default=-1)
+                    if stop_pos>=0:
+                        outputs[index] = outputs[index][:stop_pos]
+                        done = True
+                    # Stream what can't be the beginning of a stop string anymore
+                    end = len(outputs[index]) if done else len(outputs[index]) - stop_string_holdback(outputs[index], stop)
+                    if end>seq["streamed"]:
+                        word = outputs[index][seq["streamed"]:end]
+                        seq["streamed"] = end
+                        if callbacks[index] is not None:
+                            if not callbacks[index](word, MSG_OPERATION_TYPE.MSG_OPERATION_TYPE_ADD_CHUNK):
+                                done = True
+                    if done:
+                        finished.append(seq_id)
+
+                for seq_id in finished:
+                    seq = active.pop(seq_id)
+                    kv_cache_seq_rm(ctx, seq_id, -1, -1)
+                    reserved -= len(seq["tokens"]) - seq["n_generated"] + seq["budget"]
+                    free_seq_ids.append(seq_id)
+        finally:
+            llama_cpp.llama_batch_free(batch)
+            llama_cpp.llama_free(ctx)
+
+        elapsed = time.perf_counter()-start_time
+        ASCIIColors.info(f"Batch generation: {len(prompts)} prompts, {n_generated} tokens in {elapsed:.2f}s ({n_generated/elapsed if elapsed>0 else 0:.2f} tokens/s)")
+        return outputs
+
+    @with_model_lock
     def generate_with_images(self, 
             prompt:str,
             images:list=[],
@@ -542,11 +2930,32 @@ class LLAMA_Python_CPP(LLMBinding):
             'top_p': 0.96,
             'repeat_penalty': 1.3
         }
+        apply_repeat_penalty = "repeat_penalty" in gpt_params
         gpt_params = {**default_params, **gpt_params}
         output = ""
+        if self.server_pool is not None:
+            gpt_params = {"last_n_tokens":int(self.config.repeat_last_n), "seed":int(self.binding_config.seed), **gpt_params}
+            stop = [s for s in ["<0x0A>","assistant\n", self.config.start_header_id_template,self.config.start_user_header_id_template, self.config.start_ai_header_id_template] if s]
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "image_url", "image_url": {"url": image_to_data_uri(img)}}
+                        for img in images
+                    ]+[ {"type" : "text", "text": prompt}]
+                }
+            ]
+            try:
+                return self.server_pool.chat_completion(messages, n_predict, self.server_params(gpt_params, apply_repeat_penalty), stop, callback)
+            except Exception as ex:
+                trace_exception(ex)
+                self.error(f"The llama.cpp server failed to generate:\n{ex}")
+                return ""
+        self.apply_lora(gpt_params)
         try:
             count = 0
-            url_imgs = [f"http://{self.config.host}:{self.config.port}"+discussion_path_to_url(img) for img in images]
+            # The images are read from disk, the chat handler decodes the data URIs
+            url_imgs = [image_to_data_uri(img) for img in images]
             for chunk in self.model.create_chat_completion(
                                 messages = [
                                     {
@@ -577,6 +2986,8 @@ class LLAMA_Python_CPP(LLMBinding):
                             break
         except Exception as ex:
             trace_exception(ex)
+        if hasattr(self.chat_handler, "summary"):
+            ASCIIColors.info(self.chat_handler.summary())
         return output
 
 if __name__=="__main__":
@@ -0,0 +1,52 @@
+# project: lollms
+# author: ParisNeo with the help of the community
+# script: autotune.py
+# description : measures the best n_threads, n_threads_batch and batch_size of a gguf model on this machine
+# and stores them in the tuning profiles used by the python_llama_cpp binding (autotune setting)
+# usage : python autotune.py path/to/model.gguf --n_gpu_layers 0
+
+import argparse
+import importlib.util
+from pathlib import Path
+
+# The binding is loaded the same way lollms loads it
+spec = importlib.util.spec_from_file_location("python_llama_cpp", Path(__file__).parent / "__init__.py")
+binding = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(binding)
+
+
+def parse_list(text):
+    return [int(v) for v in text.split(",")] if text else None
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Measure the best threads and batch settings of a gguf model on this machine")
+    parser.add_argument("model_path", type=str, help="Path to the gguf model file")
+    parser.add_argument("--n_gpu_layers", type=int, default=0, help="Number of layers offloaded to the gpu (must match the binding settings)")
+    parser.add_argument("--threads", type=str, default="", help="Comma separated thread counts to try (defaults to a sweep over the available cores)")
+    parser.add_argument("--batch_sizes", type=str, default="", help="Comma separated batch sizes to try (defaults to 128,256,512,1024,2048)")
+    parser.add_argument("--prompt_tokens", type=int, default=512, help="Size of the synthetic prompt")
+    parser.add_argument("--decode_tokens", type=int, default=32, help="Number of generated tokens measured")
+    parser.add_argument("--profiles", type=str, default="", help="Profiles file (defaults to the one of the lollms personal models folder)")
+    args = parser.parse_args()
+
+    if args.profiles:
+        profiles_file = Path(args.profiles)
+    else:
+        from lollms.paths import LollmsPaths
+        lollms_paths = LollmsPaths.find_paths(tool_prefix="")
+        profiles_file = lollms_paths.personal_models_path / "llama_cpp_cache" / "autotune_profiles.json"
+
+    model_path = Path(args.model_path)
+    profile = binding.autotune_llama_cpp(
+                                model_path,
+                                args.n_gpu_layers,
+                                thread_candidates=parse_list(args.threads),
+                                batch_candidates=parse_list(args.batch_sizes),
+                                prompt_tokens=args.prompt_tokens,
+                                decode_tokens=args.decode_tokens
+                            )
+    binding.LlamaTuningProfiles(profiles_file).put(model_path, args.n_gpu_layers, profile)
+    binding.ASCIIColors.success(f"{model_path.name}: {profile['n_threads']} threads, {profile['n_threads_batch']} prompt threads, batch of {profile['n_batch']}")
+    binding.ASCIIColors.success(f"{profile['prompt_tokens_per_s']:.1f} prompt tokens/s, {profile['decode_tokens_per_s']:.1f} tokens/s")
+    binding.ASCIIColors.info(f"Profile saved to {profiles_file}")